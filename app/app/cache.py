@@ -0,0 +1,102 @@
+from collections import OrderedDict
+from datetime import datetime, timezone
+import hashlib
+import threading
+from typing import FrozenSet, Iterable, List, NamedTuple, Optional
+
+from db import DBEntry
+
+
+class CachedPage(NamedTuple):
+    body: bytes
+    mimetype: str
+    etag: str
+    last_modified: datetime
+    person_ids: FrozenSet[str]
+
+
+class PageCache():
+    """Bounded LRU cache of rendered pages. Each page can be registered
+    with the IDs of the people whose data appears on it, so that when
+    those people (or their relationships) are changed, exactly the
+    affected pages are dropped.
+
+    Every invalidation also moves the cache on to a new epoch. A page
+    rendered while a change was being committed may show the old data,
+    so callers take the epoch before rendering and pass it to set(),
+    which doesn't store the page if the epoch has moved on since.
+    """
+    def __init__(self, max_size: int) -> None:
+        self.max_size = max_size
+        self._pages = OrderedDict()
+        # person ID -> set of cache keys for pages showing that person
+        self._dependents = {}
+        self._page_deps = {}
+        self._lock = threading.Lock()
+        self.epoch = 0
+
+    def get(self, key: str) -> Optional[CachedPage]:
+        with self._lock:
+            page = self._pages.get(key)
+            if page is not None:
+                self._pages.move_to_end(key)
+            return page
+
+    def set(self, key: str, body: bytes, mimetype: str,
+            person_ids: Iterable[str] = (), epoch: Optional[int] = None) -> CachedPage:
+        person_ids = frozenset(person_ids)
+        page = CachedPage(
+            body=body,
+            mimetype=mimetype,
+            etag=hashlib.sha1(body).hexdigest(),
+            last_modified=datetime.now(timezone.utc).replace(microsecond=0),
+            person_ids=person_ids)
+        with self._lock:
+            if epoch is not None and epoch != self.epoch:
+                return page
+            self._remove(key)
+            self._pages[key] = page
+            self._page_deps[key] = person_ids
+            for pid in person_ids:
+                self._dependents.setdefault(pid, set()).add(key)
+
+            while len(self._pages) > self.max_size:
+                oldest = next(iter(self._pages))
+                self._remove(oldest)
+        return page
+
+    def _remove(self, key: str) -> None:
+        # must be called with the lock held
+        self._pages.pop(key, None)
+        for pid in self._page_deps.pop(key, ()):
+            keys = self._dependents.get(pid)
+            if keys is not None:
+                keys.discard(key)
+                if len(keys) == 0:
+                    del self._dependents[pid]
+
+    def invalidate_people(self, person_ids: Iterable[str]) -> None:
+        """Drops every page that shows any of the given people."""
+        with self._lock:
+            self.epoch += 1
+            for pid in set(person_ids):
+                for key in list(self._dependents.get(pid, ())):
+                    self._remove(key)
+
+    def invalidate(self, entries: Optional[List[DBEntry]] = None) -> None:
+        """Commit hook for DBConnect: drops the pages affected by the
+        committed entries, or everything if the entries are unknown."""
+        if entries is None:
+            self.clear()
+            return
+        person_ids = set()
+        for entry in entries:
+            person_ids.update(entry.person_ids())
+        self.invalidate_people(person_ids)
+
+    def clear(self) -> None:
+        with self._lock:
+            self.epoch += 1
+            self._pages.clear()
+            self._dependents.clear()
+            self._page_deps.clear()
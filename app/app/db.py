@@ -1,13 +1,208 @@
+import csv
+from datetime import date, datetime, MAXYEAR, MINYEAR
 from enum import Enum
 import io
+import json
+import logging
 import os
-from typing import Any, Dict, List
+import random
+import re
+import select
+import socket
+import sys
+import threading
+import time
+from typing import Any, Callable, Dict, FrozenSet, Iterator, List, Optional, Sequence, Tuple
 import psycopg2
+import psycopg2.extensions
+import psycopg2.extras
+from psycopg2 import sql
 
 PERSON_COLS = ["id", "print_id", "in_tree", "first_name", "nickname", "middle_name1", "middle_name2", "last_name", "pref_name", "gender", "birth_month", "birth_day", "birth_year", "birth_place", "death_month", "death_day", "death_year", "death_place", "buried", "additional_notes"]
 MARRIAGE_COLS = ["id", "pid1", "pid2", "marriage_order", "married_month", "married_day", "married_year", "married_place", "common_law", "divorced", "divorced_month", "divorced_day", "divorced_year"]
 CHILDREN_COLS = ["id", "pid", "cid", "birth_order", "adoptive"]
 
+# columns written to the CSV data exports, for each table; the row IDs
+# of marriages and children are included so that the rows in a change
+# export (see export_changes()) can be matched to those in a full one
+EXPORT_COLS = {
+    "people": list(PERSON_COLS),
+    "marriages": list(MARRIAGE_COLS),
+    "children": list(CHILDREN_COLS)
+}
+
+NAMES_EXPR = "person_names(first_name, nickname, middle_name1, middle_name2, last_name)"
+# the decade someone was born in, for the search facets (and the filter
+# they link to): that of the middle of the range of possible birth
+# dates, if it is bounded at both ends
+BIRTH_DECADE_EXPR = """CASE WHEN NOT lower_inf(birth_range) AND NOT upper_inf(birth_range)
+    THEN EXTRACT(YEAR FROM lower(birth_range) + (upper(birth_range) - lower(birth_range)) / 2)::integer / 10 * 10
+    END"""
+
+# connections that have sat unused in the pool for longer than this
+# (in seconds) are pinged before being handed out
+HEALTH_CHECK_INTERVAL = 30
+
+# limit on the number of generations followed when rebuilding the
+# ancestry table, which guards against loops in the data
+ANCESTRY_MAX_DEPTH = 100
+
+# channel on which committed changes are announced to the other
+# processes (see DBConnect.listen()); Postgres limits a notification to
+# 8000 bytes, so larger ones just say that everything has changed
+NOTIFY_CHANNEL = "data_changes"
+NOTIFY_MAX_PAYLOAD = 7500
+# how long (in seconds) the listener waits before reconnecting after
+# losing its connection
+LISTEN_RETRY_INTERVAL = 5
+
+# statements that are only read from, and so can be run again under
+# EXPLAIN ANALYZE when they are slow
+READ_ONLY_RE = re.compile(r"^\s*(SELECT|WITH)\b(?!.*\b(INSERT|UPDATE|DELETE|pg_notify)\b)", re.IGNORECASE | re.DOTALL)
+# longest statement and parameters (in characters) kept for a slow query
+SLOW_QUERY_MAX_TEXT = 5000
+
+# for bulk imports: the columns that must be in each CSV file, the
+# condition matching an imported row (s) to an existing one (t) when
+# the file has no row IDs, and the same key as a single value;
+# marriages are matched by the couple, in either order
+IMPORT_KEYS = {
+    "people": (["id"], "t.id = s.id", "s.id"),
+    "marriages": (["pid1", "pid2"],
+        "LEAST(t.pid1, t.pid2) = LEAST(s.pid1, s.pid2) AND GREATEST(t.pid1, t.pid2) = GREATEST(s.pid1, s.pid2)",
+        "LEAST(s.pid1, s.pid2) || ',' || GREATEST(s.pid1, s.pid2)"),
+    "children": (["pid", "cid"], "t.pid = s.pid AND t.cid = s.cid", "s.pid || ',' || s.cid")
+}
+# columns of each table that refer to a person
+IMPORT_REFS = {
+    "people": [],
+    "marriages": ["pid1", "pid2"],
+    "children": ["pid", "cid"]
+}
+# the most problems listed when an import fails
+IMPORT_MAX_ERRORS = 50
+
+
+def place_key(place: str) -> str:
+    """Normalizes a place name for matching, by lowercasing it and
+    collapsing punctuation and spaces, e.g. "Meaford,  Ontario" becomes
+    "meaford ontario". Same as the place_key() function in the
+    database."""
+    return re.sub(r"[^a-z0-9]+", " ", place.lower()).strip()
+
+
+def _year(value: Any) -> Optional[int]:
+    # a year searched for, or None (so the filter is skipped) if it
+    # isn't one that a date can have
+    try:
+        year = int(value)
+    except (TypeError, ValueError):
+        return None
+    if year < MINYEAR or year > MAXYEAR:
+        return None
+    return year
+
+
+class DataImportError(Exception):
+    """Raised by DBConnect.import_data() when the imported files can't
+    be loaded; `errors` lists the problems found."""
+    def __init__(self, errors: List[str]) -> None:
+        super().__init__(f"{len(errors)} problem(s) found in the imported data")
+        self.errors = errors
+
+
+class Record():
+    """Base class for the compact rows returned by the DBConnect read
+    methods and held in memory (e.g., by FamilyGraph): each column is an
+    attribute in `__slots__` rather than a key in a per-row dict, and
+    short, often repeated strings (IDs, names, places, years) are
+    interned, so that every row holding them shares one copy.
+
+    Records can be read like the dicts they replace (`record["id"]`,
+    `record.get()`, `in`, and `dict(record)`), and their columns can be
+    set, but no other keys can be added: use to_dict() for a copy to
+    add fields to, e.g. for a template.
+    """
+    __slots__ = ()
+    COLS: Tuple[str, ...] = ()
+    KEYS: FrozenSet[str] = frozenset()
+    INTERN: FrozenSet[str] = frozenset()
+
+    @classmethod
+    def from_row(cls, row: Sequence[Any]) -> "Record":
+        """Creates a record from a row with a value for each of COLS, in
+        order."""
+        record = cls.__new__(cls)
+        for col, value in zip(cls.COLS, row):
+            if col in cls.INTERN and isinstance(value, str):
+                value = sys.intern(value)
+            setattr(record, col, value)
+        return record
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "Record":
+        return cls.from_row([data.get(col) for col in cls.COLS])
+
+    def __getitem__(self, key: str) -> Any:
+        if key not in self.KEYS:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __setitem__(self, key: str, value: Any) -> None:
+        if key not in self.KEYS:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.KEYS
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.COLS)
+
+    def __len__(self) -> int:
+        return len(self.COLS)
+
+    def __eq__(self, other: Any) -> bool:
+        return type(other) is type(self) and all(getattr(self, c) == getattr(other, c) for c in self.COLS)
+
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}({self.to_dict()!r})"
+
+    def get(self, key: str, default: Any = None) -> Any:
+        if key not in self.KEYS:
+            return default
+        return getattr(self, key)
+
+    def keys(self) -> Tuple[str, ...]:
+        return self.COLS
+
+    def items(self) -> List[Tuple[str, Any]]:
+        return [(col, getattr(self, col)) for col in self.COLS]
+
+    def to_dict(self) -> Dict[str, Any]:
+        return { col: getattr(self, col) for col in self.COLS }
+
+
+class Person(Record):
+    __slots__ = tuple(PERSON_COLS)
+    COLS = tuple(PERSON_COLS)
+    KEYS = frozenset(PERSON_COLS)
+    INTERN = frozenset(PERSON_COLS) - { "additional_notes" }
+
+
+class Marriage(Record):
+    __slots__ = tuple(MARRIAGE_COLS)
+    COLS = tuple(MARRIAGE_COLS)
+    KEYS = frozenset(MARRIAGE_COLS)
+    INTERN = frozenset(MARRIAGE_COLS)
+
+
+class ChildLink(Record):
+    __slots__ = tuple(CHILDREN_COLS)
+    COLS = tuple(CHILDREN_COLS)
+    KEYS = frozenset(CHILDREN_COLS)
+    INTERN = frozenset(CHILDREN_COLS)
+
 
 class DBEntryType(Enum):
     # people must be added to the database first so the foreign keys
@@ -48,6 +243,21 @@ class DBEntry:
         else:
             raise KeyError("Unknown DB entry type")
 
+        # set by DBConnect.run_transaction() to whether the row was
+        # written
+        self.success = None
+
+    def person_ids(self) -> List[str]:
+        """Returns the IDs of the people whose data is changed by this
+        entry, including the people on either side of a relationship."""
+        if self.type is DBEntryType.PERSON:
+            keys = ["id"]
+        elif self.type is DBEntryType.MARRIAGE:
+            keys = ["pid1", "pid2"]
+        else:
+            keys = ["pid", "cid"]
+        return [self.data[k] for k in keys if self.data.get(k) is not None]
+
     def __lt__(self, other: DBEntryType) -> bool:
         # people must be added to the database first so the foreign keys
         # exist; so this relies on the enum value for DBEntryType.PERSON
@@ -55,21 +265,393 @@ class DBEntry:
         return self.type.value < other.type.value
 
 
+# the table and its columns for each type of entry
+ENTRY_COLS = {
+    DBEntryType.PERSON: ("people", PERSON_COLS),
+    DBEntryType.MARRIAGE: ("marriages", MARRIAGE_COLS),
+    DBEntryType.PARENT_CHILD_REL: ("children", CHILDREN_COLS)
+}
+
+# the columns of each type of entry sent in change notifications: the
+# row's ID and the people it links (plus what DBEntry requires)
+NOTIFY_COLS = {
+    DBEntryType.PERSON: ["id", "in_tree"],
+    DBEntryType.MARRIAGE: ["id", "pid1", "pid2"],
+    DBEntryType.PARENT_CHILD_REL: ["id", "pid", "cid"]
+}
+
+
+class TimedCursor(psycopg2.extensions.cursor):
+    """Cursor that reports how long each statement takes to the query
+    hooks of its DBConnect (`db`), labelled with the name of the
+    DBConnect method that ran it, e.g. "get_family". Only statements
+    that succeed are reported, and a failing hook is logged rather
+    than raised, so the caller never sees an error of the hooks'
+    making."""
+    db = None
+
+    def execute(self, query, vars=None):
+        start = time.perf_counter()
+        result = super().execute(query, vars)
+        self._report(start, query, vars)
+        return result
+
+    def copy_expert(self, sql, file, size=8192):
+        start = time.perf_counter()
+        result = super().copy_expert(sql, file, size)
+        self._report(start, sql, None)
+        return result
+
+    def _report(self, start: float, query: Any, vars: Any) -> None:
+        seconds = time.perf_counter() - start
+        if self.db is None:
+            return
+        slow = seconds * 1000 >= self.db.slow_query_ms and len(self.db.slow_query_hooks) > 0
+        if len(self.db.query_hooks) == 0 and not slow:
+            return
+        # the nearest caller in this file, other than the cursor itself
+        # (statements may be run through e.g. psycopg2.extras first)
+        frame = sys._getframe(2)
+        while frame is not None and (frame.f_code.co_filename != __file__
+                or frame.f_code.co_name in ("execute", "copy_expert")):
+            frame = frame.f_back
+        label = frame.f_code.co_name if frame is not None else "unknown"
+        try:
+            for hook in self.db.query_hooks:
+                hook(label, seconds)
+            if slow:
+                self.db._slow_query(self, label, seconds, query, vars)
+        except Exception:
+            logging.getLogger(__name__).exception("Failed to report a query")
+
+
 class DBConnect():
+    """Access to the Postgres database. Connections come from a bounded
+    pool: each thread checks one out the first time it uses `conn` or
+    `cursor`, and must hand it back with release() when it is done
+    (for web requests, this happens at the end of the request)."""
     def __init__(self):
-        self.conn = psycopg2.connect(
+        self.pool_size = int(os.environ.get("POSTGRES_POOL_SIZE", 4))
+        # connections are only opened when needed, and idle ones are
+        # kept for reuse; the semaphore bounds how many can be checked
+        # out at once, making other threads wait for one to be returned
+        self._slots = threading.BoundedSemaphore(self.pool_size)
+        self._idle = []
+        self._idle_lock = threading.Lock()
+        self._local = threading.local()
+
+        # callables that are notified with the list of entries after
+        # run_transaction() commits (or with None after a bulk import).
+        # Change hooks are called in every process listening for
+        # changes, so that each one's in-memory caches of the data can
+        # be invalidated; commit hooks only in the process that made
+        # the change, for work that is done once per change
+        self.change_hooks = []
+        self.commit_hooks = []
+
+        # callables that are given the label and the time taken (in
+        # seconds) of each statement run through `cursor`
+        self.query_hooks = []
+
+        # callables that are given the details of each statement that
+        # takes longer than `slow_query_ms`; a share of those that only
+        # read (`explain_rate`) are run again under EXPLAIN ANALYZE, to
+        # include the plan
+        self.slow_query_hooks = []
+        self.slow_query_ms = float(os.environ.get("APP_SLOW_QUERY_MS") or 250)
+        self.explain_rate = float(os.environ.get("APP_SLOW_QUERY_EXPLAIN_RATE") or 0.1)
+        self._volatile_functions = None
+
+        # the thread listening for changes, and the last change_log ID
+        # when the in-memory caches were built (see mark_changes())
+        self._listener = None
+        self._listener_pid = None
+        self._listener_lock = threading.Lock()
+        self._change_marker = None
+
+        # column types of each table, for casting batched updates
+        self._col_types = {}
+
+    def __del__(self):
+        for conn, _ in self._idle:
+            conn.close()
+
+    def _connect(self) -> psycopg2.extensions.connection:
+        return psycopg2.connect(
             host=os.environ["POSTGRES_HOST"],
             port=os.environ["POSTGRES_PORT"],
             dbname=os.environ["POSTGRES_DB"],
             user=os.environ["POSTGRES_USER"],
             password=os.environ["POSTGRES_PASSWORD"])
-        self.cursor = self.conn.cursor()
 
-    def __del__(self):
-        self.cursor.close()
-        self.conn.close()
+    @property
+    def conn(self) -> psycopg2.extensions.connection:
+        if getattr(self._local, "conn", None) is None:
+            self._open()
+        return self._local.conn
+
+    @property
+    def cursor(self) -> psycopg2.extensions.cursor:
+        if getattr(self._local, "conn", None) is None:
+            self._open()
+        return self._local.cursor
+
+    def _open(self) -> None:
+        if not self._slots.acquire(timeout=30):
+            raise psycopg2.OperationalError("Timed out waiting for a database connection")
+        try:
+            conn = self._checkout()
+        except:
+            self._slots.release()
+            raise
+        self._local.conn = conn
+        self._local.cursor = conn.cursor(cursor_factory=TimedCursor)
+        self._local.cursor.db = self
+
+    def _checkout(self) -> psycopg2.extensions.connection:
+        # idle connections that fail their health check are thrown
+        # away; if there are none left, open a new one
+        while True:
+            with self._idle_lock:
+                if len(self._idle) == 0:
+                    break
+                conn, last_used = self._idle.pop()
+            if self._is_healthy(conn, last_used):
+                return conn
+            conn.close()
+        return self._connect()
+
+    def _is_healthy(self, conn: psycopg2.extensions.connection, last_used: float) -> bool:
+        if conn.closed:
+            return False
+        if time.monotonic() - last_used < HEALTH_CHECK_INTERVAL:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def release(self, error: Optional[BaseException] = None) -> None:
+        """Returns this thread's connection to the pool, if it has one.
+        Any open transaction is rolled back, and if the connection is
+        broken (or `error` is a database error), it is closed rather
+        than reused."""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            return
+        cursor = self._local.cursor
+        self._local.conn = None
+        self._local.cursor = None
+
+        discard = isinstance(error, psycopg2.Error) or conn.closed != 0
+        if not discard:
+            try:
+                cursor.close()
+                if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except psycopg2.Error:
+                discard = True
+
+        if discard:
+            conn.close()
+        else:
+            with self._idle_lock:
+                self._idle.append((conn, time.monotonic()))
+        self._slots.release()
+
+    def disconnect_all(self) -> None:
+        """Closes all idle connections (and this thread's, if it has
+        one checked out), e.g. so that connections opened while
+        starting up the app are not shared with forked worker
+        processes."""
+        self.release()
+        with self._idle_lock:
+            idle, self._idle = self._idle, []
+        for conn, _ in idle:
+            conn.close()
+
+    def add_commit_hook(self, hook: Callable[[Optional[List["DBEntry"]]], None]) -> None:
+        self.commit_hooks.append(hook)
+
+    def add_query_hook(self, hook: Callable[[str, float], None]) -> None:
+        self.query_hooks.append(hook)
+
+    def add_slow_query_hook(self, hook: Callable[[Dict[str, Any]], None]) -> None:
+        self.slow_query_hooks.append(hook)
+
+    def _slow_query(self, cursor: psycopg2.extensions.cursor, label: str, seconds: float, query: Any, vars: Any) -> None:
+        # logs a statement that took longer than slow_query_ms, and
+        # passes it on to the slow query hooks
+        if isinstance(query, sql.Composable):
+            query = query.as_string(cursor)
+        if isinstance(query, bytes):
+            query = query.decode(errors="replace")
+        query = re.sub(r"\s+", " ", str(query)).strip()
+        plan = None
+        if READ_ONLY_RE.match(query) and cursor.query is not None and random.random() < self.explain_rate:
+            plan = self._explain(cursor.connection, cursor.query)
+        logging.getLogger(__name__).warning(f"Slow query in {label}: {seconds * 1000:.0f} ms")
+        entry = {
+            "time": datetime.now().isoformat(timespec="seconds"),
+            "label": label,
+            "ms": round(seconds * 1000, 1),
+            "statement": query[:SLOW_QUERY_MAX_TEXT],
+            "params": repr(vars)[:SLOW_QUERY_MAX_TEXT] if vars is not None else None,
+            "plan": plan
+        }
+        for hook in self.slow_query_hooks:
+            hook(entry)
+
+    def _explain(self, conn: psycopg2.extensions.connection, query: bytes) -> Optional[str]:
+        # runs the statement (with its parameters filled in) again under
+        # EXPLAIN (ANALYZE, BUFFERS), on a separate cursor so the results
+        # the caller is about to fetch are untouched; this is done in a
+        # savepoint that is always rolled back, so that it neither
+        # changes anything nor, if it fails, aborts the transaction.
+        # Statements that call volatile functions (e.g. nextval(), whose
+        # effects a rollback doesn't undo) are only planned, with a
+        # plain EXPLAIN
+        if conn.autocommit or conn.get_transaction_status() == psycopg2.extensions.TRANSACTION_STATUS_INERROR:
+            return None
+        with conn.cursor() as cur:
+            if self._volatile_functions is None:
+                cur.execute("SELECT DISTINCT lower(proname::text) FROM pg_proc WHERE provolatile = 'v'")
+                self._volatile_functions = frozenset(r[0] for r in cur.fetchall())
+            called = set(re.findall(rb"(\w+)\s*\(", query.lower()))
+            volatile = any(f.decode(errors="replace") in self._volatile_functions for f in called)
+            explain = b"EXPLAIN " if volatile else b"EXPLAIN (ANALYZE, BUFFERS) "
+
+            cur.execute("SAVEPOINT explain_slow_query")
+            try:
+                cur.execute(explain + query)
+                plan = "\n".join(r[0] for r in cur.fetchall())
+            except psycopg2.Error as e:
+                plan = f"EXPLAIN failed: {e}"
+            cur.execute("ROLLBACK TO SAVEPOINT explain_slow_query")
+            cur.execute("RELEASE SAVEPOINT explain_slow_query")
+        return plan
+
+    def add_change_hook(self, hook: Callable[[Optional[List["DBEntry"]]], None]) -> None:
+        self.change_hooks.append(hook)
+
+    def _sender(self) -> str:
+        # identifies this process in change notifications
+        return f"{socket.gethostname()}:{os.getpid()}"
+
+    def _notify_changes(self, entries: Optional[List["DBEntry"]]) -> None:
+        # announces the changes to the other processes, as part of the
+        # current transaction, so the notification is only sent if it
+        # commits; only the IDs of the rows (and the people they link)
+        # are sent
+        changes = None
+        if entries is not None:
+            changes = [{
+                "type": e.type.value,
+                "update": e.update,
+                "data": { k: v for k, v in e.data.items() if k in NOTIFY_COLS[e.type] }
+            } for e in entries]
+        payload = json.dumps({ "sender": self._sender(), "entries": changes }, default=str)
+        if len(payload.encode()) > NOTIFY_MAX_PAYLOAD:
+            payload = json.dumps({ "sender": self._sender(), "entries": None })
+        self.cursor.execute("SELECT pg_notify(%s, %s)", (NOTIFY_CHANNEL, payload))
+
+    def _changed(self, entries: Optional[List["DBEntry"]]) -> None:
+        # runs the hooks for a change committed by this process
+        for hook in self.change_hooks + self.commit_hooks:
+            hook(entries)
 
-    def get_person(self, pid: str) -> Dict[str, Any]:
+    def mark_changes(self) -> None:
+        """Records how far the change log has got, before building any
+        in-memory caches of the data while starting up. A worker can
+        be forked from those caches long afterwards (e.g. by uWSGI's
+        cheaper mode, or on a respawn), so when its listener starts, it
+        runs the change hooks if anything has changed since."""
+        self._change_marker = self._last_change(self.cursor)
+
+    def _last_change(self, cursor: psycopg2.extensions.cursor) -> int:
+        cursor.execute("SELECT COALESCE(MAX(id), 0) FROM change_log")
+        return cursor.fetchone()[0]
+
+    def listen(self) -> None:
+        """Starts a background thread (once per process) that listens
+        for changes committed by other processes, and runs the change
+        hooks for each one. Does nothing if there are no change hooks.
+        Since threads don't survive a fork, this is called at the start
+        of each request rather than while starting up."""
+        if len(self.change_hooks) == 0 or self._listener_pid == os.getpid():
+            return
+        with self._listener_lock:
+            if self._listener_pid == os.getpid():
+                return
+            self._listener_pid = os.getpid()
+            self._listener = threading.Thread(target=self._listen, daemon=True)
+            self._listener.start()
+
+    def _listen(self) -> None:
+        # uses its own connection, outside of the pool, as it stays
+        # open for as long as the process runs
+        connected_before = False
+        while True:
+            conn = None
+            try:
+                conn = self._connect()
+                conn.autocommit = True
+                with conn.cursor() as cur:
+                    cur.execute(f"LISTEN {NOTIFY_CHANNEL}")
+                if connected_before:
+                    # anything may have changed while disconnected
+                    self._run_change_hooks(None)
+                elif self._change_marker is not None:
+                    # or, the first time, since the caches were built
+                    with conn.cursor() as cur:
+                        if self._last_change(cur) != self._change_marker:
+                            self._run_change_hooks(None)
+                connected_before = True
+                while True:
+                    if select.select([conn], [], [], HEALTH_CHECK_INTERVAL) == ([], [], []):
+                        with conn.cursor() as cur:
+                            cur.execute("SELECT 1")
+                        continue
+                    conn.poll()
+                    while len(conn.notifies) > 0:
+                        self._received(conn.notifies.pop(0).payload)
+            except (psycopg2.Error, OSError):
+                logging.getLogger(__name__).exception("Lost the connection listening for changes")
+            finally:
+                if conn is not None:
+                    conn.close()
+            time.sleep(LISTEN_RETRY_INTERVAL)
+
+    def _received(self, payload: str) -> None:
+        # runs the change hooks for a notification, unless it came from
+        # this process (which has already run them)
+        try:
+            message = json.loads(payload)
+            if message["sender"] == self._sender():
+                return
+            entries = None
+            if message["entries"] is not None:
+                entries = [DBEntry(e["data"], DBEntryType(e["type"]), e["update"])
+                    for e in message["entries"]]
+        except (ValueError, KeyError, TypeError):
+            logging.getLogger(__name__).exception("Invalid change notification")
+            return
+        self._run_change_hooks(entries)
+
+    def _run_change_hooks(self, entries: Optional[List["DBEntry"]]) -> None:
+        try:
+            for hook in self.change_hooks:
+                hook(entries)
+        except Exception:
+            logging.getLogger(__name__).exception("Failed to apply a change notification")
+        finally:
+            # the hooks may have used a connection from the pool
+            self.release()
+
+    def get_person(self, pid: str) -> Optional[Person]:
         self.cursor.execute("""
             SELECT
                 id, print_id, in_tree, first_name, nickname,
@@ -82,7 +664,7 @@ class DBConnect():
         p = self.cursor.fetchone()
         if p is None:
             return None
-        return { k: v for k, v in zip(PERSON_COLS, p) }
+        return Person.from_row(p)
 
     def get_parents(self, pid: str) -> List[Dict[str, Any]]:
         self.cursor.execute("""
@@ -102,8 +684,10 @@ class DBConnect():
             out.append({ k: v for k, v in zip(PERSON_COLS + ["adoptive", "row_id"], pr) })
         return out
 
-    def get_children(self, pid1: str, pid2: str) -> List[Dict[str, Any]]:
-        # logic from https://stackoverflow.com/questions/15537892/postgresql-select-must-match-across-multiple-rows
+    def get_children(self, pid1: str, pid2: str) -> List[Person]:
+        # self-join on the children table, restricted to the rows for the
+        # two parents, so the cost depends only on how many children
+        # they have (using the children(pid) index)
         self.cursor.execute("""
             SELECT
                 p.id, p.print_id, p.in_tree, p.first_name, p.nickname,
@@ -114,26 +698,14 @@ class DBConnect():
             FROM (
                 SELECT DISTINCT a.cid, a.birth_order
                 FROM children a
-                INNER JOIN
-                (
-                    SELECT
-                        cid,
-                        SUM((pid = %s)::integer + (pid = %s)::integer) AS match
-                    FROM children
-                    GROUP BY cid
-                ) b ON a.cid = b.cid
-                WHERE match >= 2
+                INNER JOIN children b ON a.cid = b.cid
+                WHERE a.pid = %s AND b.pid = %s
             ) c
             LEFT JOIN people p on c.cid = p.id
             ORDER BY c.birth_order""", (pid1, pid2))
-        children = self.cursor.fetchall()
+        return [Person.from_row(c) for c in self.cursor.fetchall()]
 
-        out = []
-        for c in children:
-            out.append({ k: v for k, v in zip(PERSON_COLS + ["adoptive"], c) })
-        return out
-
-    def get_marriages(self, pid: str) -> List[Dict[str, Any]]:
+    def get_marriages(self, pid: str) -> List[Dict[str, Record]]:
         self.cursor.execute(f"""
             (SELECT
                 p.id, p.print_id, p.in_tree, p.first_name, p.nickname,
@@ -167,126 +739,497 @@ class DBConnect():
 
         out = []
         for s in spouses:
-            spouse = { k: v for k, v in zip(PERSON_COLS, s[:len(PERSON_COLS)]) }
-            marriage = { k: v for k, v in zip(MARRIAGE_COLS, s[len(PERSON_COLS):]) }
+            spouse = Person.from_row(s[:len(PERSON_COLS)])
+            marriage = Marriage.from_row(s[len(PERSON_COLS):])
             out.append({ "marriage": marriage, "spouse": spouse })
         return out
     
+    def get_family(self, pid: str) -> Optional[Dict[str, Any]]:
+        # fetches the focal person along with their parents, siblings,
+        # and marriages (with the spouse and the children of each
+        # marriage) in a single round trip, as JSON aggregates
+        self.cursor.execute("""
+            WITH parent_rows AS (
+                SELECT id, pid, adoptive
+                FROM children
+                WHERE cid = %(pid)s
+            ),
+            sibling_rows AS (
+                SELECT
+                    cid,
+                    array_agg(DISTINCT pid) AS parent_ids,
+                    MIN(birth_order) AS birth_order
+                FROM children
+                WHERE pid IN (SELECT pid FROM parent_rows)
+                GROUP BY cid
+            )
+            SELECT
+                (SELECT row_to_json(p) FROM people p WHERE p.id = %(pid)s),
+                (SELECT COALESCE(json_agg(json_build_object(
+                        'person', row_to_json(p),
+                        'adoptive', pr.adoptive,
+                        'row_id', pr.id) ORDER BY pr.id), '[]')
+                    FROM parent_rows pr
+                    INNER JOIN people p ON pr.pid = p.id),
+                (SELECT COALESCE(json_agg(json_build_object(
+                        'person', row_to_json(p),
+                        'parent_ids', s.parent_ids,
+                        'birth_order', s.birth_order) ORDER BY s.birth_order), '[]')
+                    FROM sibling_rows s
+                    INNER JOIN people p ON s.cid = p.id),
+                (SELECT COALESCE(json_agg(json_build_object(
+                        'marriage', row_to_json(m),
+                        'spouse', row_to_json(sp),
+                        'children', (
+                            SELECT COALESCE(json_agg(row_to_json(cp) ORDER BY c.birth_order), '[]')
+                            FROM (
+                                SELECT DISTINCT a.cid, a.birth_order
+                                FROM children a
+                                INNER JOIN children b ON a.cid = b.cid
+                                WHERE a.pid = %(pid)s AND b.pid = sp.id
+                            ) c
+                            INNER JOIN people cp ON c.cid = cp.id)
+                        ) ORDER BY m.marriage_order), '[]')
+                    FROM marriages m
+                    INNER JOIN people sp
+                        ON sp.id = CASE WHEN m.pid1 = %(pid)s THEN m.pid2 ELSE m.pid1 END
+                    WHERE m.pid1 = %(pid)s OR m.pid2 = %(pid)s)""", { "pid": pid })
+        focal, parents, siblings, marriages = self.cursor.fetchone()
+        if focal is None:
+            return None
+
+        # row_to_json() returns every column of the table, so keep just
+        # the ones the rest of the app expects
+        def person(p):
+            return { k: p.get(k) for k in PERSON_COLS }
+
+        out = { "focal": person(focal), "parents": [], "siblings": [], "marriages": [] }
+        for pr in parents:
+            parent = person(pr["person"])
+            parent["adoptive"] = pr["adoptive"]
+            parent["row_id"] = pr["row_id"]
+            out["parents"].append(parent)
+        for sib in siblings:
+            out["siblings"].append({
+                "person": person(sib["person"]),
+                "parent_ids": sib["parent_ids"],
+                "birth_order": sib["birth_order"]
+            })
+        for m in marriages:
+            out["marriages"].append({
+                "marriage": { k: m["marriage"].get(k) for k in MARRIAGE_COLS },
+                "spouse": person(m["spouse"]),
+                "children": [person(c) for c in m["children"]]
+            })
+        return out
+
+    def get_lineage(self, pid: str, direction: str, depth: int, max_nodes: int) -> Optional[Dict[str, Any]]:
+        # fetches everyone up to `depth` generations above (direction
+        # "ancestors") or below ("descendants") the person, with the
+        # parent-child and marriage rows between them (including the
+        # parent-child rows of spouses who married in), in a single
+        # round trip, using the ancestry table; the nearest `max_nodes`
+        # people are kept, and "truncated" says if anyone was left out
+        if direction == "ancestors":
+            step, follow = "descendant", "ancestor"
+        elif direction == "descendants":
+            step, follow = "ancestor", "descendant"
+        else:
+            raise ValueError
+        self.cursor.execute(f"""
+            WITH all_nodes AS (
+                SELECT id, 0 AS depth FROM people WHERE id = %(pid)s
+                UNION ALL
+                SELECT {follow}_id, depth
+                FROM ancestry
+                WHERE {step}_id = %(pid)s
+                    AND depth <= %(depth)s
+            ),
+            nodes AS (
+                SELECT id, depth
+                FROM all_nodes
+                ORDER BY depth, id
+                LIMIT %(max_nodes)s
+            ),
+            marriage_rows AS (
+                SELECT m.*
+                FROM marriages m
+                WHERE m.pid1 IN (SELECT id FROM nodes)
+                    {"AND" if direction == "ancestors" else "OR"} m.pid2 IN (SELECT id FROM nodes)
+            )
+            SELECT
+                (SELECT json_object_agg(id, depth) FROM nodes),
+                (SELECT COALESCE(json_agg(row_to_json(p)), '[]')
+                    FROM people p
+                    WHERE p.id IN (SELECT id FROM nodes)
+                        OR p.id IN (SELECT pid1 FROM marriage_rows)
+                        OR p.id IN (SELECT pid2 FROM marriage_rows)),
+                (SELECT COALESCE(json_agg(row_to_json(c) ORDER BY c.id), '[]')
+                    FROM children c
+                    WHERE c.cid IN (SELECT id FROM nodes)
+                        AND (c.pid IN (SELECT id FROM nodes)
+                            OR c.pid IN (SELECT pid1 FROM marriage_rows)
+                            OR c.pid IN (SELECT pid2 FROM marriage_rows))),
+                (SELECT COALESCE(json_agg(row_to_json(m) ORDER BY m.marriage_order, m.id), '[]')
+                    FROM marriage_rows m),
+                (SELECT count(*) FROM all_nodes) > %(max_nodes)s""",
+            { "pid": pid, "depth": depth, "max_nodes": max_nodes })
+        depths, people, children, marriages, truncated = self.cursor.fetchone()
+        if depths is None:
+            return None
+        return {
+            "depths": depths,
+            "people": { p["id"]: { k: p.get(k) for k in PERSON_COLS } for p in people },
+            "children": [{ k: c.get(k) for k in CHILDREN_COLS } for c in children],
+            "marriages": [{ k: m.get(k) for k in MARRIAGE_COLS } for m in marriages],
+            "truncated": truncated
+        }
+
+    def get_lineage_counts(self, pid: str) -> Dict[str, int]:
+        # the number of the person's ancestors and descendants, and
+        # their generation (how many generations they are below their
+        # furthest known ancestor), from the ancestry table
+        self.cursor.execute("""
+            SELECT
+                (SELECT count(*) FROM ancestry WHERE descendant_id = %(pid)s),
+                (SELECT count(*) FROM ancestry WHERE ancestor_id = %(pid)s),
+                (SELECT COALESCE(MAX(depth), 0) FROM ancestry WHERE descendant_id = %(pid)s)""",
+            { "pid": pid })
+        ancestors, descendants, generation = self.cursor.fetchone()
+        return { "ancestors": ancestors, "descendants": descendants, "generation": generation }
+
+    def get_all_people(self) -> List[Person]:
+        self.cursor.execute("""
+            SELECT
+                id, print_id, in_tree, first_name, nickname,
+                middle_name1, middle_name2, last_name, pref_name,
+                gender, birth_month, birth_day, birth_year, birth_place,
+                death_month, death_day, death_year, death_place, buried,
+                additional_notes
+            FROM people""")
+        return [Person.from_row(p) for p in self.cursor.fetchall()]
+
+    def get_all_marriages(self) -> List[Marriage]:
+        self.cursor.execute("""
+            SELECT
+                id, pid1, pid2, marriage_order, married_month,
+                married_day, married_year, married_place, common_law,
+                divorced, divorced_month, divorced_day, divorced_year
+            FROM marriages""")
+        return [Marriage.from_row(m) for m in self.cursor.fetchall()]
+
+    def get_all_children(self) -> List[ChildLink]:
+        self.cursor.execute("""
+            SELECT id, pid, cid, birth_order, adoptive
+            FROM children""")
+        return [ChildLink.from_row(c) for c in self.cursor.fetchall()]
+
+    def get_snapshot_rows(self, table: str) -> Tuple[List[str], List[Tuple]]:
+        # every row of the table, for the read-only snapshot (see
+        # snapshot.py), along with the columns and the values the
+        # searches here match on: everyone's names, the place keys, and
+        # the date ranges, as their first and last possible days (with
+        # far-off dates for open ends); these are worked out here so
+        # that the snapshot matches the same way
+        def bounds(col: str) -> List[str]:
+            return [
+                f"""CASE WHEN {col} IS NULL OR isempty({col}) THEN NULL
+                    WHEN lower_inf({col}) THEN '0001-01-01'
+                    ELSE to_char(lower({col}), 'YYYY-MM-DD') END""",
+                f"""CASE WHEN {col} IS NULL OR isempty({col}) THEN NULL
+                    WHEN upper_inf({col}) THEN '9999-12-31'
+                    ELSE to_char(upper({col}) - 1, 'YYYY-MM-DD') END"""
+            ]
+
+        if table == "people":
+            cols = PERSON_COLS + ["names", "birth_place_key", "death_place_key",
+                "birth_from", "birth_to", "death_from", "death_to", "birth_decade"]
+            exprs = PERSON_COLS + [NAMES_EXPR, "place_key(birth_place)", "place_key(death_place)"] \
+                + bounds("birth_range") + bounds("death_range") + [BIRTH_DECADE_EXPR]
+        elif table == "marriages":
+            cols = MARRIAGE_COLS + ["married_from", "married_to"]
+            exprs = MARRIAGE_COLS + bounds("married_range")
+        elif table == "children":
+            cols = exprs = CHILDREN_COLS
+        elif table == "ancestry":
+            cols = exprs = ["ancestor_id", "descendant_id", "depth"]
+        else:
+            raise ValueError
+        self.cursor.execute(f"SELECT {', '.join(exprs)} FROM {table}")
+        return cols, self.cursor.fetchall()
+
     def search_name(self, search_terms: List[str]) -> List[Dict[str, Any]]:
-        # case insensitive matching for each term in the query
-        match_stmts = ["(first_name ILIKE %s OR nickname ILIKE %s OR middle_name1 ILIKE %s OR middle_name2 ILIKE %s OR last_name ILIKE %s)"] * len(search_terms)
-        match_stmt = " AND ".join(match_stmts)
+        # case insensitive substring matching for each term in the query,
+        # against all of a person's names at once; this matches the
+        # expression in the trigram index on people, so it can be used
+        # (for terms of 3+ characters)
+        match_stmt = " AND ".join([f"{NAMES_EXPR} LIKE %s"] * len(search_terms))
         if len(match_stmt) == 0:
             return []
 
-        # repeat each term 5 times, once for each column to match on
-        terms = [f"%{t}%" for t in search_terms for i in range(5)]
+        # rank results by how closely each term matches a whole word in
+        # the person's names, so e.g. "will" ranks a Will above a William
+        rank_stmt = " + ".join([f"word_similarity(%s, {NAMES_EXPR})"] * len(search_terms))
+
+        terms = [t.lower() for t in search_terms]
         self.cursor.execute(f"""
             SELECT
                 id, print_id, in_tree, first_name, nickname,
                 middle_name1, middle_name2, last_name, pref_name,
                 gender, birth_month, birth_day, birth_year, birth_place,
                 death_month, death_day, death_year, death_place, buried,
-                additional_notes
+                additional_notes, {rank_stmt} AS rank
             FROM people
-            WHERE {match_stmt}""", terms)
+            WHERE {match_stmt}
+            ORDER BY rank DESC""", terms + [f"%{t}%" for t in terms])
         results = self.cursor.fetchall()
 
         out = []
         for p in results:
-            out.append({ k: v for k, v in zip(PERSON_COLS, p) })
+            out.append({ k: v for k, v in zip(PERSON_COLS + ["rank"], p) })
         return out
 
-    def search_advanced(self, search_terms: Dict[str, Any]) -> List[Dict[str, Any]]:
-        term_contains = ["first_name", "nickname", "last_name", "birth_place", "buried", "death_place", "additional_notes"]
-        term_exact = ["birth_day", "birth_month", "birth_year", "death_day", "death_month", "death_year"]
+    def search_advanced(self, search_terms: Dict[str, Any]) -> Tuple[List[Dict[str, Any]], Dict[str, List[Dict[str, Any]]]]:
+        # each filter is written so that it can use an index: name terms
+        # are also checked against the trigram index on all names,
+        # places are matched on their normalized keys, and years and
+        # year ranges on the normalized date ranges
+        term_names = ["first_name", "nickname", "last_name"]
+        term_places = ["birth_place", "death_place"]
+        term_contains = ["buried", "additional_notes"]
+        term_exact = ["birth_day", "birth_month", "death_day", "death_month"]
+        term_years = { "birth_year": "birth_range", "death_year": "death_range" }
+        term_ranges = { "born": "birth_range", "died": "death_range" }
 
         match_stmts = []
         terms = []
         for col, term in search_terms.items():
             if term != "":
                 if col == "middle_name":
-                    match_stmts.append("(middle_name1 ILIKE %s OR middle_name2 ILIKE %s)")
-                    terms.append(f"%{term}%")
-                    terms.append(f"%{term}%")
+                    match_stmts.append(f"(middle_name1 ILIKE %s OR middle_name2 ILIKE %s) AND {NAMES_EXPR} LIKE %s")
+                    terms += [f"%{term}%", f"%{term}%", f"%{term.lower()}%"]
+                elif col in term_names:
+                    match_stmts.append(f"{col} ILIKE %s AND {NAMES_EXPR} LIKE %s")
+                    terms += [f"%{term}%", f"%{term.lower()}%"]
+                elif col in term_places:
+                    match_stmts.append(f"place_key({col}) LIKE %s")
+                    terms.append(f"%{place_key(term)}%")
+                elif col in (f"{c}_key" for c in term_places):
+                    match_stmts.append(f"place_key({col[:-4]}) = %s")
+                    terms.append(term)
                 elif col in term_contains:
                     match_stmts.append(f"{col} ILIKE %s")
                     terms.append(f"%{term}%")
                 elif col in term_exact:
                     match_stmts.append(f"{col} = %s")
                     terms.append(term)
+                elif col in term_years:
+                    if _year(term) is not None:
+                        match_stmts.append(f"{term_years[col]} && daterange(%s, %s, '[]')")
+                        terms += [date(_year(term), 1, 1), date(_year(term), 12, 31)]
+                    else:
+                        match_stmts.append(f"{col} = %s")
+                        terms.append(term)
+                elif col == "birth_decade" and _year(term) is not None:
+                    # the same rule as the facets; the overlap with the
+                    # decade is implied, and lets the index be used
+                    decade = _year(term)
+                    match_stmts.append(f"birth_range && daterange(%s, %s, '[]') AND {BIRTH_DECADE_EXPR} = %s")
+                    terms += [date(decade, 1, 1), date(min(decade + 9, MAXYEAR), 12, 31), decade]
+
+        # ranges given as "<prefix>_from" and/or "<prefix>_to" years
+        ranges = dict(term_ranges, married="married_range")
+        for prefix, range_col in ranges.items():
+            year_from = _year(search_terms.get(f"{prefix}_from"))
+            year_to = _year(search_terms.get(f"{prefix}_to"))
+            if year_from is None and year_to is None:
+                continue
+            bounds = [
+                date(year_from, 1, 1) if year_from is not None else None,
+                date(year_to, 12, 31) if year_to is not None else None
+            ]
+            if prefix == "married":
+                match_stmts.append("""id IN (
+                    SELECT pid1 FROM marriages WHERE married_range && daterange(%s, %s, '[]')
+                    UNION
+                    SELECT pid2 FROM marriages WHERE married_range && daterange(%s, %s, '[]'))""")
+                terms += bounds + bounds
+            else:
+                match_stmts.append(f"{range_col} && daterange(%s, %s, '[]')")
+                terms += bounds
+
         match_stmt = " AND ".join(match_stmts)
         if len(match_stmt) == 0:
-            return []
+            return [], {}
 
+        # facet counts are computed over the same results, in the same
+        # query: by decade of birth (see BIRTH_DECADE_EXPR), and by
+        # normalized birthplace
         self.cursor.execute(f"""
+            WITH results AS (
+                SELECT
+                    id, print_id, in_tree, first_name, nickname,
+                    middle_name1, middle_name2, last_name, pref_name,
+                    gender, birth_month, birth_day, birth_year, birth_place,
+                    death_month, death_day, death_year, death_place, buried,
+                    additional_notes, birth_range
+                FROM people
+                WHERE {match_stmt}
+            )
             SELECT
-                id, print_id, in_tree, first_name, nickname,
-                middle_name1, middle_name2, last_name, pref_name,
-                gender, birth_month, birth_day, birth_year, birth_place,
-                death_month, death_day, death_year, death_place, buried,
-                additional_notes
-            FROM people
-            WHERE {match_stmt}""", terms)
-        results = self.cursor.fetchall()
+                (SELECT COALESCE(json_agg(row_to_json(r)), '[]') FROM results r),
+                (SELECT COALESCE(json_agg(json_build_object(
+                        'decade', decade, 'count', n) ORDER BY decade), '[]')
+                    FROM (
+                        SELECT {BIRTH_DECADE_EXPR} AS decade, COUNT(*) AS n
+                        FROM results
+                        WHERE {BIRTH_DECADE_EXPR} IS NOT NULL
+                        GROUP BY 1
+                    ) d),
+                (SELECT COALESCE(json_agg(json_build_object(
+                        'key', key, 'place', place, 'count', n) ORDER BY n DESC, key), '[]')
+                    FROM (
+                        SELECT place_key(birth_place) AS key, MIN(birth_place) AS place, COUNT(*) AS n
+                        FROM results
+                        WHERE place_key(birth_place) <> ''
+                        GROUP BY 1
+                        ORDER BY n DESC, key
+                        LIMIT 15
+                    ) b)""", terms)
+        results, decades, birth_places = self.cursor.fetchone()
 
-        out = []
-        for p in results:
-            out.append({ k: v for k, v in zip(PERSON_COLS, p) })
-        return out
+        out = [{ k: r.get(k) for k in PERSON_COLS } for r in results]
+        return out, { "decades": decades, "birth_places": birth_places }
 
     def run_transaction(self, data: List[DBEntry]) -> bool:
-        query_map = {
-            DBEntryType.PERSON: self.add_person,
-            DBEntryType.PARENT_CHILD_REL: self.add_child_relationship,
-            DBEntryType.MARRIAGE: self.add_marriage
-        }
+        # runs the entries in one transaction, committing only if every
+        # one succeeds. Entries of the same type and operation that set
+        # the same columns are written together, with one statement per
+        # batch rather than per entry; people go first so the foreign
+        # keys exist. Each entry's `success` is set to whether its row
+        # was written (or left as None if an earlier batch failed).
+        batches = {}
+        rows_seen = {}
+        for entry in sorted(data):
+            cols = tuple(c for c in ENTRY_COLS[entry.type][1] if c in entry.data)
+            seq = 0
+            if "id" in entry.data:
+                # each entry for a row goes in a later round of batches
+                # than the one before it, so that the row's entries are
+                # written in order (and a statement only writes each row
+                # once)
+                row_key = (entry.type, str(entry.data["id"]))
+                seq = rows_seen.get(row_key, 0)
+                rows_seen[row_key] = seq + 1
+            batches.setdefault((entry.type, entry.update, cols, seq), []).append(entry)
 
-        # sort queries so that People are added before other queries, and
-        # foreign keys exist
-        queries = sorted(data)
+        # by type, then round, keeping the order the batches were found
+        # in within each round
+        order = sorted(batches, key=lambda k: (k[0].value, k[3]))
 
         all_success = True
-        for entry in queries:
-            result = query_map[entry.type](entry.data, entry.update)
-            if not result:
+        for key in order:
+            entry_type, update, _, _ = key
+            entries = batches[key]
+            results = self._write_rows(entry_type, [e.data for e in entries], update)
+            for entry, success in zip(entries, results):
+                entry.success = success
+            if not all(results):
                 all_success = False
                 break
 
         if all_success:
+            self._notify_changes(data)
             self.commit_transaction()
+            self._changed(sorted(data))
         else:
             self.rollback_transaction()
         return all_success
 
+    def _column_types(self, table: str) -> Dict[str, str]:
+        # the SQL type of each column in the table, looked up once
+        if table not in self._col_types:
+            self.cursor.execute("""
+                SELECT attname::text, format_type(atttypid, atttypmod)
+                FROM pg_attribute
+                WHERE attrelid = %s::regclass
+                    AND attnum > 0
+                    AND NOT attisdropped""", (table,))
+            self._col_types[table] = dict(self.cursor.fetchall())
+        return self._col_types[table]
+
+    def _write_rows(self, entry_type: DBEntryType, rows: List[Dict[str, Any]], update: bool) -> List[bool]:
+        # inserts or updates (by ID) rows of one type that all set the
+        # same columns, as a single multi-row statement that also logs
+        # the changes; returns whether each row was written
+        table, table_cols = ENTRY_COLS[entry_type]
+        cols = [c for c in table_cols if c in rows[0]]
+        returning = "id, cid" if table == "children" else "id"
+        action = "update" if update else "insert"
+
+        if update:
+            ids = [r["id"] for r in rows]
+            set_cols = [c for c in cols if c != "id"]
+            types = self._column_types(table)
+            if table == "children":
+                # the rows' old children, whose ancestors may change
+                self.cursor.execute(f"SELECT cid FROM children WHERE id = ANY(%s::{types['id']}[])", (ids,))
+                old_cids = [r[0] for r in self.cursor.fetchall()]
+
+            # values in a VALUES list don't take their types from the
+            # table being updated, so they are cast explicitly
+            written = psycopg2.extras.execute_values(self.cursor, f"""
+                WITH written AS (
+                    UPDATE {table} t
+                    SET {", ".join(f"{c} = v.{c}" for c in set_cols)}
+                    FROM (VALUES %s) AS v (id, {", ".join(set_cols)})
+                    WHERE t.id = v.id
+                    RETURNING t.{returning.replace(", ", ", t.")}
+                ), logged AS (
+                    INSERT INTO change_log (table_name, row_id, action)
+                    SELECT '{table}', id::text, '{action}'
+                    FROM written
+                )
+                SELECT {returning} FROM written""",
+                [[r["id"]] + [r[c] for c in set_cols] for r in rows],
+                template="(" + ", ".join(f"%s::{types[c]}" for c in ["id"] + set_cols) + ")",
+                fetch=True)
+            written_ids = { str(w[0]) for w in written }
+            results = [str(i) in written_ids for i in ids]
+        else:
+            written = psycopg2.extras.execute_values(self.cursor, f"""
+                WITH written AS (
+                    INSERT INTO {table} ({", ".join(cols)})
+                    VALUES %s
+                    RETURNING {returning}
+                ), logged AS (
+                    INSERT INTO change_log (table_name, row_id, action)
+                    SELECT '{table}', id::text, '{action}'
+                    FROM written
+                )
+                SELECT {returning} FROM written""",
+                [[r[c] for c in cols] for r in rows],
+                fetch=True)
+            results = [len(written) == len(rows)] * len(rows)
+
+        if table == "children" and len(written) > 0:
+            if update:
+                self.rebuild_ancestry(list(set(old_cids) | { w[1] for w in written }))
+            elif len(written) == 1:
+                self._add_ancestry(rows[0]["pid"], rows[0]["cid"])
+            else:
+                # the new links may build on each other (e.g., a parent
+                # and a grandparent), so recompute rather than adding
+                # them one at a time
+                self.rebuild_ancestry(list({ w[1] for w in written }))
+        return results
+
     def add_person(self, person: Dict[str, Any], update: bool) -> bool:
         if "id" not in person:
             raise KeyError("No 'id' value for Person: Cannot insert into database.")
         if "in_tree" not in person:
             raise KeyError("No 'in_tree' value for Person: Cannot insert null value in database.")
-
-        if update:
-            cols = [k for k in person.keys() if k in PERSON_COLS and k != "id"]
-            blanks_list = ", ".join([f"{k} = %s" for k in cols])
-            val_list = [person[k] for k in cols] + [person["id"]]
-            self.cursor.execute(f"""
-                UPDATE people
-                SET {blanks_list}
-                WHERE id = %s""", val_list)
-            msg = self.cursor.statusmessage.split(" ")
-            status = msg[0] == "UPDATE" and msg[1] == "1"
-        else:
-            cols = [k for k in person.keys() if k in PERSON_COLS]
-            col_list = ", ".join(cols)
-            blanks_list = ", ".join(["%s"] * len(cols))
-            val_list = [person[k] for k in cols]
-            self.cursor.execute(f"""
-                INSERT INTO people ({col_list})
-                VALUES
-                ({blanks_list})""", val_list)
-            msg = self.cursor.statusmessage.split(" ")
-            status = msg[0] == "INSERT" and msg[2] == "1"
-        return status
+        return self._write_rows(DBEntryType.PERSON, [person], update)[0]
 
     def add_child_relationship(self, relationship: Dict[str, Any], update: bool) -> bool:
         if "pid" not in relationship:
@@ -295,81 +1238,339 @@ class DBConnect():
             raise KeyError("No 'cid' value for Child Relationship: Cannot insert into database.")
         if update and "id" not in relationship:
             raise KeyError("No 'id' value for Child Relationship: Cannot update entry in database.")
+        return self._write_rows(DBEntryType.PARENT_CHILD_REL, [relationship], update)[0]
 
-        if update:
-            cols = [k for k in relationship.keys() if k in CHILDREN_COLS and k != "id"]
-            blanks_list = ", ".join([f"{k} = %s" for k in cols])
-            val_list = [relationship[k] for k in cols] + [relationship["id"]]
-            self.cursor.execute(f"""
-                UPDATE children
-                SET {blanks_list}
-                WHERE id = %s""", val_list)
-            msg = self.cursor.statusmessage.split(" ")
-            status = msg[0] == "UPDATE" and msg[1] == "1"
-        else:
-            cols = [k for k in relationship.keys() if k in CHILDREN_COLS]
-            col_list = ", ".join(cols)
-            blanks_list = ", ".join(["%s"] * len(cols))
-            val_list = [relationship[k] for k in cols]
-            self.cursor.execute(f"""
-                INSERT INTO children ({col_list})
-                VALUES
-                ({blanks_list})""", val_list)
-            msg = self.cursor.statusmessage.split(" ")
-            status = msg[0] == "INSERT" and msg[2] == "1"
-        return status
-
-    def add_marriage(self, marriage: Dict[str, Any], update: bool) -> None:
+    def add_marriage(self, marriage: Dict[str, Any], update: bool) -> bool:
         if "pid1" not in marriage or "pid2" not in marriage:
             raise KeyError("Must have both 'pid1' and 'pid2' values for Marriage: Cannot insert into database.")
         if update and "id" not in marriage:
             raise KeyError("No 'id' value for Marriage: Cannot update entry in database.")
+        return self._write_rows(DBEntryType.MARRIAGE, [marriage], update)[0]
 
-        if update:
-            cols = [k for k in marriage.keys() if k in MARRIAGE_COLS and k != "id"]
-            blanks_list = ", ".join([f"{k} = %s" for k in cols])
-            val_list = [marriage[k] for k in cols] + [marriage["id"]]
-            self.cursor.execute(f"""
-                UPDATE marriages
-                SET {blanks_list}
-                WHERE id = %s""", val_list)
-            msg = self.cursor.statusmessage.split(" ")
-            status = msg[0] == "UPDATE" and msg[1] == "1"
+    def _add_ancestry(self, pid: str, cid: str) -> None:
+        # a new parent-child link makes the parent and all of their
+        # ancestors into ancestors of the child and all of their
+        # descendants
+        self.cursor.execute("""
+            INSERT INTO ancestry (ancestor_id, descendant_id, depth)
+            SELECT a.id, d.id, MIN(a.depth + d.depth + 1)
+            FROM (
+                SELECT ancestor_id AS id, depth FROM ancestry WHERE descendant_id = %(pid)s
+                UNION ALL
+                SELECT %(pid)s, 0
+            ) a
+            CROSS JOIN (
+                SELECT descendant_id AS id, depth FROM ancestry WHERE ancestor_id = %(cid)s
+                UNION ALL
+                SELECT %(cid)s, 0
+            ) d
+            WHERE a.id <> d.id
+            GROUP BY a.id, d.id
+            ON CONFLICT (ancestor_id, descendant_id)
+            DO UPDATE SET depth = LEAST(ancestry.depth, EXCLUDED.depth)""",
+            { "pid": pid, "cid": cid })
+
+    def rebuild_ancestry(self, pids: Optional[List[str]] = None) -> None:
+        # recomputes the ancestors of the given people and all of their
+        # descendants (whose ancestors are the only ones that can change
+        # when the people's parents change), or of everyone if no
+        # people are given; this does not commit
+        if pids is None:
+            self.cursor.execute("DELETE FROM ancestry")
+            seed = "SELECT cid, pid, 1 FROM children WHERE pid <> cid"
+            params = { "max_depth": ANCESTRY_MAX_DEPTH }
         else:
-            cols = [k for k in marriage.keys() if k in MARRIAGE_COLS]
-            col_list = ", ".join(cols)
-            blanks_list = ", ".join(["%s"] * len(cols))
-            val_list = [marriage[k] for k in cols]
-            self.cursor.execute(f"""
-                INSERT INTO marriages ({col_list})
-                VALUES
-                ({blanks_list})""", val_list)
-            msg = self.cursor.statusmessage.split(" ")
-            status = msg[0] == "INSERT" and msg[2] == "1"
-        return status
+            self.cursor.execute("""
+                SELECT descendant_id
+                FROM ancestry
+                WHERE ancestor_id = ANY(%s)""", (pids,))
+            affected = list(set(pids) | { r[0] for r in self.cursor.fetchall() })
+            self.cursor.execute("DELETE FROM ancestry WHERE descendant_id = ANY(%s)", (affected,))
+            seed = "SELECT cid, pid, 1 FROM children WHERE pid <> cid AND cid = ANY(%(affected)s)"
+            params = { "max_depth": ANCESTRY_MAX_DEPTH, "affected": affected }
+
+        self.cursor.execute(f"""
+            INSERT INTO ancestry (ancestor_id, descendant_id, depth)
+            WITH RECURSIVE up (descendant_id, ancestor_id, depth) AS (
+                {seed}
+                UNION
+                SELECT u.descendant_id, c.pid, u.depth + 1
+                FROM up u
+                INNER JOIN children c ON c.cid = u.ancestor_id
+                WHERE u.depth < %(max_depth)s
+            )
+            SELECT ancestor_id, descendant_id, MIN(depth)
+            FROM up
+            WHERE ancestor_id <> descendant_id
+            GROUP BY ancestor_id, descendant_id""", params)
 
     def export_data(self, table: str, file_handle: io.IOBase) -> None:
-        if table == "people":
-            self.cursor.copy_expert("""
-                COPY people (id, print_id, in_tree, first_name, nickname,
-                    middle_name1, middle_name2, last_name, pref_name,
-                    gender, birth_month, birth_day, birth_year,
-                    birth_place, death_month, death_day, death_year,
-                    death_place, buried, additional_notes)
-                TO STDOUT DELIMITER ',' CSV HEADER;""", file_handle)
-        elif table == "marriages":
-            self.cursor.copy_expert("""
-                COPY marriages (pid1, pid2, marriage_order,
-                    married_month, married_day, married_year,
-                    married_place, common_law, divorced, divorced_month,
-                    divorced_day, divorced_year)
-                TO STDOUT DELIMITER ',' CSV HEADER;""", file_handle)
-        elif table == "children":
-            self.cursor.copy_expert("""
-                COPY children (pid, cid, birth_order, adoptive)
-                TO STDOUT DELIMITER ',' CSV HEADER;""", file_handle)
-        else:
+        if table not in EXPORT_COLS:
             raise ValueError
+        self.cursor.copy_expert(f"""
+            COPY {table} ({", ".join(EXPORT_COLS[table])})
+            TO STDOUT DELIMITER ',' CSV HEADER;""", file_handle)
+
+    def export_changes(self, table: str, since: date, file_handle: io.IOBase) -> None:
+        # the current version of every row inserted or updated on or
+        # after `since`, in the same columns as export_data()
+        if table not in EXPORT_COLS:
+            raise ValueError
+        cols = EXPORT_COLS[table]
+        query = self.cursor.mogrify(f"""
+            SELECT {", ".join(cols)}
+            FROM {table}
+            WHERE id::text IN (
+                SELECT row_id
+                FROM change_log
+                WHERE table_name = %s
+                    AND changed_at >= %s
+            )
+            ORDER BY id""", (table, since))
+        self.cursor.copy_expert(f"""
+            COPY ({query.decode()})
+            TO STDOUT DELIMITER ',' CSV HEADER;""", file_handle)
+
+    def import_data(self, files: Dict[str, io.IOBase]) -> Dict[str, Dict[str, int]]:
+        # bulk loads CSV files in the same format as the exports (with
+        # a header row naming the columns), given as a dict of table
+        # name to file; each file is copied into a temporary staging
+        # table, checked as a whole, and then merged into the table:
+        # rows matching an existing row (by ID, or for marriages and
+        # children without an ID column, by the people involved)
+        # update it, and the rest are added. Nothing is deleted. All of
+        # the tables are loaded in one transaction, so if any problems
+        # are found, DataImportError is raised and nothing changes.
+        # Returns the number of rows inserted, updated, and unchanged in
+        # each table.
+        tables = [t for t in ["people", "marriages", "children"] if t in files]
+        if len(tables) == 0:
+            raise DataImportError(["No people, marriages, or children files to import."])
+        try:
+            cols = {}
+            for table in tables:
+                cols[table] = self._stage_import(table, files[table])
+            errors = []
+            for table in tables:
+                errors.extend(self._check_import(table, cols[table], "people" in tables))
+            if len(errors) > 0:
+                if len(errors) > IMPORT_MAX_ERRORS:
+                    errors = errors[:IMPORT_MAX_ERRORS] + [f"...and {len(errors) - IMPORT_MAX_ERRORS} more."]
+                raise DataImportError(errors)
+
+            counts = {}
+            for table in tables:
+                counts[table] = self._merge_import(table, cols[table])
+            self._notify_changes(None)
+        except:
+            self.rollback_transaction()
+            raise
+
+        self.commit_transaction()
+        self._changed(None)
+        return counts
+
+    def _stage_import(self, table: str, file_handle: io.IOBase) -> List[str]:
+        # copies the file into import_<table>, a temporary table with
+        # the same column types but none of the constraints, plus the
+        # row number within the file and the ID of the row it will
+        # update (filled in later); returns the columns in the file
+        if not isinstance(file_handle, io.TextIOBase):
+            file_handle = io.TextIOWrapper(file_handle, encoding="utf-8-sig", newline="")
+        header = next(csv.reader([file_handle.readline()]), [])
+        allowed = EXPORT_COLS[table]
+        unknown = [c for c in header if c not in allowed]
+        if len(header) == 0 or len(unknown) > 0 or len(set(header)) != len(header):
+            raise DataImportError([f"{table}: the header row must name the columns, out of: {', '.join(allowed)}."
+                + (f" Unknown columns: {', '.join(unknown)}." if len(unknown) > 0 else "")])
+        missing = [c for c in IMPORT_KEYS[table][0] if c not in header]
+        if len(missing) > 0:
+            raise DataImportError([f"{table}: missing the {', '.join(missing)} column(s)."])
+
+        self.cursor.execute(f"""
+            CREATE TEMP TABLE import_{table} ON COMMIT DROP AS
+            SELECT id AS target_id, {", ".join(allowed)}
+            FROM {table}
+            WITH NO DATA""")
+        self.cursor.execute(f"ALTER TABLE import_{table} ADD COLUMN import_row BIGSERIAL")
+        try:
+            self.cursor.copy_expert(f"""
+                COPY import_{table} ({", ".join(header)})
+                FROM STDIN DELIMITER ',' CSV;""", file_handle)
+        except psycopg2.DataError as e:
+            # e.g., text in a number column; the context gives the line
+            # (not counting the header) and column
+            raise DataImportError([f"{table}: {e.diag.message_primary} ({e.diag.context})"])
+        return header
+
+    def _check_import(self, table: str, cols: List[str], with_people: bool) -> List[str]:
+        # matches the staged rows to existing ones, then looks for
+        # problems with the staged rows, one query per kind of problem
+        # rather than row by row; returns a description of each one
+        _, key_match, key_expr = IMPORT_KEYS[table]
+        if "id" in cols:
+            self.cursor.execute(f"""
+                UPDATE import_{table} s
+                SET target_id = t.id
+                FROM {table} t
+                WHERE t.id = s.id""")
+        if table != "people":
+            # marriages and children without an ID, or with one that
+            # isn't in the database (e.g. when loading an export into a
+            # different database), match the row between the same people
+            self.cursor.execute(f"""
+                UPDATE import_{table} s
+                SET target_id = (SELECT MIN(t.id) FROM {table} t WHERE {key_match})
+                WHERE s.target_id IS NULL""")
+
+        # each check is a query selecting the row number and a
+        # description of the problem for every row that has it; they
+        # are composed with psycopg2.sql, as the CHECK constraints are
+        # included as they are, and run without parameters, so that
+        # any braces or percent signs in them are left alone
+        staged = sql.Identifier(f"import_{table}")
+        checks = []
+        checks.append(sql.SQL("""
+            SELECT MIN(import_row), {msg} || string_agg(import_row::text, ', ' ORDER BY import_row)
+            FROM {staged} s
+            WHERE COALESCE(s.target_id::text, {key}) IS NOT NULL
+            GROUP BY COALESCE(s.target_id::text, {key})
+            HAVING COUNT(*) > 1""").format(staged=staged, key=sql.SQL(key_expr),
+            msg=sql.Literal("the same row is given more than once, on rows ")))
+        if table != "people" and "id" in cols:
+            checks.append(sql.SQL("""
+                SELECT MIN(import_row), {msg} || string_agg(import_row::text, ', ' ORDER BY import_row)
+                FROM {staged} s
+                WHERE s.id IS NOT NULL
+                GROUP BY s.id
+                HAVING COUNT(*) > 1""").format(staged=staged,
+                msg=sql.Literal("the same ID is given more than once, on rows ")))
+
+        # NOT NULL columns: those in the file can't be empty, and those
+        # not in the file leave new rows empty
+        self.cursor.execute("""
+            SELECT attname::text
+            FROM pg_attribute
+            WHERE attrelid = %s::regclass
+                AND attnum > 0
+                AND NOT attisdropped
+                AND attnotnull
+                AND NOT atthasdef""", (table,))
+        for (col,) in self.cursor.fetchall():
+            if col in cols:
+                checks.append(sql.SQL("""
+                    SELECT import_row, {msg}
+                    FROM {staged} s
+                    WHERE s.{col} IS NULL""").format(staged=staged, col=sql.Identifier(col),
+                    msg=sql.Literal(f"{col} is empty")))
+            else:
+                checks.append(sql.SQL("""
+                    SELECT import_row, {msg}
+                    FROM {staged} s
+                    WHERE s.target_id IS NULL""").format(staged=staged,
+                    msg=sql.Literal(f"{col} is needed to add a new row")))
+
+        # the table's CHECK constraints, on the columns in the file
+        self.cursor.execute("""
+            SELECT pg_get_expr(c.conbin, c.conrelid),
+                ARRAY(SELECT a.attname::text
+                    FROM pg_attribute a
+                    WHERE a.attrelid = c.conrelid AND a.attnum = ANY(c.conkey))
+            FROM pg_constraint c
+            WHERE c.conrelid = %s::regclass
+                AND c.contype = 'c'""", (table,))
+        for expr, con_cols in self.cursor.fetchall():
+            if all(c in cols for c in con_cols):
+                checks.append(sql.SQL("""
+                    SELECT import_row, {msg}
+                    FROM {staged} s
+                    WHERE NOT ({expr})""").format(staged=staged, expr=sql.SQL(expr),
+                    msg=sql.Literal(f"{', '.join(con_cols)} must satisfy {expr}")))
+
+        # foreign keys, which may refer to people in the same import
+        for col in IMPORT_REFS[table]:
+            in_import = sql.SQL("AND NOT EXISTS (SELECT 1 FROM import_people p WHERE p.id = s.{col})" if with_people else "")
+            checks.append(sql.SQL("""
+                SELECT import_row, {msg} || s.{col}
+                FROM {staged} s
+                WHERE s.{col} IS NOT NULL
+                    AND NOT EXISTS (SELECT 1 FROM people p WHERE p.id = s.{col})
+                    {in_import}""").format(staged=staged, col=sql.Identifier(col),
+                    in_import=in_import.format(col=sql.Identifier(col)),
+                    msg=sql.Literal(f"{col} is not the ID of a person: ")))
+
+        self.cursor.execute(
+            sql.SQL(" UNION ALL ").join(sql.SQL("({})").format(q) for q in checks) + sql.SQL(" ORDER BY 1"))
+        return [f"{table} row {n}: {msg}" for n, msg in self.cursor.fetchall()]
+
+    def _merge_import(self, table: str, cols: List[str]) -> Dict[str, int]:
+        # updates the existing rows that differ from the staged ones and
+        # adds the rest, logging each change; changes to the children
+        # table are carried through to the ancestry table
+        self.cursor.execute(f"SELECT COUNT(*) FROM import_{table}")
+        total = self.cursor.fetchone()[0]
+
+        set_cols = [c for c in cols if c != "id"]
+        differs = f"({', '.join(f't.{c}' for c in set_cols)}) IS DISTINCT FROM ({', '.join(f's.{c}' for c in set_cols)})"
+        if table == "children":
+            # the people whose ancestors may change: the old and new
+            # children of changed rows, and the children of new rows
+            self.cursor.execute(f"""
+                SELECT t.cid
+                FROM children t
+                INNER JOIN import_children s ON s.target_id = t.id
+                WHERE {differs}
+                UNION
+                SELECT s.cid
+                FROM import_children s
+                LEFT JOIN children t ON t.id = s.target_id
+                WHERE t.id IS NULL OR {differs}""")
+            affected = [r[0] for r in self.cursor.fetchall()]
+
+        updated = 0
+        if len(set_cols) > 0:
+            self.cursor.execute(f"""
+                WITH changed AS (
+                    UPDATE {table} t
+                    SET {", ".join(f"{c} = s.{c}" for c in set_cols)}
+                    FROM import_{table} s
+                    WHERE t.id = s.target_id
+                        AND {differs}
+                    RETURNING t.id
+                )
+                INSERT INTO change_log (table_name, row_id, action)
+                SELECT %s, id::text, 'update'
+                FROM changed""", (table,))
+            updated = self.cursor.rowcount
+
+        # new marriages and children keep the ID they were given, so
+        # that later change exports still match them; the rest get
+        # theirs from the sequence, which is then moved past the IDs
+        # given
+        insert_cols = cols if table == "people" or "id" in cols else set_cols
+        select_cols = [f"COALESCE(id, nextval(pg_get_serial_sequence('{table}', 'id')))"
+            if c == "id" and table != "people" else c for c in insert_cols]
+        self.cursor.execute(f"""
+            WITH added AS (
+                INSERT INTO {table} ({", ".join(insert_cols)})
+                SELECT {", ".join(select_cols)}
+                FROM import_{table}
+                WHERE target_id IS NULL
+                ORDER BY import_row
+                RETURNING id
+            )
+            INSERT INTO change_log (table_name, row_id, action)
+            SELECT %s, id::text, 'insert'
+            FROM added""", (table,))
+        inserted = self.cursor.rowcount
+        if table != "people" and "id" in cols and inserted > 0:
+            self.cursor.execute(f"""
+                SELECT setval(pg_get_serial_sequence('{table}', 'id'), MAX(id))
+                FROM {table}""")
+
+        if table == "children" and updated + inserted > 0:
+            self.rebuild_ancestry(affected)
+        return { "inserted": inserted, "updated": updated, "unchanged": total - inserted - updated }
 
     def commit_transaction(self) -> None:
         self.conn.commit()
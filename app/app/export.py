@@ -0,0 +1,142 @@
+from datetime import date, datetime
+import fcntl
+import os
+import threading
+from typing import Any, Dict, Optional
+
+from db import DBConnect
+import utils
+
+
+class ExportJob():
+    """Runs utils.export_data() (a full export) or utils.export_changes()
+    (only the rows changed since a given date) on a background thread,
+    so that no request has to wait for the export to finish.
+
+    Only one export runs at a time: within a process, a second call to
+    start() while the job is running does nothing, and across processes
+    (e.g., uWSGI workers) an exclusive lock on a file in the data
+    directory stops two workers from exporting at once. The process
+    holding the lock writes its PID to a second file, so that other
+    processes can tell an export is running without trying the lock.
+    """
+    def __init__(self, db: DBConnect) -> None:
+        self.db = db
+        self._lock = threading.Lock()
+        self._thread = None
+        self.state = "idle"
+        self.since = None
+        self.filename = None
+        self.started = None
+        self.finished = None
+        self.error = None
+
+    def _lock_path(self) -> str:
+        data_dir = os.path.join(os.environ.get("APP_ROOT"), "static/data")
+        os.makedirs(data_dir, exist_ok=True)
+        return os.path.join(data_dir, ".export.lock")
+
+    def _pid_path(self) -> str:
+        return os.path.join(os.path.dirname(self._lock_path()), ".export.pid")
+
+    def start(self, force: bool = False, since: Optional[date] = None) -> bool:
+        """Starts an export in the background, unless one is already
+        running here or in another process. If `since` is given, only
+        the changes since that date are exported. Unless `force` is
+        set, no export is started if it would be redundant: a full
+        export is only made when utils.snapshot_due() says so, and the
+        changes since a date only once a day. Returns True if an export
+        is (now) running."""
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return True
+
+            lock_file = open(self._lock_path(), "w")
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # another process is already exporting
+                lock_file.close()
+                return True
+
+            # check again, since another process may have finished an
+            # export while we were waiting for the lock
+            if not force and not self._is_due(since):
+                lock_file.close()
+                return False
+
+            self.state = "running"
+            self.since = since
+            self.filename = None
+            self.started = datetime.now()
+            self.finished = None
+            self.error = None
+            with open(self._pid_path(), "w") as f:
+                f.write(str(os.getpid()))
+            self._thread = threading.Thread(target=self._run, args=(lock_file, since), daemon=True)
+            self._thread.start()
+            return True
+
+    def _is_due(self, since: Optional[date]) -> bool:
+        if since is None:
+            return utils.snapshot_due()
+        path = os.path.join(os.path.dirname(self._lock_path()), utils.changes_filename(since))
+        return not os.path.exists(path)
+
+    def _run(self, lock_file, since: Optional[date]) -> None:
+        error = None
+        try:
+            if since is None:
+                self.filename = utils.export_data(self.db)
+            else:
+                self.filename = utils.export_changes(self.db, since)
+            self.state = "done"
+        except Exception as e:
+            error = e
+            self.error = str(e)
+            self.state = "failed"
+        finally:
+            self.finished = datetime.now()
+            # this thread checked out its own connection from the pool
+            self.db.release(error)
+            try:
+                os.remove(self._pid_path())
+            except FileNotFoundError:
+                pass
+            lock_file.close()
+
+    def is_running(self) -> bool:
+        """Whether an export is running, in this process or another."""
+        if self._thread is not None and self._thread.is_alive():
+            return True
+        # the PID file is left behind if the process exporting was
+        # killed, so check that the process is still there
+        try:
+            with open(self._pid_path()) as f:
+                pid = int(f.read())
+        except (FileNotFoundError, ValueError):
+            return False
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+        return True
+
+    def status(self) -> Dict[str, Any]:
+        """Summary of the most recent export started by this process,
+        along with the latest export file available."""
+        def fmt(d: Optional[datetime]) -> Optional[str]:
+            return d.isoformat(timespec="seconds") if d is not None else None
+
+        running = self.is_running()
+        return {
+            "state": "running" if running else self.state,
+            "since": self.since.strftime("%Y%m%d") if self.since is not None else None,
+            "file": self.filename,
+            "started": fmt(self.started),
+            "finished": fmt(self.finished),
+            "error": self.error,
+            "latest_export": utils.get_latest_export()
+        }
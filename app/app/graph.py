@@ -0,0 +1,219 @@
+import threading
+from typing import Any, Dict, List, NamedTuple, Optional
+
+from db import ChildLink, DBConnect, DBEntry, Marriage, Person
+
+
+class _Tree(NamedTuple):
+    people: Dict[str, Person]
+    # cid -> [child row, ...] and pid -> [child row, ...]
+    parents: Dict[str, List[ChildLink]]
+    children: Dict[str, List[ChildLink]]
+    # pid -> [marriage row, ...], for both spouses
+    marriages: Dict[str, List[Marriage]]
+
+
+class FamilyGraph():
+    """In-memory copy of the people, marriages, and children tables,
+    held as adjacency maps keyed by person ID. Provides the same read
+    methods as DBConnect (get_person, get_parents, get_children,
+    get_marriages), so person pages can be assembled without any
+    round trips to the database. Rows are held as the compact records
+    returned by DBConnect, and handed out as dict copies.
+
+    The whole tree is small enough that after a change, it is simpler
+    (and safer) to reload it than to patch it in place; invalidate()
+    marks the graph as stale and the next read rebuilds it. The maps are
+    swapped in together, as one _Tree, and each read works from the tree
+    it started with.
+    """
+    def __init__(self, db: DBConnect) -> None:
+        self.db = db
+        self._lock = threading.Lock()
+        self._stale = True
+        self._tree = None
+
+    def build(self) -> None:
+        """Loads the full tree from the database and swaps it in."""
+        # cleared before reading, so that a change committed while the
+        # tree is loading marks it stale again rather than being lost
+        self._stale = False
+        try:
+            people = { p["id"]: p for p in self.db.get_all_people() }
+
+            parents = {}
+            children = {}
+            for c in self.db.get_all_children():
+                parents.setdefault(c["cid"], []).append(c)
+                children.setdefault(c["pid"], []).append(c)
+
+            marriages = {}
+            for m in self.db.get_all_marriages():
+                marriages.setdefault(m["pid1"], []).append(m)
+                if m["pid2"] != m["pid1"]:
+                    marriages.setdefault(m["pid2"], []).append(m)
+        except:
+            self._stale = True
+            raise
+        self._tree = _Tree(people, parents, children, marriages)
+
+    def invalidate(self, entries: Optional[List[DBEntry]] = None) -> None:
+        """Commit hook for DBConnect: marks the graph as out of date so
+        that it is reloaded on the next read."""
+        self._stale = True
+
+    def _ensure_fresh(self) -> _Tree:
+        # while the tree is being rebuilt, other readers carry on with
+        # the previous one, unless there isn't one yet
+        if self._stale or self._tree is None:
+            with self._lock:
+                if self._stale or self._tree is None:
+                    self.build()
+        return self._tree
+
+    def get_person(self, pid: str) -> Optional[Dict[str, Any]]:
+        return self._person(self._ensure_fresh(), pid)
+
+    def _person(self, tree: _Tree, pid: str) -> Optional[Dict[str, Any]]:
+        p = tree.people.get(pid)
+        if p is None:
+            return None
+        return dict(p)
+
+    def get_parents(self, pid: str) -> List[Dict[str, Any]]:
+        return self._parents(self._ensure_fresh(), pid)
+
+    def _parents(self, tree: _Tree, pid: str) -> List[Dict[str, Any]]:
+        out = []
+        for c in tree.parents.get(pid, []):
+            parent = tree.people.get(c["pid"])
+            if parent is None:
+                continue
+            pr = dict(parent)
+            pr["adoptive"] = c["adoptive"]
+            pr["row_id"] = c["id"]
+            out.append(pr)
+        return out
+
+    def get_children(self, pid1: str, pid2: str) -> List[Dict[str, Any]]:
+        return self._children(self._ensure_fresh(), pid1, pid2)
+
+    def _children(self, tree: _Tree, pid1: str, pid2: str) -> List[Dict[str, Any]]:
+        other_children = { c["cid"] for c in tree.children.get(pid2, []) }
+        shared = {}
+        for c in tree.children.get(pid1, []):
+            if c["cid"] in other_children and c["cid"] not in shared:
+                shared[c["cid"]] = c["birth_order"]
+
+        # children with an unknown birth order sort last, as in Postgres
+        order = sorted(shared.items(), key=lambda c: (c[1] is None, c[1] or 0))
+        return [dict(tree.people[cid]) for cid, _ in order if cid in tree.people]
+
+    def get_marriages(self, pid: str) -> List[Dict[str, Any]]:
+        return self._marriages(self._ensure_fresh(), pid)
+
+    def _marriages(self, tree: _Tree, pid: str) -> List[Dict[str, Any]]:
+        rows = sorted(tree.marriages.get(pid, []),
+            key=lambda m: (m["marriage_order"] is None, m["marriage_order"] or 0))
+
+        out = []
+        for m in rows:
+            spouse_id = m["pid2"] if m["pid1"] == pid else m["pid1"]
+            spouse = tree.people.get(spouse_id)
+            if spouse is None:
+                continue
+            out.append({ "marriage": dict(m), "spouse": dict(spouse) })
+        return out
+
+    def get_family(self, pid: str) -> Optional[Dict[str, Any]]:
+        """Returns the same bundle as DBConnect.get_family(): the focal
+        person, their parents, siblings, and marriages (each with the
+        spouse and children)."""
+        tree = self._ensure_fresh()
+        focal = self._person(tree, pid)
+        if focal is None:
+            return None
+
+        siblings = {}
+        for pr in tree.parents.get(pid, []):
+            for c in tree.children.get(pr["pid"], []):
+                sib = siblings.setdefault(c["cid"], { "parent_ids": [], "birth_order": None })
+                if c["pid"] not in sib["parent_ids"]:
+                    sib["parent_ids"].append(c["pid"])
+                if c["birth_order"] is not None and (sib["birth_order"] is None or c["birth_order"] < sib["birth_order"]):
+                    sib["birth_order"] = c["birth_order"]
+        sibling_list = []
+        for cid, sib in siblings.items():
+            if cid in tree.people:
+                sib["person"] = dict(tree.people[cid])
+                sibling_list.append(sib)
+        sibling_list.sort(key=lambda s: (s["birth_order"] is None, s["birth_order"] or 0))
+
+        marriages = self._marriages(tree, pid)
+        for m in marriages:
+            m["children"] = self._children(tree, pid, m["spouse"]["id"])
+
+        return {
+            "focal": focal,
+            "parents": self._parents(tree, pid),
+            "siblings": sibling_list,
+            "marriages": marriages
+        }
+
+    def get_lineage(self, pid: str, direction: str, depth: int, max_nodes: int) -> Optional[Dict[str, Any]]:
+        """Returns the same bundle as DBConnect.get_lineage(), found
+        with a breadth-first walk up or down the parent-child links."""
+        tree = self._ensure_fresh()
+        if direction == "ancestors":
+            links, follow = tree.parents, "pid"
+        elif direction == "descendants":
+            links, follow = tree.children, "cid"
+        else:
+            raise ValueError
+        if pid not in tree.people:
+            return None
+
+        depths = { pid: 0 }
+        frontier = [pid]
+        level = 0
+        while len(frontier) > 0 and level < depth:
+            level += 1
+            next_frontier = []
+            for node in frontier:
+                for c in links.get(node, []):
+                    if c[follow] not in depths:
+                        depths[c[follow]] = level
+                        next_frontier.append(c[follow])
+            frontier = next_frontier
+
+        # keep the nearest people, in the same order as the database
+        truncated = len(depths) > max_nodes
+        kept = sorted(depths.items(), key=lambda d: (d[1], d[0]))[:max_nodes]
+        depths = dict(kept)
+
+        marriages = {}
+        for node in depths:
+            for m in tree.marriages.get(node, []):
+                other = m["pid2"] if m["pid1"] == node else m["pid1"]
+                if direction == "descendants" or other in depths:
+                    marriages[m["id"]] = m
+        marriages = sorted(marriages.values(),
+            key=lambda m: (m["marriage_order"] is None, m["marriage_order"] or 0, m["id"]))
+
+        # the links from each person to their parents in the lineage,
+        # including spouses who married into it
+        spouses = { m[k] for m in marriages for k in ("pid1", "pid2") }
+        children = sorted([c for node in depths for c in tree.parents.get(node, [])
+            if c["pid"] in depths or c["pid"] in spouses], key=lambda c: c["id"])
+
+        people = {}
+        for person_id in list(depths) + [m[k] for m in marriages for k in ("pid1", "pid2")]:
+            if person_id in tree.people:
+                people[person_id] = dict(tree.people[person_id])
+        return {
+            "depths": depths,
+            "people": people,
+            "children": [dict(c) for c in children],
+            "marriages": [dict(m) for m in marriages],
+            "truncated": truncated
+        }
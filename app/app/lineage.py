@@ -0,0 +1,133 @@
+import os
+from typing import Any, Dict, List
+
+import utils
+
+# limits on how much of the tree a single request can ask for
+MAX_DEPTH = int(os.environ.get("APP_LINEAGE_MAX_DEPTH") or 10)
+MAX_NODES = int(os.environ.get("APP_LINEAGE_MAX_NODES") or 500)
+
+
+def _by_birth_order(rows: List[Dict[str, Any]]) -> List[str]:
+    # child IDs in birth order, with unknown birth orders last
+    rows = sorted(rows, key=lambda c: (c["birth_order"] is None, c["birth_order"] or 0))
+    out = []
+    for c in rows:
+        if c["cid"] not in out:
+            out.append(c["cid"])
+    return out
+
+
+def descendant_tree(lineage: Dict[str, Any], pid: str, max_nodes: int = MAX_NODES) -> Dict[str, Any]:
+    """Given the bundle returned by get_lineage() for a person's
+    descendants, this nests them into the format used by dTree: each
+    person has a list of marriages, each with the spouse and the
+    children of that marriage. Children whose other parent isn't a
+    spouse are listed under the person's own `children`.
+
+    Returns the tree (a list with the person as the only root), along
+    with whether anyone was left out to stay within `max_nodes`."""
+    people = lineage["people"]
+    children = {}
+    parents_of = {}
+    for c in lineage["children"]:
+        children.setdefault(c["pid"], []).append(c)
+        parents_of.setdefault(c["cid"], set()).add(c["pid"])
+    marriages = {}
+    for m in lineage["marriages"]:
+        marriages.setdefault(m["pid1"], []).append(m)
+        if m["pid2"] != m["pid1"]:
+            marriages.setdefault(m["pid2"], []).append(m)
+
+    state = { "count": 0, "truncated": lineage["truncated"] }
+
+    def build_children(cids: List[str]) -> List[Dict[str, Any]]:
+        out = []
+        for cid in cids:
+            if state["count"] >= max_nodes:
+                state["truncated"] = True
+                break
+            out.append(build(cid))
+        return out
+
+    def build(person_id: str, focal: bool = False) -> Dict[str, Any]:
+        state["count"] += 1
+        node = utils.tree_node(people[person_id], focal=focal)
+        own_children = _by_birth_order(children.get(person_id, []))
+
+        node["marriages"] = []
+        placed = set()
+        for m in marriages.get(person_id, []):
+            spouse_id = m["pid2"] if m["pid1"] == person_id else m["pid1"]
+            if spouse_id not in people:
+                continue
+            shared = [c for c in own_children if spouse_id in parents_of[c]]
+            placed.update(shared)
+            node["marriages"].append({
+                "spouse": utils.tree_node(people[spouse_id]),
+                "children": build_children(shared)
+            })
+        node["children"] = build_children([c for c in own_children if c not in placed])
+        return node
+
+    tree = [build(pid, focal=True)]
+    return { "tree": tree, "truncated": state["truncated"] }
+
+
+def ancestor_tree(lineage: Dict[str, Any], pid: str, max_nodes: int = MAX_NODES) -> Dict[str, Any]:
+    """Given the bundle returned by get_lineage() for a person's
+    ancestors, this lays them out in the format used by dTree. dTree
+    draws trees downwards, from a root to its descendants, so each line
+    of ancestors becomes its own root: for each couple, the line is
+    continued through the first parent (by birth date), and the second
+    parent's ancestors start a separate root, ending at the second
+    parent.
+
+    Returns the list of roots, along with whether anyone was left out
+    to stay within `max_nodes`."""
+    people = lineage["people"]
+    parent_rows = {}
+    for c in lineage["children"]:
+        parent_rows.setdefault(c["cid"], []).append(c)
+
+    state = { "count": 0, "truncated": lineage["truncated"] }
+
+    def tree_parents(person_id: str) -> List[Dict[str, Any]]:
+        # the same parents as shown on the person pages
+        parents = [dict(people[c["pid"]], adoptive=c["adoptive"])
+            for c in parent_rows.get(person_id, []) if c["pid"] in people]
+        parent_ids = utils.tree_parent_ids(parents)
+        parents = [p for p in parents if p["id"] in parent_ids]
+        return sorted(parents, key=utils.birthdate_sorter)[:2]
+
+    def up(person_id: str, node: Dict[str, Any]) -> List[Dict[str, Any]]:
+        # returns the roots of the lines of ancestors above the person,
+        # with `node` (the person's own node) at the bottom
+        parents = tree_parents(person_id)
+        if len(parents) == 0:
+            return [node]
+        if state["count"] + len(parents) > max_nodes:
+            state["truncated"] = True
+            return [node]
+        state["count"] += len(parents)
+
+        first = utils.tree_node(parents[0])
+        if len(parents) == 1:
+            first["children"] = [node]
+            return up(parents[0]["id"], first)
+
+        first["marriages"] = [{
+            "spouse": utils.tree_node(parents[1]),
+            "children": [node]
+        }]
+        roots = up(parents[0]["id"], first)
+        second = utils.tree_node(parents[1])
+        second_roots = up(parents[1]["id"], second)
+        if len(second_roots) > 1 or second_roots[0] is not second:
+            # only add the second parent's line if they have ancestors
+            roots.extend(second_roots)
+        return roots
+
+    state["count"] += 1
+    tree = up(pid, utils.tree_node(people[pid], focal=True))
+    return { "tree": tree, "truncated": state["truncated"] }
@@ -1,13 +1,28 @@
+from datetime import datetime
+from functools import wraps
+import gc
+import hmac
 import json
 import os
+import time
 from urllib.parse import urlparse, urljoin
 
-from flask import abort, Flask, flash, redirect, render_template, request, url_for
+import click
+from flask import abort, before_render_template, Flask, flash, g, jsonify, make_response, redirect, render_template, request, template_rendered, url_for
 from flask_login import current_user, LoginManager, login_required, login_user, logout_user
 # from flask_mailman import Mail, EmailMessage
 
 from auth import User, hash_pass
-from db import DBConnect, DBEntry, DBEntryType, PERSON_COLS, MARRIAGE_COLS
+from cache import PageCache
+from db import DataImportError, DBConnect, DBEntry, DBEntryType, PERSON_COLS, MARRIAGE_COLS
+from export import ExportJob
+from graph import FamilyGraph
+import lineage
+import metrics
+from relationships import RelationshipIndex
+from search_index import NameIndex
+from snapshot import SnapshotReader, SnapshotWriter
+from static_pages import StaticPages
 import utils
 
 # special cases with extended notes about the early family members
@@ -19,15 +34,217 @@ app.config.from_envvar('FLASK_SETTINGS')
 login_manager = LoginManager(app)
 login_manager.login_view = "admin_login"
 
+# uWSGI imports the app once, in the master process, and forks the
+# workers from it, so everything built while starting up is shared by
+# the workers until they change it; garbage collection is paused until
+# then, so that objects freed along the way don't leave holes in the
+# pages being shared (see the end of the startup code)
+gc.disable()
+
 db = DBConnect()
 
+# latency histograms for /admin/metrics, and the timings for each
+# request's Server-Timing header: database statements (through the
+# query hook), template rendering, and whatever views time themselves
+request_metrics = metrics.Metrics(os.environ.get("APP_METRICS_DIR"))
+request_metrics.reset()
+
+def time_query(label, seconds):
+    request_metrics.observe("query", { "query": label }, seconds)
+    metrics.add_timing("db", seconds)
+
+db.add_query_hook(time_query)
+
+# the most recent statements over APP_SLOW_QUERY_MS, some with their
+# query plans, for /admin/slow-queries
+slow_queries = metrics.SlowQueryLog(os.environ.get("APP_METRICS_DIR"))
+db.add_slow_query_hook(slow_queries.add)
+
+# optionally, serve the public pages (person pages, trees, and searches)
+# from a read-only SQLite snapshot of the data instead of Postgres. The
+# snapshot is rewritten after each change; the in-memory copies of the
+# data below are refreshed when this process picks up the new snapshot
+# (see refresh_data()) rather than on each change, so that they aren't
+# rebuilt from the old one
+snapshot = None
+snapshot_writer = None
+if os.environ.get("APP_SNAPSHOT"):
+    snapshot_writer = SnapshotWriter(db, os.environ["APP_SNAPSHOT"])
+    if not os.path.exists(snapshot_writer.path):
+        snapshot_writer.write()
+    db.add_commit_hook(snapshot_writer.update)
+    snapshot = SnapshotReader(os.environ["APP_SNAPSHOT"])
+    add_data_hook = snapshot.add_swap_hook
+else:
+    add_data_hook = db.add_change_hook
+    # mark the change log before building any of the in-memory copies
+    # of the data below, so that workers forked later catch up on any
+    # changes made in the meantime (see DBConnect.listen()); with a
+    # snapshot, they catch up by checking for a new snapshot instead,
+    # and the public pages don't need Postgres at all
+    db.mark_changes()
+
+# optionally, hold the whole family graph in memory so that person
+# pages can be served without querying the database; admin edits (in
+# any worker) invalidate it through the change hook
+if snapshot is not None:
+    reader = snapshot
+elif os.environ.get("APP_GRAPH_CACHE", "").lower() in ['true', '1', 't']:
+    family_graph = FamilyGraph(db)
+    family_graph.build()
+    db.add_change_hook(family_graph.invalidate)
+    reader = family_graph
+else:
+    reader = db
+
+# where the searches, lineage counts, and in-memory indexes read from
+searcher = snapshot if snapshot is not None else db
+
+# optionally, cache rendered person and content pages in memory; admin
+# edits drop the pages showing any of the people they touch
+page_cache = None
+if int(os.environ.get("APP_PAGE_CACHE_SIZE") or 0) > 0:
+    page_cache = PageCache(int(os.environ["APP_PAGE_CACHE_SIZE"]))
+    add_data_hook(page_cache.invalidate)
+
+# in-memory index of names for as-you-type search suggestions; it is
+# built while starting up and updated as people are added or edited
+name_index = NameIndex(searcher)
+add_data_hook(name_index.update)
+
+# CSV exports of the data run in the background
+export_job = ExportJob(db)
+
+# index of everyone's ancestors, for working out how two people are
+# related; built while starting up and rebuilt after any change
+relationship_index = RelationshipIndex(searcher)
+add_data_hook(relationship_index.invalidate)
+
+# optionally, render the person and content pages to static files for
+# nginx to serve (see the `prerender` command), and re-render the pages
+# affected by each change (once it is in the snapshot, if there is one);
+# this hook comes last so the caches above are already cleared
+static_pages = None
+if os.environ.get("APP_STATIC_PAGES"):
+    domain = os.environ.get("DOMAIN")
+    static_pages = StaticPages(app, db, os.environ["APP_STATIC_PAGES"],
+        f"https://{domain}" if domain else None)
+    if snapshot_writer is not None:
+        snapshot_writer.add_write_hook(static_pages.update)
+    else:
+        db.add_commit_hook(static_pages.update)
+
+# build the indexes now rather than on first use, so that it is done
+# once in the master rather than in every worker
+name_index.build()
+relationship_index.build()
+
+# don't let the workers inherit any connections opened while starting
+# up
+db.disconnect_all()
+if snapshot is not None:
+    snapshot.close()
+
+# move everything built so far out of the garbage collector's reach:
+# collections in the workers would otherwise write to the header of
+# every object, copying all of the pages they share with the master
+gc.freeze()
+gc.enable()
+
+
+@app.before_request
+def start_timer():
+    g.request_started = time.perf_counter()
+
+
+@before_render_template.connect_via(app)
+def start_render_timer(sender, template, context, **extra):
+    g.render_started = time.perf_counter()
+
+
+@template_rendered.connect_via(app)
+def stop_render_timer(sender, template, context, **extra):
+    seconds = time.perf_counter() - g.pop("render_started", time.perf_counter())
+    request_metrics.observe("render", { "template": template.name or "" }, seconds)
+    metrics.add_timing("render", seconds)
+
+
+@app.after_request
+def add_server_timing(response):
+    # times the whole request, from the first before_request function
+    # on, and breaks it down in the Server-Timing header
+    started = g.get("request_started")
+    if started is None:
+        return response
+    seconds = time.perf_counter() - started
+    request_metrics.observe("request", {
+        "route": request.endpoint or "",
+        "method": request.method,
+        "status": str(response.status_code)
+    }, seconds)
+    response.headers["Server-Timing"] = metrics.server_timing(g.get("timings", {}), seconds)
+    request_metrics.flush_if_due()
+    return response
+
+
+@app.before_request
+def refresh_data():
+    # switch to the latest snapshot, if a new one has been written, and
+    # make sure this worker is listening for changes made by the others
+    if snapshot is not None:
+        snapshot.refresh()
+    db.listen()
+
+
+@app.teardown_appcontext
+def release_db_connection(error):
+    # hand this request's database connection back to the pool
+    db.release(error)
+
+
+def cached_page(view):
+    """Serves the view from the page cache, if it is enabled. Views can
+    set `g.page_person_ids` to the IDs of the people shown on the page,
+    so that the page is dropped when any of them change. Responses get
+    an ETag and Last-Modified header so clients can revalidate them."""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if page_cache is None:
+            return view(*args, **kwargs)
+
+        key = request.base_url
+        page = page_cache.get(key)
+        if page is None:
+            # a change committed while the view runs may not be on the
+            # page, so it is only cached if nothing changed meanwhile
+            epoch = page_cache.epoch
+            response = make_response(view(*args, **kwargs))
+            if response.status_code != 200:
+                return response
+            page = page_cache.set(key, response.get_data(), response.mimetype,
+                g.get("page_person_ids", ()), epoch)
+        else:
+            # as if the view had run, e.g. for the static page renderer
+            g.page_person_ids = page.person_ids
+
+        response = make_response(page.body)
+        response.mimetype = page.mimetype
+        response.set_etag(page.etag)
+        response.last_modified = page.last_modified
+        response.cache_control.no_cache = True
+        return response.make_conditional(request)
+    return wrapper
+
 
 @app.route('/')
 def index():
+    if utils.snapshot_due():
+        # the download link will show up (or be updated) once the
+        # export is done
+        export_job.start()
     raw_data_file = utils.get_latest_export()
-    if raw_data_file is None:
-        raw_data_file = utils.export_data(db)
-    raw_data_file = "data/" + raw_data_file
+    if raw_data_file is not None:
+        raw_data_file = "data/" + raw_data_file
     return render_template("index.html", raw_data=raw_data_file)
 
 
@@ -35,82 +252,84 @@ def index():
 def search():
     if len(request.args) > 0:
         terms = request.args.get("search", "").split()
-        res = db.search_name(terms)
-        res = sorted(res, key=utils.birthdate_sorter)
+        res = searcher.search_name(terms)
+        # best matches first, and in birth order within equal matches
+        res = sorted(res, key=lambda r: (-r["rank"], utils.birthdate_sorter(r)))
         for r in res:
-            r["display_name"] = utils.create_display_name(r)
-            r["life_span"] = utils.create_life_span(r)
+            derived = utils.get_derived_fields(r)
+            r["display_name"] = derived["display_name"]
+            r["life_span"] = derived["life_span"]
         return render_template("search_results.html", results=res)
     else:
         return render_template("search_results.html", results=[])
 
 
+@app.route('/search/suggest', methods=['GET'])
+def search_suggest():
+    results = name_index.suggest(request.args.get("q", ""))
+    for r in results:
+        r["url"] = url_for("person_page", pid=r["id"])
+    return jsonify(results)
+
+
 @app.route('/advsearch', methods=['GET'])
 def adv_search():
     if len(request.args) > 0:
-        res = db.search_advanced(request.args)
+        res, facets = searcher.search_advanced(request.args)
         res = sorted(res, key=utils.birthdate_sorter)
         for r in res:
-            r["display_name"] = utils.create_display_name(r)
-            r["life_span"] = utils.create_life_span(r)
-        return render_template("search_results.html", results=res)
+            derived = utils.get_derived_fields(r)
+            r["display_name"] = derived["display_name"]
+            r["life_span"] = derived["life_span"]
+
+        # links to narrow down the search to each facet value
+        args = request.args.to_dict()
+        for d in facets.get("decades", []):
+            d["url"] = url_for("adv_search", **dict(args, birth_decade=d["decade"]))
+        for b in facets.get("birth_places", []):
+            b["url"] = url_for("adv_search", **dict(args, birth_place_key=b["key"]))
+        return render_template("search_results.html", results=res, facets=facets)
     else:
         return render_template("adv_search.html")
 
 
 @app.route('/p/<pid>')
+@cached_page
 def person_page(pid):
     data = {}
-    p = db.get_person(pid)
-    if p is None:
+    family = reader.get_family(pid)
+    if family is None:
         abort(404)
 
-    data["focal"] = utils.format_person_data(p, focal=True)
+    format_started = time.perf_counter()
+    data["focal"] = utils.format_person_data(family["focal"], focal=True)
 
     # get info on focal person's parents
     data["parents"] = []
-    bio_parent_ids = []
-    adopt_parent_ids = []
-    parent_ids = []
-    parents = db.get_parents(pid)
+    parents = family["parents"]
+    parent_ids = utils.tree_parent_ids(parents)
 
     if len(parents) > 0:
-        focal_birth_order = None
         for pr in parents:
-            pr_dict = utils.format_person_data(pr)
-            if pr["adoptive"]:
-                adopt_parent_ids.append(pr_dict["id"])
-            else:
-                bio_parent_ids.append(pr_dict["id"])
-            data["parents"].append(pr_dict)
-
+            data["parents"].append(utils.format_person_data(pr))
         data["parents"] = sorted(data["parents"], key=utils.birthdate_sorter)
 
-        # there are a few cases in the data where we have two biological
-        # parents listed, plus an adoptive parent, and the graphical tree
-        # in particular just doesn't handle more than two parents very
-        # well...
-        if len(adopt_parent_ids) > 0 and len(bio_parent_ids) < 2:
-            parent_ids = bio_parent_ids + adopt_parent_ids
-        else:
-            parent_ids = bio_parent_ids
-
-        # get info on focal person's siblings
+        # get info on focal person's siblings, i.e., the children of
+        # both of the parents
         if len(parent_ids) == 2:
-            siblings = db.get_children(parent_ids[0], parent_ids[1])
+            siblings = [s["person"] for s in family["siblings"]
+                if parent_ids[0] in s["parent_ids"] and parent_ids[1] in s["parent_ids"]]
             data["siblings"] = []
-            for i, sib in enumerate(siblings):
+            for sib in siblings:
                 if sib["id"] == pid:
                     data["siblings"].append(data["focal"])
-                    focal_birth_order = i
                 else:
                     sib_dict = utils.format_person_data(sib)
                     data["siblings"].append(sib_dict)
 
     # get info on focal person's spouse(s)
     data["marriages"] = []
-    marriages = db.get_marriages(pid)
-    for m in marriages:
+    for m in family["marriages"]:
         marriage = m["marriage"]
 
         marriage["marriage_date"] = utils.format_date(marriage, "married_day", "married_month", "married_year")
@@ -120,38 +339,45 @@ def person_page(pid):
         spouse = utils.format_person_data(m["spouse"])
         marriage["spouse"] = spouse
 
-        children = db.get_children(pid, spouse["id"])
         s_children = []
-        for c in children:
+        for c in m["children"]:
             s_children.append(utils.format_person_data(c))
 
         marriage["children"] = s_children
         data["marriages"].append(marriage)
 
+    # data for the graphical tree, with just the fields it uses; the
+    # tree can be expanded from there with the node_data() endpoint
+    focal_node = utils.tree_node(family["focal"], focal=True)
+    focal_node["marriages"] = [{
+        "spouse": utils.tree_node(m["spouse"]),
+        "children": [utils.tree_node(c) for c in m["children"]]
+    } for m in family["marriages"]]
+
     # if focal person's parents aren't in the database, we have to
     # adjust the graphical tree properly since their data isn't nested
     # under their parents
     if len(parent_ids) != 2:
-        treegraph = data["focal"]
-        treegraph["marriages"] = data["marriages"]
-    elif len(parents) > 2:
-        # special case of biological and adoptive parents
-        tree_parents = [p for p in data["parents"] if p["id"] in parent_ids]
-        treegraph = tree_parents[0]
-        treegraph["marriages"] = [{}]
-        treegraph["marriages"][0]["spouse"] = tree_parents[1]
-        treegraph["marriages"][0]["children"] = data["siblings"]
+        treegraph = focal_node
     else:
-        treegraph = data["parents"][0]
-        treegraph["marriages"] = [{}]
-        treegraph["marriages"][0]["spouse"] = data["parents"][1]
-        treegraph["marriages"][0]["children"] = data["siblings"]
-
-        if len(data["marriages"]) > 0:
-            treegraph["marriages"][0]["children"][focal_birth_order]["marriages"] = data["marriages"]
-
-    # add data formatted for the graphical tree
+        tree_parents = [p for p in data["parents"] if p["id"] in parent_ids]
+        treegraph = utils.tree_node(tree_parents[0])
+        treegraph["marriages"] = [{
+            "spouse": utils.tree_node(tree_parents[1]),
+            "children": [focal_node if s["id"] == pid else utils.tree_node(s)
+                for s in data["siblings"]]
+        }]
+    metrics.add_timing("format", time.perf_counter() - format_started)
+    json_started = time.perf_counter()
     data["treegraph"] = json.dumps([treegraph])
+    metrics.add_timing("json", time.perf_counter() - json_started)
+
+    # everyone shown on the page, so the cached page can be dropped
+    # when any of them change
+    g.page_person_ids = { pid } | { p["id"] for p in data["parents"] } \
+        | { s["id"] for s in data.get("siblings", []) } \
+        | { m["spouse"]["id"] for m in data["marriages"] } \
+        | { c["id"] for m in data["marriages"] for c in m["children"] }
 
     # special cases with extended notes about the early family members
     if pid in EXTENDED_NOTES:
@@ -160,27 +386,122 @@ def person_page(pid):
         return render_template("person.html", data=data)
 
 
+@app.route('/p/<pid>/node')
+@cached_page
+def node_data(pid):
+    # the person's node for the graphical tree, with their marriages and
+    # children, plus their parents and siblings (with the position of
+    # the person among them), so that the tree can be expanded up or
+    # down from the person without loading their page
+    family = reader.get_family(pid)
+    if family is None:
+        abort(404)
+
+    node = utils.tree_node(family["focal"])
+    node["marriages"] = [{
+        "spouse": utils.tree_node(m["spouse"]),
+        "children": [utils.tree_node(c) for c in m["children"]]
+    } for m in family["marriages"]]
+
+    parent_ids = utils.tree_parent_ids(family["parents"])
+    parents = sorted([p for p in family["parents"] if p["id"] in parent_ids],
+        key=utils.birthdate_sorter)
+    siblings = [s["person"] for s in family["siblings"]
+        if all([p in s["parent_ids"] for p in parent_ids])] if len(parents) > 0 else []
+    sibling_ids = [s["id"] for s in siblings]
+
+    g.page_person_ids = { pid } | { p["id"] for p in parents } | set(sibling_ids) \
+        | { m["spouse"]["id"] for m in family["marriages"] } \
+        | { c["id"] for m in family["marriages"] for c in m["children"] }
+    return jsonify({
+        "node": node,
+        "parents": [utils.tree_node(p) for p in parents],
+        "siblings": [utils.tree_node(s) for s in siblings],
+        "position": sibling_ids.index(pid) if pid in sibling_ids else None
+    })
+
+
+@app.route('/p/<pid>/ancestors')
+def person_ancestors(pid):
+    return lineage_tree(pid, "ancestors")
+
+
+@app.route('/p/<pid>/descendants')
+def person_descendants(pid):
+    return lineage_tree(pid, "descendants")
+
+
+def lineage_tree(pid, direction):
+    # JSON for the graphical tree of up to `depth` generations of the
+    # person's ancestors or descendants, fetched in a single query
+    try:
+        depth = int(request.args.get("depth", 3))
+    except ValueError:
+        abort(400)
+    depth = max(1, min(depth, lineage.MAX_DEPTH))
+
+    data = reader.get_lineage(pid, direction, depth, lineage.MAX_NODES)
+    if data is None:
+        abort(404)
+    if direction == "ancestors":
+        result = lineage.ancestor_tree(data, pid)
+    else:
+        result = lineage.descendant_tree(data, pid)
+    result["depth"] = depth
+    result["counts"] = searcher.get_lineage_counts(pid)
+    return jsonify(result)
+
+
+@app.route('/relationship')
+def relationship():
+    # how person `b` is related to person `a`
+    result = relationship_index.relate(request.args.get("a", ""), request.args.get("b", ""))
+    if result is None:
+        abort(404)
+
+    people = relationship_index.people
+    def describe(pid):
+        derived = utils.get_derived_fields(people[pid])
+        return {
+            "id": pid,
+            "display_name": derived["display_name"],
+            "life_span": derived["life_span"],
+            "url": url_for("person_page", pid=pid)
+        }
+    result["a"] = describe(result["a"])
+    result["b"] = describe(result["b"])
+    result["common_ancestors"] = [describe(pid) for pid in result["common_ancestors"]]
+    if result["spouse"] is not None:
+        result["spouse"] = describe(result["spouse"])
+    return jsonify(result)
+
+
 @app.route('/in-memoriam')
+@cached_page
 def in_memoriam():
     return render_template("in_memoriam.html")
 
 
 @app.route('/preface')
+@cached_page
 def preface():
     return render_template("preface.html")
 
 
 @app.route('/numbering')
+@cached_page
 def numbering():
     return render_template("numbering.html")
 
 
 @app.route('/maps')
+@cached_page
 def maps():
     return render_template("maps.html")
 
 
 @app.route('/technical-details')
+@cached_page
 def technical_details():
     return render_template("technical_details.html")
 
@@ -191,14 +512,63 @@ def report():
 
 @app.route('/last-export-date')
 def last_export():
+    if utils.snapshot_due():
+        export_job.start()
     raw_data_file = utils.get_latest_export()
     if raw_data_file is None:
-        raw_data_file = utils.export_data(db)
+        return ""
 
     no_ext = raw_data_file.split(".")[0]
     date = no_ext.split("_")[1]
     return date
 
+@app.route('/data/changes')
+def data_changes():
+    # redirects to a zip of the rows changed since the `since` date
+    # (formatted as `%Y%m%d`), which must be the date of one of the full
+    # exports, so that anyone can only cause one change export per full
+    # export per day; if it hasn't been made yet today, it is started in
+    # the background and this returns the status of the export job
+    # instead
+    try:
+        since = datetime.strptime(request.args.get("since", ""), "%Y%m%d").date()
+    except ValueError:
+        abort(400)
+    data_dir = os.path.join(os.environ.get("APP_ROOT"), "static/data")
+    if not os.path.exists(os.path.join(data_dir, f"data_{since.strftime('%Y%m%d')}.zip")):
+        abort(404)
+
+    filename = utils.changes_filename(since)
+    if os.path.exists(os.path.join(data_dir, filename)):
+        return redirect(url_for("static", filename="data/"+filename))
+    export_job.start(since=since)
+    return jsonify(export_job.status()), 202
+
+@app.cli.command("rebuild-ancestry")
+def rebuild_ancestry():
+    """Rebuilds the ancestry table from the parent-child relationships."""
+    db.rebuild_ancestry()
+    db.commit_transaction()
+    db.release()
+
+
+@app.cli.command("write-snapshot")
+def write_snapshot():
+    """Rewrites the snapshot of the data served to the public pages."""
+    if snapshot_writer is None:
+        raise click.ClickException("APP_SNAPSHOT is not set.")
+    snapshot_writer.write()
+    click.echo(f"Wrote the snapshot to {snapshot_writer.path}")
+
+
+@app.cli.command("prerender")
+def prerender():
+    """Renders the person and content pages to static files for nginx."""
+    if static_pages is None:
+        raise click.ClickException("APP_STATIC_PAGES is not set.")
+    click.echo(f"Rendered {static_pages.build()} pages to {static_pages.out_dir}")
+
+
 @app.errorhandler(404)
 def page_not_found(e):
     # note that we set the 404 status explicitly
@@ -236,15 +606,63 @@ def admin_logout():
 @login_required
 def admin_index():
     if len(request.args) > 0 and int(request.args.get("export")) == 1:
-        # re-export data from database to CSV file
-        data_fn = utils.export_data(db)
-        data_path = url_for("static", filename="data/"+data_fn)
-        if data_path.startswith("/"):
-            data_path = data_path[1:]
-        data_path = request.url_root + data_path
-        return render_template("admin/index.html", exported_data=data_path)
-    else:
-        return render_template("admin/index.html")
+        # re-export data from database to CSV file, in the background
+        export_job.start(force=True)
+        return redirect(url_for("admin_index"))
+
+    status = export_job.status()
+    data_path = None
+    if status["latest_export"] is not None:
+        data_path = url_for("static", filename="data/"+status["latest_export"], _external=True)
+    return render_template("admin/index.html", export_status=status, exported_data=data_path)
+
+
+@app.route('/admin/metrics', methods=['GET'])
+def admin_metrics():
+    # latency histograms across all of the workers, for Prometheus;
+    # besides logged-in admins, a scraper can fetch them with the token
+    # in APP_METRICS_TOKEN, as "Authorization: Bearer <token>"
+    if not current_user.is_authenticated:
+        token = os.environ.get("APP_METRICS_TOKEN")
+        auth = request.headers.get("Authorization", "")
+        if not token or not hmac.compare_digest(auth.encode(), f"Bearer {token}".encode()):
+            if auth:
+                abort(401)
+            return login_manager.unauthorized()
+    response = make_response(request_metrics.render())
+    response.mimetype = "text/plain"
+    response.headers["Content-Type"] = "text/plain; version=0.0.4; charset=utf-8"
+    return response
+
+
+@app.route('/admin/slow-queries', methods=['GET'])
+@login_required
+def admin_slow_queries():
+    return render_template("admin/slow_queries.html",
+        queries=slow_queries.recent(),
+        threshold=db.slow_query_ms,
+        explain_rate=db.explain_rate)
+
+
+@app.route('/admin/export-status', methods=['GET'])
+@login_required
+def admin_export_status():
+    return jsonify(export_job.status())
+
+
+@app.route('/admin/import', methods=['GET', 'POST'])
+@login_required
+def admin_import():
+    if request.method == "POST":
+        files = [(f.filename, f.stream) for f in request.files.getlist("files") if f.filename != ""]
+        try:
+            counts = utils.import_data(db, files)
+        except DataImportError as e:
+            return render_template("admin/import.html", errors=e.errors,
+                message="Nothing was imported, because of the problems below.", message_style="error")
+        return render_template("admin/import.html", counts=counts,
+            message="The data has been imported.", message_style="success")
+    return render_template("admin/import.html")
 
 
 @app.route('/admin/editdata', methods=['GET', 'POST'])
@@ -356,13 +774,9 @@ def admin_editdata():
     elif len(request.args) > 0:
         pid = request.args.get("search_id")
         if pid is not None:
-            focal = db.get_person(pid)
-            if focal is not None:
-                parents = db.get_parents(pid)
-                marriages = db.get_marriages(pid)
-                for i, m in enumerate(marriages):
-                    marriages[i]["children"] = db.get_children(pid, m["spouse"]["id"])
-                return render_template("admin/editdata.html", focal=focal, parents=parents, marriages=marriages, update=True)
+            family = db.get_family(pid)
+            if family is not None:
+                return render_template("admin/editdata.html", focal=family["focal"], parents=family["parents"], marriages=family["marriages"], update=True)
 
     return render_template("admin/editdata.html", focal={}, parents={}, marriages={})
 
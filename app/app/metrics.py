@@ -0,0 +1,181 @@
+from bisect import bisect_left
+from collections import deque
+import json
+import os
+import tempfile
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+from flask import g, has_request_context
+
+# upper bounds (in seconds) of the histogram buckets
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+# the histograms kept, with their descriptions
+HISTOGRAMS = {
+    "request": "Time taken to handle requests, by route.",
+    "query": "Time taken by database statements, by the DBConnect method that ran them.",
+    "render": "Time taken to render templates, by template."
+}
+
+# how often (in seconds) each process writes its histograms to disk
+FLUSH_INTERVAL = 10
+
+# how many slow queries each process keeps
+SLOW_QUERY_LOG_SIZE = 100
+
+
+class Metrics():
+    """Latency histograms, e.g. of requests by route, aggregated for
+    the /admin/metrics endpoint in the Prometheus text format.
+
+    Each uWSGI worker keeps its own histograms, and every so often
+    writes them to a file of its own in `data_dir`; render() adds up the
+    files of all of the workers, since the request for the metrics can
+    only reach one of them.
+    """
+    def __init__(self, data_dir: Optional[str] = None) -> None:
+        self.data_dir = data_dir or os.path.join(tempfile.gettempdir(), "portertree-metrics")
+        self._lock = threading.Lock()
+        # name -> labels (as JSON) -> [bucket counts, sum, count]
+        self._histograms = { name: {} for name in HISTOGRAMS }
+        self._flushed = time.monotonic()
+
+    def reset(self) -> None:
+        """Clears the histograms, including the ones written by other
+        processes, e.g. while starting up the app."""
+        with self._lock:
+            self._histograms = { name: {} for name in HISTOGRAMS }
+        if os.path.isdir(self.data_dir):
+            for filename in os.listdir(self.data_dir):
+                if filename.endswith(".json"):
+                    os.remove(os.path.join(self.data_dir, filename))
+
+    def observe(self, name: str, labels: Dict[str, str], seconds: float) -> None:
+        key = json.dumps(sorted(labels.items()))
+        with self._lock:
+            hist = self._histograms[name].get(key)
+            if hist is None:
+                hist = self._histograms[name][key] = [[0] * (len(BUCKETS) + 1), 0.0, 0]
+            hist[0][bisect_left(BUCKETS, seconds)] += 1
+            hist[1] += seconds
+            hist[2] += 1
+
+    def flush(self) -> None:
+        """Writes this process's histograms to its file."""
+        with self._lock:
+            data = json.dumps(self._histograms)
+            self._flushed = time.monotonic()
+        os.makedirs(self.data_dir, exist_ok=True)
+        path = os.path.join(self.data_dir, f"histograms_{os.getpid()}.json")
+        with open(path + ".tmp", "w") as f:
+            f.write(data)
+        os.replace(path + ".tmp", path)
+
+    def flush_if_due(self) -> None:
+        if time.monotonic() - self._flushed >= FLUSH_INTERVAL:
+            self.flush()
+
+    def render(self) -> str:
+        """Returns the histograms of every process, in the Prometheus
+        text format."""
+        self.flush()
+        totals = { name: {} for name in HISTOGRAMS }
+        for filename in os.listdir(self.data_dir):
+            if not (filename.startswith("histograms_") and filename.endswith(".json")):
+                continue
+            try:
+                with open(os.path.join(self.data_dir, filename)) as f:
+                    histograms = json.load(f)
+            except (OSError, ValueError):
+                continue
+            for name, series in histograms.items():
+                for key, (buckets, total, count) in series.items():
+                    out = totals[name].setdefault(key, [[0] * (len(BUCKETS) + 1), 0.0, 0])
+                    out[0] = [a + b for a, b in zip(out[0], buckets)]
+                    out[1] += total
+                    out[2] += count
+
+        lines = []
+        for name, series in totals.items():
+            metric = f"portertree_{name}_duration_seconds"
+            lines.append(f"# HELP {metric} {HISTOGRAMS[name]}")
+            lines.append(f"# TYPE {metric} histogram")
+            for key, (buckets, total, count) in sorted(series.items()):
+                labels = [f'{k}="{_escape(v)}"' for k, v in json.loads(key)]
+                cumulative = 0
+                for bound, n in zip([str(b) for b in BUCKETS] + ["+Inf"], buckets):
+                    cumulative += n
+                    bucket_labels = ",".join(labels + [f'le="{bound}"'])
+                    lines.append(f"{metric}_bucket{{{bucket_labels}}} {cumulative}")
+                lines.append(f"{metric}_sum{{{','.join(labels)}}} {total}")
+                lines.append(f"{metric}_count{{{','.join(labels)}}} {count}")
+        return "\n".join(lines) + "\n"
+
+
+class SlowQueryLog():
+    """The most recent slow queries reported by DBConnect, for the
+    /admin/slow-queries page.
+
+    As with Metrics, each process keeps a ring buffer of its own and
+    writes it to a file in `data_dir` (after every slow query, as they
+    should be rare); recent() merges the files of all of the processes.
+    """
+    def __init__(self, data_dir: Optional[str] = None, size: int = SLOW_QUERY_LOG_SIZE) -> None:
+        self.data_dir = data_dir or os.path.join(tempfile.gettempdir(), "portertree-metrics")
+        self.size = size
+        self._lock = threading.Lock()
+        self._entries = deque(maxlen=size)
+
+    def add(self, entry: Dict[str, Any]) -> None:
+        """Slow query hook for DBConnect."""
+        with self._lock:
+            self._entries.append(entry)
+            data = json.dumps(list(self._entries), default=str)
+        os.makedirs(self.data_dir, exist_ok=True)
+        path = os.path.join(self.data_dir, f"slow_{os.getpid()}.json")
+        with open(path + ".tmp", "w") as f:
+            f.write(data)
+        os.replace(path + ".tmp", path)
+
+    def recent(self) -> List[Dict[str, Any]]:
+        """Returns the slow queries of every process, newest first."""
+        entries = []
+        if os.path.isdir(self.data_dir):
+            for filename in os.listdir(self.data_dir):
+                if not (filename.startswith("slow_") and filename.endswith(".json")):
+                    continue
+                try:
+                    with open(os.path.join(self.data_dir, filename)) as f:
+                        entries.extend(json.load(f))
+                except (OSError, ValueError):
+                    continue
+        entries.sort(key=lambda e: e["time"], reverse=True)
+        return entries[:self.size]
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def add_timing(name: str, seconds: float) -> None:
+    """Adds to the time spent on `name` (e.g., "db" or "render") in the
+    current request, for its Server-Timing header. Does nothing outside
+    of a request."""
+    if not has_request_context():
+        return
+    timings = g.setdefault("timings", {})
+    entry = timings.setdefault(name, [0.0, 0])
+    entry[0] += seconds
+    entry[1] += 1
+
+
+def server_timing(timings: Dict[str, List], total: float) -> str:
+    """Formats the timings recorded with add_timing() as a Server-Timing
+    header, along with the total time taken by the request."""
+    parts = []
+    for name, (seconds, count) in timings.items():
+        parts.append(f'{name};dur={seconds * 1000:.2f};desc="{count}x"')
+    parts.append(f"total;dur={total * 1000:.2f}")
+    return ", ".join(parts)
@@ -0,0 +1,281 @@
+import threading
+from typing import Any, Dict, List, NamedTuple, Optional, Set, Tuple
+
+from db import DBConnect, DBEntry, Person
+
+ORDINALS = ["zeroth", "first", "second", "third", "fourth", "fifth",
+            "sixth", "seventh", "eighth", "ninth", "tenth"]
+TIMES = ["", "once", "twice", "three times", "four times", "five times"]
+
+# words for each kind of relative, for men, women, and people of
+# unknown gender
+TERMS = {
+    "parent": ("father", "mother", "parent"),
+    "child": ("son", "daughter", "child"),
+    "sibling": ("brother", "sister", "sibling"),
+    "aunt": ("uncle", "aunt", "aunt or uncle"),
+    "niece": ("nephew", "niece", "niece or nephew"),
+    "spouse": ("husband", "wife", "spouse")
+}
+
+
+def _term(kind: str, gender: Optional[str]) -> str:
+    men, women, other = TERMS[kind]
+    if gender == "M":
+        return men
+    elif gender == "F":
+        return women
+    return other
+
+
+def _ordinal(n: int) -> str:
+    if n < len(ORDINALS):
+        return ORDINALS[n]
+    suffix = "th" if 10 <= n % 100 <= 20 else {1: "st", 2: "nd", 3: "rd"}.get(n % 10, "th")
+    return f"{n}{suffix}"
+
+
+def _greats(n: int) -> str:
+    # prefix for relatives n generations beyond the closest ones, e.g.
+    # "great-", "2nd great-" (numbered, as is usual in genealogy)
+    if n <= 0:
+        return ""
+    elif n == 1:
+        return "great-"
+    short = {2: "2nd", 3: "3rd"}.get(n, f"{n}th")
+    return f"{short} great-"
+
+
+def name_relationship(up: int, down: int, gender: Optional[str], half: bool = False) -> str:
+    """Names the relationship of person B to person A, where their
+    closest common ancestor is `up` generations above A and `down`
+    generations above B. E.g., (2, 2) is a first cousin and (1, 0) is
+    a parent. `gender` is B's."""
+    if up == 0 and down == 0:
+        return "self"
+    elif down == 0:
+        # B is A's ancestor
+        if up == 1:
+            return _term("parent", gender)
+        return _greats(up - 2) + "grand" + _term("parent", gender)
+    elif up == 0:
+        # B is A's descendant
+        if down == 1:
+            return _term("child", gender)
+        return _greats(down - 2) + "grand" + _term("child", gender)
+
+    prefix = "half-" if half else ""
+    if up == 1 and down == 1:
+        return prefix + _term("sibling", gender)
+    elif down == 1:
+        # B is a sibling of one of A's ancestors
+        return prefix + _greats(up - 2) + _term("aunt", gender)
+    elif up == 1:
+        # B is a descendant of one of A's siblings
+        return prefix + _greats(down - 2) + _term("niece", gender)
+
+    degree = min(up, down) - 1
+    removed = abs(up - down)
+    name = f"{prefix}{_ordinal(degree)} cousin"
+    if removed > 0:
+        times = TIMES[removed] if removed < len(TIMES) else f"{removed} times"
+        name += f" {times} removed"
+    return name
+
+
+class _Index(NamedTuple):
+    people: Dict[str, Person]
+    # person ID -> the IDs of their parents, and of their spouses
+    parents: Dict[str, Set[str]]
+    spouses: Dict[str, List[str]]
+    # person ID -> ancestor ID -> generations between them (with the
+    # person themselves at 0)
+    ancestors: Dict[str, Dict[str, int]]
+
+
+class RelationshipIndex():
+    """Finds how two people are related. For every person, the index
+    holds the set of their ancestors along with the number of
+    generations to each one, so the closest common ancestors of two
+    people are found by intersecting two precomputed sets rather than
+    walking the tree.
+
+    The index is built on first use, and marked stale (and rebuilt on
+    the next query) when the data changes, through the commit hook. The
+    maps are swapped in together, as one _Index, and each query works
+    from the index it started with.
+    """
+    def __init__(self, db: DBConnect) -> None:
+        self.db = db
+        self._lock = threading.Lock()
+        self._stale = True
+        self._index = None
+
+    @property
+    def people(self) -> Dict[str, Person]:
+        return self._ensure_fresh().people
+
+    def build(self) -> None:
+        """Loads the people and their relationships from the database
+        and computes everyone's ancestors."""
+        # cleared before reading, so that a change committed while the
+        # index is building marks it stale again rather than being lost
+        self._stale = False
+        try:
+            self._index = self._load()
+        except:
+            self._stale = True
+            raise
+
+    def _load(self) -> _Index:
+        people = { p["id"]: p for p in self.db.get_all_people() }
+        parents = {}
+        for c in self.db.get_all_children():
+            if c["pid"] != c["cid"]:
+                parents.setdefault(c["cid"], set()).add(c["pid"])
+        spouses = {}
+        for m in self.db.get_all_marriages():
+            spouses.setdefault(m["pid1"], []).append(m["pid2"])
+            spouses.setdefault(m["pid2"], []).append(m["pid1"])
+
+        # each person's ancestors are their parents plus their parents'
+        # ancestors, one generation further away; keep the shortest
+        # distance to each ancestor
+        ancestors = {}
+        for pid in people:
+            stack = [pid]
+            while len(stack) > 0:
+                node = stack[-1]
+                if node in ancestors:
+                    stack.pop()
+                    continue
+                pending = [p for p in parents.get(node, ()) if p not in ancestors and p not in stack]
+                if len(pending) > 0:
+                    stack.extend(pending)
+                    continue
+                stack.pop()
+                anc = { node: 0 }
+                for p in parents.get(node, ()):
+                    for a, gens in ancestors.get(p, {}).items():
+                        if a not in anc or gens + 1 < anc[a]:
+                            anc[a] = gens + 1
+                ancestors[node] = anc
+
+        return _Index(people, parents, spouses, ancestors)
+
+    def invalidate(self, entries: Optional[List[DBEntry]] = None) -> None:
+        """Commit hook for DBConnect: marks the index as out of date so
+        that it is rebuilt on the next query."""
+        self._stale = True
+
+    def _ensure_fresh(self) -> _Index:
+        # while the index is being rebuilt, other queries carry on with
+        # the previous one, unless there isn't one yet
+        if self._stale or self._index is None:
+            with self._lock:
+                if self._stale or self._index is None:
+                    self.build()
+        return self._index
+
+    def _blood(self, index: _Index, a: str, b: str) -> Optional[Tuple[int, int, List[str], bool]]:
+        # finds the closest common ancestors of a and b (either of whom
+        # may be the ancestor); returns the generations from a and b up
+        # to them, the ancestors, and whether a and b are only half
+        # related, or None if they have no common ancestor
+        anc_a = index.ancestors.get(a, {})
+        anc_b = index.ancestors.get(b, {})
+        if len(anc_b) < len(anc_a):
+            common = [c for c in anc_b if c in anc_a]
+        else:
+            common = [c for c in anc_a if c in anc_b]
+        if len(common) == 0:
+            return None
+
+        best = min([anc_a[c] + anc_b[c] for c in common])
+        closest = sorted([c for c in common if anc_a[c] + anc_b[c] == best],
+            key=lambda c: (anc_a[c], c))
+        up, down = anc_a[closest[0]], anc_b[closest[0]]
+        closest = [c for c in closest if anc_a[c] == up]
+
+        # half relatives descend from different children of just one of
+        # the closest ancestors, who each have two known parents
+        half = False
+        if up > 0 and down > 0 and len(closest) == 1:
+            lca = closest[0]
+            side_a = self._child_towards(index, lca, a, up)
+            side_b = self._child_towards(index, lca, b, down)
+            if side_a is not None and side_b is not None:
+                parents_a = index.parents.get(side_a, set())
+                parents_b = index.parents.get(side_b, set())
+                half = len(parents_a) == 2 and len(parents_b) == 2 and parents_a != parents_b
+        return (up, down, closest, half)
+
+    def _child_towards(self, index: _Index, ancestor: str, person: str, gens: int) -> Optional[str]:
+        # the child of `ancestor` that `person` descends from
+        anc = index.ancestors.get(person, {})
+        for c, g in anc.items():
+            if g == gens - 1 and ancestor in index.parents.get(c, ()):
+                return c
+        return None
+
+    def relate(self, a: str, b: str) -> Optional[Dict[str, Any]]:
+        """Describes how person B is related to person A, by blood or
+        else by marriage (e.g., "brother-in-law" or "wife of first
+        cousin"). Returns None if either person doesn't exist."""
+        index = self._ensure_fresh()
+        if a not in index.people or b not in index.people:
+            return None
+        gender = index.people[b].get("gender")
+        gender = gender.strip() if gender is not None else None
+
+        out = { "a": a, "b": b, "relationship": None, "common_ancestors": [],
+                "generations": None, "spouse": None }
+        blood = self._blood(index, a, b)
+        if blood is not None:
+            up, down, closest, half = blood
+            out["relationship"] = name_relationship(up, down, gender, half)
+            out["common_ancestors"] = closest
+            out["generations"] = [up, down]
+            return out
+
+        if b in index.spouses.get(a, []):
+            out["relationship"] = _term("spouse", gender)
+            return out
+
+        # B is a blood relative of A's spouse
+        for s in index.spouses.get(a, []):
+            rel = self._blood(index, s, b)
+            if rel is None:
+                continue
+            up, down, closest, half = rel
+            name = name_relationship(up, down, gender, half)
+            if (up, down) in [(1, 0), (1, 1)]:
+                name = f"{name}-in-law"
+            elif (up, down) == (0, 1):
+                name = "step" + name
+            else:
+                name = f"spouse's {name}"
+            out.update({ "relationship": name, "common_ancestors": closest,
+                "generations": [up, down], "spouse": s })
+            return out
+
+        # B is married to a blood relative of A
+        for s in index.spouses.get(b, []):
+            rel = self._blood(index, a, s)
+            if rel is None:
+                continue
+            up, down, closest, half = rel
+            if (up, down) == (1, 1):
+                name = _term("sibling", gender) + "-in-law"
+            elif (up, down) == (0, 1):
+                name = _term("child", gender) + "-in-law"
+            elif (up, down) == (1, 0):
+                name = "step" + _term("parent", gender)
+            else:
+                spouse_gender = index.people[s].get("gender")
+                spouse_gender = spouse_gender.strip() if spouse_gender is not None else None
+                name = f"{_term('spouse', gender)} of {name_relationship(up, down, spouse_gender, half)}"
+            out.update({ "relationship": name, "common_ancestors": closest,
+                "generations": [up, down], "spouse": s })
+            return out
+        return out
@@ -0,0 +1,131 @@
+from bisect import bisect_left, insort
+import re
+import threading
+import unicodedata
+from typing import Any, Dict, List, Optional
+
+from db import DBConnect, DBEntry, DBEntryType
+import utils
+
+NAME_COLS = ["first_name", "nickname", "middle_name1", "middle_name2", "last_name"]
+
+
+def normalize_tokens(text: str) -> List[str]:
+    """Splits text into lowercase word tokens with accents removed, so
+    e.g. "Zoë O'Neil" becomes ["zoe", "o", "neil"]."""
+    text = unicodedata.normalize("NFKD", text)
+    text = "".join([c for c in text if not unicodedata.combining(c)])
+    return re.findall(r"\w+", text.lower())
+
+
+class NameIndex():
+    """In-memory inverted index from normalized name tokens (first,
+    nickname, middle, and last names) to people, for answering
+    as-you-type name suggestions without querying the database. Each
+    indexed person carries their precomputed display name and life span.
+
+    The token list is kept sorted, so all tokens starting with a prefix
+    can be found with a binary search.
+    """
+    def __init__(self, db: DBConnect) -> None:
+        self.db = db
+        self._lock = threading.Lock()
+        self._stale = True
+        self._tokens = []
+        self._postings = {}
+        self._people = {}
+
+    def build(self) -> None:
+        """Indexes everyone in the people table from scratch."""
+        people = self.db.get_all_people()
+        with self._lock:
+            self._tokens = []
+            self._postings = {}
+            self._people = {}
+            for p in people:
+                self._add(p)
+            self._stale = False
+
+    def update(self, entries: Optional[List[DBEntry]] = None) -> None:
+        """Commit hook for DBConnect: reindexes the people that were
+        added or changed, or marks the whole index as stale if the
+        entries are unknown."""
+        if entries is None:
+            self._stale = True
+            return
+        pids = { e.data["id"] for e in entries if e.type is DBEntryType.PERSON }
+        if self._stale or len(pids) == 0:
+            return
+
+        people = [self.db.get_person(pid) for pid in pids]
+        with self._lock:
+            for pid in pids:
+                self._remove(pid)
+            for p in people:
+                if p is not None:
+                    self._add(p)
+
+    def _add(self, person: Dict[str, Any]) -> None:
+        # must be called with the lock held
+        tokens = set()
+        for col in NAME_COLS:
+            if utils.is_attr(person, col):
+                tokens.update(normalize_tokens(person[col]))
+
+        derived = utils.get_derived_fields(person)
+        self._people[person["id"]] = {
+            "id": person["id"],
+            "display_name": derived["display_name"],
+            "life_span": derived["life_span"],
+            "tokens": tokens,
+            "sort_key": utils.birthdate_sorter(person)
+        }
+        for token in tokens:
+            postings = self._postings.get(token)
+            if postings is None:
+                self._postings[token] = postings = set()
+                insort(self._tokens, token)
+            postings.add(person["id"])
+
+    def _remove(self, pid: str) -> None:
+        # must be called with the lock held
+        person = self._people.pop(pid, None)
+        if person is None:
+            return
+        for token in person["tokens"]:
+            postings = self._postings[token]
+            postings.discard(pid)
+            if len(postings) == 0:
+                del self._postings[token]
+                del self._tokens[bisect_left(self._tokens, token)]
+
+    def suggest(self, query: str, limit: int = 10) -> List[Dict[str, Any]]:
+        """Returns up to `limit` people with a name token starting with
+        each of the words in the query. People whose names contain the
+        words exactly are listed first, and then in order of birth."""
+        if self._stale:
+            self.build()
+
+        terms = normalize_tokens(query)
+        if len(terms) == 0:
+            return []
+
+        with self._lock:
+            matches = None
+            for term in terms:
+                found = set()
+                i = bisect_left(self._tokens, term)
+                while i < len(self._tokens) and self._tokens[i].startswith(term):
+                    found.update(self._postings[self._tokens[i]])
+                    i += 1
+                matches = found if matches is None else matches & found
+                if len(matches) == 0:
+                    return []
+
+            people = [self._people[pid] for pid in matches]
+
+        def rank(p):
+            exact = sum([1 for t in terms if t in p["tokens"]])
+            return (-exact, p["sort_key"])
+        people = sorted(people, key=rank)[:limit]
+        return [{ k: p[k] for k in ("id", "display_name", "life_span") } for p in people]
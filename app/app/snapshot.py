@@ -0,0 +1,518 @@
+from datetime import date
+import fcntl
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from db import CHILDREN_COLS, ChildLink, DBConnect, DBEntry, Marriage, MARRIAGE_COLS, Person, PERSON_COLS, Record, _year, place_key
+
+# SQLite hands back BOOLEAN columns as integers unless told otherwise
+sqlite3.register_converter("BOOLEAN", lambda v: v == b"1")
+
+SCHEMA = """
+    CREATE TABLE people (
+        id TEXT PRIMARY KEY, print_id TEXT, in_tree BOOLEAN,
+        first_name TEXT, nickname TEXT, middle_name1 TEXT,
+        middle_name2 TEXT, last_name TEXT, pref_name TEXT, gender TEXT,
+        birth_month TEXT, birth_day INTEGER, birth_year TEXT,
+        birth_place TEXT, death_month TEXT, death_day INTEGER,
+        death_year TEXT, death_place TEXT, buried TEXT,
+        additional_notes TEXT,
+        names TEXT, birth_place_key TEXT, death_place_key TEXT,
+        birth_from TEXT, birth_to TEXT, death_from TEXT, death_to TEXT,
+        birth_decade INTEGER
+    );
+    CREATE TABLE marriages (
+        id INTEGER PRIMARY KEY, pid1 TEXT, pid2 TEXT,
+        marriage_order INTEGER, married_month TEXT, married_day INTEGER,
+        married_year TEXT, married_place TEXT, common_law BOOLEAN,
+        divorced BOOLEAN, divorced_month TEXT, divorced_day INTEGER,
+        divorced_year TEXT,
+        married_from TEXT, married_to TEXT
+    );
+    CREATE TABLE children (
+        id INTEGER PRIMARY KEY, pid TEXT, cid TEXT, birth_order INTEGER,
+        adoptive BOOLEAN
+    );
+    CREATE TABLE ancestry (
+        ancestor_id TEXT, descendant_id TEXT, depth INTEGER,
+        PRIMARY KEY (ancestor_id, descendant_id)
+    ) WITHOUT ROWID;
+    CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT);
+"""
+
+INDEXES = """
+    CREATE INDEX people_birth_place_key ON people (birth_place_key);
+    CREATE INDEX people_death_place_key ON people (death_place_key);
+    CREATE INDEX marriages_pid1 ON marriages (pid1);
+    CREATE INDEX marriages_pid2 ON marriages (pid2);
+    CREATE INDEX children_pid ON children (pid);
+    CREATE INDEX children_cid ON children (cid);
+    CREATE INDEX ancestry_descendant ON ancestry (descendant_id, depth);
+    CREATE VIRTUAL TABLE people_names USING fts5(names, id UNINDEXED, tokenize = 'trigram');
+    INSERT INTO people_names (names, id) SELECT names, id FROM people;
+"""
+
+# how much of the snapshot file is memory-mapped, in bytes
+MMAP_SIZE = 256 * 1024 * 1024
+
+# stand-ins for the open ends of the date ranges
+MIN_DATE = "0001-01-01"
+MAX_DATE = "9999-12-31"
+
+
+def _trigrams(text: str) -> List[str]:
+    # the trigrams of each word in order, made the same way as in
+    # pg_trgm: words are runs of letters and digits, lowercased, with
+    # two spaces added in front and one behind
+    out = []
+    for word in re.findall(r"[^\W_]+", text.lower()):
+        padded = f"  {word} "
+        out.extend(padded[i:i+3] for i in range(len(padded) - 2))
+    return out
+
+
+def word_similarity(a: str, b: Optional[str]) -> float:
+    """Same as pg_trgm's word_similarity(): the greatest similarity
+    between the set of trigrams in `a` and the set of trigrams in any
+    run of consecutive trigrams in `b`."""
+    target = set(_trigrams(a))
+    if len(target) == 0 or b is None:
+        return 0.0
+    grams = _trigrams(b)
+    best = 0.0
+    for start in range(len(grams)):
+        # the best runs start and end on a trigram found in `a`
+        if grams[start] not in target:
+            continue
+        seen = set()
+        for gram in grams[start:]:
+            seen.add(gram)
+            if gram in target:
+                found = len(seen & target)
+                best = max(best, found / (len(target) + len(seen) - found))
+    return best
+
+
+def write_snapshot(db: DBConnect, path: str) -> None:
+    """Copies the data from the database into a new SQLite file, which
+    then replaces the file at `path` in one step: readers that already
+    have the old file open carry on with it, and SnapshotReader opens
+    the new one on its next refresh(). Each worker writes a snapshot
+    after its own changes, so the writes are serialized with a lock
+    file next to the snapshot; the last one to finish has read the
+    latest data."""
+    out_dir = os.path.dirname(os.path.abspath(path))
+    tmp_path = os.path.join(out_dir, f".{os.path.basename(path)}.tmp")
+    with open(os.path.join(out_dir, f".{os.path.basename(path)}.lock"), "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        conn = sqlite3.connect(tmp_path)
+        try:
+            conn.executescript(SCHEMA)
+            for table in ["people", "marriages", "children", "ancestry"]:
+                cols, rows = db.get_snapshot_rows(table)
+                conn.executemany(f"INSERT INTO {table} ({', '.join(cols)}) VALUES ({', '.join(['?'] * len(cols))})", rows)
+            conn.executescript(INDEXES)
+            conn.execute("INSERT INTO meta VALUES ('written', ?)", (time.strftime("%Y-%m-%dT%H:%M:%S"),))
+            conn.commit()
+        finally:
+            conn.close()
+        os.replace(tmp_path, path)
+
+
+class SnapshotWriter():
+    """Rewrites the snapshot after each change, on a background thread,
+    so the public site catches up moments after an edit. The write
+    hooks are called after each new snapshot is in place, with the
+    entries it took in (or None if these are unknown), for anything
+    that renders from the snapshot, e.g. the static pages.
+    """
+    def __init__(self, db: DBConnect, path: str) -> None:
+        self.db = db
+        self.path = path
+        self.write_hooks = []
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pending = None
+        self._queued = False
+
+    def add_write_hook(self, hook: Callable[[Optional[List[DBEntry]]], None]) -> None:
+        self.write_hooks.append(hook)
+
+    def write(self) -> None:
+        """Writes a new snapshot right away."""
+        try:
+            write_snapshot(self.db, self.path)
+        finally:
+            self.db.release()
+
+    def update(self, entries: Optional[List[DBEntry]] = None) -> None:
+        """Commit hook for DBConnect: queues a new snapshot to be
+        written in the background."""
+        with self._lock:
+            if not self._queued:
+                self._queued = True
+                self._pending = [] if entries is not None else None
+            if self._pending is not None:
+                if entries is None:
+                    self._pending = None
+                else:
+                    self._pending.extend(entries)
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+
+    def _run(self) -> None:
+        # keeps going until no more changes have come in while writing
+        while True:
+            with self._lock:
+                if not self._queued:
+                    self._thread = None
+                    return
+                entries = self._pending
+                self._queued, self._pending = False, None
+            try:
+                self.write()
+            except Exception:
+                logging.getLogger(__name__).exception("Failed to write the snapshot")
+                continue
+            for hook in self.write_hooks:
+                hook(entries)
+
+
+class SnapshotReader():
+    """Read-only access to a snapshot written by write_snapshot(), with
+    the same read methods as DBConnect used by the public pages (person
+    pages, trees, and searches), so that they can be served without
+    Postgres, e.g. from a replica given a copy of the file.
+
+    Each thread has its own connection. refresh() checks whether the
+    file has been replaced since it was opened; if it has, connections
+    are reopened on their next use and the swap hooks are called (with
+    None, as the changes aren't known) so that anything holding a copy
+    of the data can drop it.
+    """
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.swap_hooks = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._version = self._file_version()
+
+    def add_swap_hook(self, hook: Callable[[Optional[List[DBEntry]]], None]) -> None:
+        self.swap_hooks.append(hook)
+
+    def _file_version(self) -> Optional[Tuple[int, int]]:
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return (st.st_ino, st.st_mtime_ns)
+
+    def refresh(self) -> bool:
+        """Switches to a new snapshot, if one has been written. Returns
+        True if it has."""
+        version = self._file_version()
+        if version == self._version:
+            return False
+        with self._lock:
+            if version == self._version:
+                return False
+            self._version = version
+        for hook in self.swap_hooks:
+            hook(None)
+        return True
+
+    def _conn(self) -> sqlite3.Connection:
+        local = self._local
+        if getattr(local, "version", None) != self._version:
+            if getattr(local, "conn", None) is not None:
+                local.conn.close()
+            local.conn = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True,
+                detect_types=sqlite3.PARSE_DECLTYPES, check_same_thread=False)
+            local.conn.create_function("word_similarity", 2, word_similarity, deterministic=True)
+            # reads go through a memory map of the file, so that every
+            # process shares the operating system's copy of it
+            local.conn.execute(f"PRAGMA mmap_size = {MMAP_SIZE}")
+            local.version = self._version
+        return local.conn
+
+    def close(self) -> None:
+        """Closes this thread's connection, e.g. so that it is not
+        shared with forked worker processes."""
+        if getattr(self._local, "conn", None) is not None:
+            self._local.conn.close()
+        self._local.conn = None
+        self._local.version = None
+
+    def _query(self, query: str, params: Any = ()) -> List[Dict[str, Any]]:
+        cursor = self._conn().execute(query, params)
+        cols = [d[0] for d in cursor.description]
+        return [dict(zip(cols, row)) for row in cursor.fetchall()]
+
+    def _records(self, cls: type, query: str, params: Any = ()) -> List[Record]:
+        # the query must select the record's columns, in order
+        return [cls.from_row(row) for row in self._conn().execute(query, params).fetchall()]
+
+    def _people(self, alias: str = "p") -> str:
+        return ", ".join(f"{alias}.{c}" for c in PERSON_COLS)
+
+    def get_person(self, pid: str) -> Optional[Person]:
+        rows = self._records(Person, f"SELECT {self._people()} FROM people p WHERE id = ?", (pid,))
+        return rows[0] if len(rows) > 0 else None
+
+    def get_parents(self, pid: str) -> List[Dict[str, Any]]:
+        return self._query(f"""
+            SELECT {self._people()}, c.adoptive, c.id AS row_id
+            FROM children c
+            INNER JOIN people p ON c.pid = p.id
+            WHERE c.cid = ?
+            ORDER BY c.id""", (pid,))
+
+    def get_children(self, pid1: str, pid2: str) -> List[Person]:
+        # unknown birth orders sort last, as in Postgres
+        return self._records(Person, f"""
+            SELECT {self._people()}
+            FROM (
+                SELECT DISTINCT a.cid, a.birth_order
+                FROM children a
+                INNER JOIN children b ON a.cid = b.cid
+                WHERE a.pid = ? AND b.pid = ?
+            ) c
+            INNER JOIN people p ON c.cid = p.id
+            ORDER BY c.birth_order IS NULL, c.birth_order""", (pid1, pid2))
+
+    def get_marriages(self, pid: str) -> List[Dict[str, Record]]:
+        marriage_cols = ", ".join(f"m.{c} AS m_{c}" for c in MARRIAGE_COLS)
+        rows = self._query(f"""
+            SELECT {self._people()}, {marriage_cols}
+            FROM marriages m
+            INNER JOIN people p ON p.id = CASE WHEN m.pid1 = ? THEN m.pid2 ELSE m.pid1 END
+            WHERE m.pid1 = ? OR m.pid2 = ?
+            ORDER BY m.marriage_order IS NULL, m.marriage_order, m.id""", (pid, pid, pid))
+        return [{
+            "marriage": Marriage.from_row([r[f"m_{c}"] for c in MARRIAGE_COLS]),
+            "spouse": Person.from_row([r[c] for c in PERSON_COLS])
+        } for r in rows]
+
+    def get_family(self, pid: str) -> Optional[Dict[str, Any]]:
+        """Returns the same bundle as DBConnect.get_family(): the focal
+        person, their parents, siblings, and marriages (each with the
+        spouse and children)."""
+        focal = self.get_person(pid)
+        if focal is None:
+            return None
+
+        siblings = self._query(f"""
+            SELECT
+                {self._people()},
+                json_group_array(DISTINCT s.pid) AS parent_ids,
+                MIN(s.birth_order) AS birth_order
+            FROM children s
+            INNER JOIN people p ON s.cid = p.id
+            WHERE s.pid IN (SELECT pid FROM children WHERE cid = ?)
+            GROUP BY s.cid
+            ORDER BY MIN(s.birth_order) IS NULL, MIN(s.birth_order), MIN(s.id)""", (pid,))
+
+        # plain dicts from here on, as from DBConnect.get_family()
+        marriages = []
+        for m in self.get_marriages(pid):
+            marriages.append({
+                "marriage": m["marriage"].to_dict(),
+                "spouse": m["spouse"].to_dict(),
+                "children": [c.to_dict() for c in self.get_children(pid, m["spouse"]["id"])]
+            })
+
+        return {
+            "focal": focal.to_dict(),
+            "parents": self.get_parents(pid),
+            "siblings": [{
+                "person": { c: s[c] for c in PERSON_COLS },
+                "parent_ids": json.loads(s["parent_ids"]),
+                "birth_order": s["birth_order"]
+            } for s in siblings],
+            "marriages": marriages
+        }
+
+    def get_lineage(self, pid: str, direction: str, depth: int, max_nodes: int) -> Optional[Dict[str, Any]]:
+        """Returns the same bundle as DBConnect.get_lineage(), using the
+        ancestry table in the same way."""
+        if direction == "ancestors":
+            step, follow, joiner = "descendant", "ancestor", "AND"
+        elif direction == "descendants":
+            step, follow, joiner = "ancestor", "descendant", "OR"
+        else:
+            raise ValueError
+        if self.get_person(pid) is None:
+            return None
+
+        all_nodes = self._query(f"""
+            SELECT {follow}_id AS id, depth
+            FROM ancestry
+            WHERE {step}_id = ? AND depth <= ?
+            ORDER BY depth, id""", (pid, depth))
+        truncated = len(all_nodes) + 1 > max_nodes
+        depths = { pid: 0 }
+        for n in all_nodes[:max(max_nodes - 1, 0)]:
+            depths[n["id"]] = n["depth"]
+        if max_nodes < 1:
+            depths = {}
+
+        conn = self._conn()
+        conn.execute("CREATE TEMP TABLE IF NOT EXISTS lineage_nodes (id TEXT PRIMARY KEY)")
+        conn.execute("DELETE FROM lineage_nodes")
+        conn.executemany("INSERT INTO lineage_nodes VALUES (?)", [(n,) for n in depths])
+        marriages = self._query(f"""
+            SELECT {', '.join(MARRIAGE_COLS)}
+            FROM marriages
+            WHERE pid1 IN lineage_nodes {joiner} pid2 IN lineage_nodes
+            ORDER BY marriage_order IS NULL, marriage_order, id""")
+        children = self._query(f"""
+            SELECT {', '.join(CHILDREN_COLS)}
+            FROM children
+            WHERE cid IN lineage_nodes
+                AND (pid IN lineage_nodes
+                    OR pid IN (SELECT pid1 FROM marriages WHERE pid1 IN lineage_nodes {joiner} pid2 IN lineage_nodes)
+                    OR pid IN (SELECT pid2 FROM marriages WHERE pid1 IN lineage_nodes {joiner} pid2 IN lineage_nodes))
+            ORDER BY id""")
+        people = self._query(f"""
+            SELECT {self._people()}
+            FROM people p
+            WHERE p.id IN lineage_nodes
+                OR p.id IN (SELECT pid1 FROM marriages WHERE pid1 IN lineage_nodes {joiner} pid2 IN lineage_nodes)
+                OR p.id IN (SELECT pid2 FROM marriages WHERE pid1 IN lineage_nodes {joiner} pid2 IN lineage_nodes)""")
+        conn.execute("DELETE FROM lineage_nodes")
+        return {
+            "depths": depths,
+            "people": { p["id"]: p for p in people },
+            "children": children,
+            "marriages": marriages,
+            "truncated": truncated
+        }
+
+    def get_lineage_counts(self, pid: str) -> Dict[str, int]:
+        row = self._conn().execute("""
+            SELECT
+                (SELECT count(*) FROM ancestry WHERE descendant_id = :pid),
+                (SELECT count(*) FROM ancestry WHERE ancestor_id = :pid),
+                (SELECT COALESCE(MAX(depth), 0) FROM ancestry WHERE descendant_id = :pid)""",
+            { "pid": pid }).fetchone()
+        return { "ancestors": row[0], "descendants": row[1], "generation": row[2] }
+
+    def get_all_people(self) -> List[Person]:
+        return self._records(Person, f"SELECT {self._people()} FROM people p")
+
+    def get_all_marriages(self) -> List[Marriage]:
+        return self._records(Marriage, f"SELECT {', '.join(MARRIAGE_COLS)} FROM marriages")
+
+    def get_all_children(self) -> List[ChildLink]:
+        return self._records(ChildLink, f"SELECT {', '.join(CHILDREN_COLS)} FROM children")
+
+    def search_name(self, search_terms: List[str]) -> List[Dict[str, Any]]:
+        # the same matching and ranking as DBConnect.search_name(), with
+        # the substring matches found through the trigram index on names
+        terms = [t.lower() for t in search_terms]
+        if len(terms) == 0:
+            return []
+        match_stmt = " AND ".join(["names LIKE ?"] * len(terms))
+        rank_stmt = " + ".join(["word_similarity(?, p.names)"] * len(terms))
+        return self._query(f"""
+            SELECT {self._people()}, {rank_stmt} AS rank
+            FROM people p
+            WHERE p.id IN (SELECT id FROM people_names WHERE {match_stmt})
+            ORDER BY rank DESC""", terms + [f"%{t}%" for t in terms])
+
+    def search_advanced(self, search_terms: Dict[str, Any]) -> Tuple[List[Dict[str, Any]], Dict[str, List[Dict[str, Any]]]]:
+        # the same filters and facets as DBConnect.search_advanced();
+        # the date ranges are stored as their first and last days
+        term_names = ["first_name", "nickname", "last_name"]
+        term_places = ["birth_place", "death_place"]
+        term_contains = ["buried", "additional_notes"]
+        term_exact = ["birth_day", "birth_month", "death_day", "death_month"]
+        term_years = { "birth_year": "birth", "death_year": "death" }
+        overlaps = "{0}_from IS NOT NULL AND {0}_from <= ? AND {0}_to >= ?"
+
+        match_stmts = []
+        terms = []
+        for col, term in search_terms.items():
+            if term != "":
+                if col == "middle_name":
+                    match_stmts.append("(middle_name1 LIKE ? OR middle_name2 LIKE ?) AND id IN (SELECT id FROM people_names WHERE names LIKE ?)")
+                    terms += [f"%{term}%", f"%{term}%", f"%{term.lower()}%"]
+                elif col in term_names:
+                    match_stmts.append(f"{col} LIKE ? AND id IN (SELECT id FROM people_names WHERE names LIKE ?)")
+                    terms += [f"%{term}%", f"%{term.lower()}%"]
+                elif col in term_places:
+                    match_stmts.append(f"{col}_key LIKE ?")
+                    terms.append(f"%{place_key(term)}%")
+                elif col in (f"{c}_key" for c in term_places):
+                    match_stmts.append(f"{col} = ?")
+                    terms.append(term)
+                elif col in term_contains:
+                    match_stmts.append(f"{col} LIKE ?")
+                    terms.append(f"%{term}%")
+                elif col in term_exact:
+                    match_stmts.append(f"{col} = ?")
+                    terms.append(term)
+                elif col in term_years:
+                    if _year(term) is not None:
+                        match_stmts.append(overlaps.format(term_years[col]))
+                        terms += [date(_year(term), 12, 31).isoformat(), date(_year(term), 1, 1).isoformat()]
+                    else:
+                        match_stmts.append(f"{col} = ?")
+                        terms.append(term)
+                elif col == "birth_decade" and _year(term) is not None:
+                    match_stmts.append("birth_decade = ?")
+                    terms.append(_year(term))
+
+        # ranges given as "<prefix>_from" and/or "<prefix>_to" years
+        for prefix, col in { "born": "birth", "died": "death", "married": "married" }.items():
+            year_from = _year(search_terms.get(f"{prefix}_from"))
+            year_to = _year(search_terms.get(f"{prefix}_to"))
+            if year_from is None and year_to is None:
+                continue
+            bounds = [
+                date(year_to, 12, 31).isoformat() if year_to is not None else MAX_DATE,
+                date(year_from, 1, 1).isoformat() if year_from is not None else MIN_DATE
+            ]
+            if prefix == "married":
+                match_stmts.append(f"""id IN (
+                    SELECT pid1 FROM marriages WHERE {overlaps.format(col)}
+                    UNION
+                    SELECT pid2 FROM marriages WHERE {overlaps.format(col)})""")
+                terms += bounds + bounds
+            else:
+                match_stmts.append(overlaps.format(col))
+                terms += bounds
+
+        match_stmt = " AND ".join(match_stmts)
+        if len(match_stmt) == 0:
+            return [], {}
+
+        conn = self._conn()
+        conn.execute("CREATE TEMP TABLE IF NOT EXISTS search_results (id TEXT PRIMARY KEY)")
+        conn.execute("DELETE FROM search_results")
+        conn.execute(f"INSERT INTO search_results SELECT id FROM people WHERE {match_stmt}", terms)
+        results = self._query(f"SELECT {self._people()} FROM people p WHERE id IN search_results")
+        decades = self._query("""
+            SELECT birth_decade AS decade, COUNT(*) AS count
+            FROM people
+            WHERE id IN search_results AND birth_decade IS NOT NULL
+            GROUP BY 1
+            ORDER BY 1""")
+        birth_places = self._query("""
+            SELECT birth_place_key AS key, MIN(birth_place) AS place, COUNT(*) AS count
+            FROM people
+            WHERE id IN search_results AND birth_place_key <> ''
+            GROUP BY 1
+            ORDER BY 3 DESC, 1
+            LIMIT 15""")
+        conn.execute("DELETE FROM search_results")
+        return results, { "decades": decades, "birth_places": birth_places }
@@ -0,0 +1,45 @@
+// as-you-type name suggestions for the search box on the home page
+(function() {
+    let input = document.getElementById("search");
+    let list = document.getElementById("search_suggestions");
+    if (input === null || list === null) {
+        return;
+    }
+
+    let timer = null;
+    let latest = 0;
+
+    function showSuggestions(results) {
+        list.innerHTML = "";
+        results.forEach(function(r) {
+            let item = document.createElement("li");
+            let link = document.createElement("a");
+            link.href = r.url;
+            // display names come from our own data, and may contain
+            // <u> tags marking the preferred name
+            link.innerHTML = r.display_name + " " + r.life_span;
+            item.appendChild(link);
+            list.appendChild(item);
+        });
+    }
+
+    input.addEventListener("input", function() {
+        clearTimeout(timer);
+        let query = input.value.trim();
+        if (query.length < 2) {
+            showSuggestions([]);
+            return;
+        }
+        timer = setTimeout(function() {
+            // ignore responses that arrive after a newer request was sent
+            let request_num = ++latest;
+            fetch(input.dataset.suggestUrl + "?q=" + encodeURIComponent(query))
+                .then(function(response) { return response.json(); })
+                .then(function(results) {
+                    if (request_num === latest) {
+                        showSuggestions(results);
+                    }
+                });
+        }, 100);
+    });
+})();
@@ -19,6 +19,12 @@ if (typeof tree_nodeWidth === "undefined") {
     tree_nodeWidth = 170;
 }
 
+// nodes in tree_data, looked up by the `extra` object that dTree passes
+// back to its callbacks, so that clicked nodes can be expanded
+let tree_nodes = new WeakMap();
+// dTree's ID for the node drawn for each `extra` object
+let tree_node_ids = new WeakMap();
+
 tree_options = {
     target: ".treegraph",
     debug: true,
@@ -37,6 +43,9 @@ tree_options = {
             return text;
         },
         nodeRenderer: function(name, x, y, height, width, extra, id, nodeClass, textClass, textRenderer) {
+            if (extra) {
+                tree_node_ids.set(extra, id);
+            }
             focal_class = ""
             if (textClass == "emphasis") {
                 focal_class = " node_focal"
@@ -46,12 +55,94 @@ tree_options = {
             node += textRenderer(name, extra, textClass);
             node += '</div>';
             return node;
+        },
+        nodeClick: function(name, extra, id) {
+            // the name links to the person's page; clicking elsewhere on
+            // the node loads more of the tree around them
+            if (d3.event && d3.event.target.tagName === "A") {
+                return;
+            }
+            expandNode(extra);
         }
     }
 };
 
-docReady(function() {
+// records each person in the tree data, and whether the generations
+// above and below them have been loaded
+function indexTree(people, is_root) {
+    people.forEach(function(person) {
+        tree_nodes.set(person.extra, {
+            person: person,
+            spouse: false,
+            expanded_down: person.marriages !== undefined,
+            expanded_up: !is_root
+        });
+        indexMarriages(person.marriages || []);
+        indexTree(person.children || [], false);
+    });
+}
+
+function indexMarriages(marriages) {
+    marriages.forEach(function(m) {
+        // dTree can't draw the relatives of spouses
+        tree_nodes.set(m.spouse.extra, { person: m.spouse, spouse: true });
+        indexTree(m.children || [], false);
+    });
+}
+
+function drawTree(zoom_extra) {
+    document.querySelector(tree_options.target).innerHTML = "";
     tree = dTree.init(tree_data, tree_options);
+    if (zoom_extra !== undefined && tree_node_ids.has(zoom_extra)) {
+        tree.zoomToNode(tree_node_ids.get(zoom_extra), 1, 0);
+    }
+}
+
+// fetches the person's marriages, children, parents, and siblings, and
+// adds whichever of them aren't in the tree yet
+function expandNode(extra) {
+    let info = tree_nodes.get(extra);
+    if (info === undefined || info.spouse || (info.expanded_down && info.expanded_up)) {
+        return;
+    }
+    fetch(extra.url + "/node")
+        .then(function(response) { return response.json(); })
+        .then(function(data) {
+            let person = info.person;
+            if (!info.expanded_down) {
+                person.marriages = data.node.marriages;
+                info.expanded_down = true;
+                indexMarriages(person.marriages);
+            }
+
+            let root_index = tree_data.indexOf(person);
+            if (!info.expanded_up && root_index >= 0 && data.parents.length > 0) {
+                // put the person in place among their siblings, below
+                // their parents
+                let siblings = data.siblings.slice();
+                if (data.position !== null) {
+                    siblings[data.position] = person;
+                } else {
+                    siblings.push(person);
+                }
+                let root = data.parents[0];
+                if (data.parents.length > 1) {
+                    root.marriages = [{ spouse: data.parents[1], children: siblings }];
+                } else {
+                    root.children = siblings;
+                }
+                tree_data[root_index] = root;
+                indexTree([root], true);
+                tree_nodes.get(root.extra).expanded_down = true;
+            }
+            info.expanded_up = true;
+            drawTree(extra);
+        });
+}
+
+docReady(function() {
+    indexTree(tree_data, true);
+    drawTree();
 
     // center graph on the focal node
     let focal_node = document.getElementsByClassName("node_focal")[0];
@@ -61,4 +152,4 @@ docReady(function() {
             // get just numeric value from ID
         tree.zoomToNode(focal_id, 1, 0);
     }
-});
\ No newline at end of file
+});
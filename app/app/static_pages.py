@@ -0,0 +1,169 @@
+import fcntl
+import json
+import os
+import threading
+from typing import Dict, Iterable, List, Optional
+
+from flask import Flask, g
+
+from db import DBConnect, DBEntry
+
+# pages rendered along with the person pages; their content doesn't
+# come from the database
+CONTENT_PAGES = ["/in-memoriam", "/preface", "/numbering", "/maps", "/technical-details"]
+
+
+class StaticPages():
+    """Renders the person pages (including the extended ones) and the
+    content pages to HTML files under `out_dir`, for nginx to serve
+    directly with `try_files $uri.html`, so that most public requests
+    never reach the app. E.g., the page for /p/1.2 is written to
+    <out_dir>/p/1.2.html.
+
+    As with the page cache, each page is recorded along with the IDs of
+    the people shown on it (from `g.page_person_ids`). After a change,
+    the commit hook re-renders the pages showing anyone it touched, on
+    a background thread. The record is kept in a file next to the pages,
+    since the change may be made in a different process (e.g., uWSGI
+    worker) than the one that rendered them, and a lock file keeps two
+    processes from rendering at once.
+    """
+    def __init__(self, app: Flask, db: DBConnect, out_dir: str, base_url: Optional[str] = None) -> None:
+        self.app = app
+        self.db = db
+        self.out_dir = os.path.abspath(out_dir)
+        # the scheme and host the pages are served from, for the few
+        # absolute URLs in the templates
+        self.base_url = base_url
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pending = set()
+        self._pending_all = False
+
+    def _index_path(self) -> str:
+        return os.path.join(self.out_dir, ".pages.json")
+
+    def _read_index(self) -> Dict[str, List[str]]:
+        # path -> IDs of the people shown on the page
+        try:
+            with open(self._index_path()) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def _write_index(self, pages: Dict[str, List[str]]) -> None:
+        tmp_path = self._index_path() + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(pages, f)
+        os.replace(tmp_path, self._index_path())
+
+    def _filename(self, path: str) -> Optional[str]:
+        # the file for the page at `path`, or None if the path would
+        # end up outside of the output directory
+        filename = os.path.abspath(os.path.join(self.out_dir, path.lstrip("/") + ".html"))
+        if not filename.startswith(self.out_dir + os.sep) or os.path.basename(filename).startswith("."):
+            return None
+        return filename
+
+    def _render(self, paths: Iterable[str], pages: Dict[str, List[str]]) -> int:
+        # renders each page through the app, as an anonymous visitor
+        # would see it; pages that are no longer found, or that fail to
+        # render, are removed so that nginx passes them on to the app.
+        # Returns the number of pages written
+        written = 0
+        for path in paths:
+            filename = self._filename(path)
+            if filename is None:
+                continue
+            try:
+                with self.app.test_request_context(path, base_url=self.base_url):
+                    response = self.app.full_dispatch_request()
+                    person_ids = g.get("page_person_ids", ())
+            except Exception:
+                self.app.logger.exception(f"Failed to render {path}")
+                response = None
+
+            if response is None or response.status_code != 200:
+                pages.pop(path, None)
+                if os.path.exists(filename):
+                    os.remove(filename)
+                continue
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+            tmp_path = os.path.join(os.path.dirname(filename), f".{os.path.basename(filename)}.tmp")
+            with open(tmp_path, "wb") as f:
+                f.write(response.get_data())
+            os.replace(tmp_path, filename)
+            pages[path] = sorted(person_ids)
+            written += 1
+        return written
+
+    def _locked(self):
+        # an exclusive lock across processes, released when the
+        # returned file is closed
+        os.makedirs(self.out_dir, exist_ok=True)
+        lock_file = open(os.path.join(self.out_dir, ".lock"), "w")
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        return lock_file
+
+    def build(self) -> int:
+        """Renders every person page and content page, and removes the
+        pages of anyone no longer in the database. Returns the number of
+        pages written."""
+        people = self.db.get_all_people()
+        self.db.release()
+        paths = CONTENT_PAGES + [f"/p/{p['id']}" for p in people]
+        with self._locked():
+            pages = self._read_index()
+            for path in set(pages) - set(paths):
+                filename = self._filename(path)
+                if filename is not None and os.path.exists(filename):
+                    os.remove(filename)
+                del pages[path]
+            written = self._render(paths, pages)
+            self._write_index(pages)
+        return written
+
+    def render_people(self, person_ids: Iterable[str]) -> int:
+        """Re-renders the pages of the given people, and every page
+        showing any of them. Returns the number of pages written."""
+        person_ids = set(person_ids)
+        with self._locked():
+            pages = self._read_index()
+            paths = { f"/p/{pid}" for pid in person_ids }
+            paths.update(path for path, shown in pages.items() if not person_ids.isdisjoint(shown))
+            written = self._render(sorted(paths), pages)
+            self._write_index(pages)
+        return written
+
+    def update(self, entries: Optional[List[DBEntry]] = None) -> None:
+        """Commit hook for DBConnect: queues the pages affected by the
+        committed entries (or all of them, if the entries are unknown)
+        to be re-rendered in the background."""
+        with self._lock:
+            if entries is None:
+                self._pending_all = True
+            else:
+                for entry in entries:
+                    self._pending.update(entry.person_ids())
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+
+    def _run(self) -> None:
+        # keeps going until no more changes have come in while rendering
+        while True:
+            with self._lock:
+                if not self._pending_all and len(self._pending) == 0:
+                    self._thread = None
+                    return
+                render_all, person_ids = self._pending_all, self._pending
+                self._pending_all, self._pending = False, set()
+            try:
+                if render_all:
+                    self.build()
+                else:
+                    self.render_people(person_ids)
+            except Exception:
+                self.app.logger.exception("Failed to render static pages")
+            finally:
+                self.db.release()
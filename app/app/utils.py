@@ -1,15 +1,18 @@
-from datetime import datetime
+import calendar
+from datetime import date, datetime, MAXYEAR, MINYEAR
+from functools import lru_cache
 import os
-import shutil
-import tempfile
-from typing import Any, Dict, Optional, List, Tuple
+import re
+import zipfile
+from typing import Any, Callable, Dict, IO, NamedTuple, Optional, List, Tuple, Union
 from urllib.parse import urlparse, urljoin
 
 from flask import request, url_for
-from db import DBConnect
+from db import DataImportError, DBConnect, PERSON_COLS
 
 MONTHS = ["January", "February", "March", "April", "May", "June", "July",
           "August", "September", "October", "November", "December"]
+MONTH_NUMBERS = { m: i + 1 for i, m in enumerate(MONTHS) }
 GENDER_MAP = { "M": "man", "F": "woman" }
 CURR_YEAR = datetime.today().year
 
@@ -20,40 +23,86 @@ def is_attr(record: Dict[str, Any], attr: str) -> bool:
     else:
         return False
 
-def birthdate_sorter(record: Dict[str, Any]) -> Tuple[int, int, int]:
-    """Function for use in sorted(), to sort birthdates in chronological
-    order. Returns a tuple of (year, month, day).
+class FuzzyDate(NamedTuple):
+    """A date parsed from the free-text year, month, and day fields.
+    `year`, `month`, and `day` are the best reading of each part (None
+    if unknown), and `earliest` and `latest` bound the range of days
+    the date could fall on (None if unbounded, or the year is unknown).
     """
-    # in case of unknown values, 1000000 will ensure they are sorted
-    # to the end
-    year, month, day = (1000000, 1000000, 1000000)
-    if is_attr(record, "birth_year"):
+    year: Optional[int]
+    month: Optional[int]
+    day: Optional[int]
+    earliest: Optional[date]
+    latest: Optional[date]
+
+@lru_cache(maxsize=8192)
+def parse_fuzzy_date(year: Optional[str], month: Optional[str],
+                     day: Union[int, str, None]) -> FuzzyDate:
+    """Parses free-text date fields, e.g., ("1846 or 1847", "January",
+    21). Follows the same rules as the fuzzy_date_range() function in
+    the database: every 4-digit year mentioned is included in the range
+    (the first is taken as the best guess), a "?" widens it by a year
+    either way, a missing month or day spans the whole year or month,
+    and "after"/"before" leave one end open. Results are cached, so
+    repeated parsing of the same values is just a lookup."""
+    years = [int(y) for y in re.findall(r"\d{4}", year or "")]
+    if len(years) == 0:
+        return FuzzyDate(None, None, None, None, None)
+    first_year, last_year = min(years), max(years)
+    if "?" in year:
+        first_year -= 1
+        last_year += 1
+    # dates can only have years from 1 to 9999
+    best_year = min(max(years[0], MINYEAR), MAXYEAR)
+    first_year = min(max(first_year, MINYEAR), MAXYEAR)
+    last_year = min(max(last_year, MINYEAR), MAXYEAR)
+
+    month_num = MONTH_NUMBERS.get(month)
+
+    day_num = None
+    if day is not None and day != "" and month_num is not None:
         try:
-            # if year is integer, great
-            year = int(record["birth_year"])
+            day_num = int(day)
         except ValueError:
             try:
-                # this should handle cases like "1945?" and
-                # "1945 or 1946"
-                year = int(record["birth_year"][0:4])
-            except:
+                day_num = int(str(day)[0:2])
+            except ValueError:
                 pass
+        # e.g., February 30 is treated as an unknown day
+        if day_num is not None and not (1 <= day_num <= calendar.monthrange(best_year, month_num)[1]
+                                        and day_num <= calendar.monthrange(first_year, month_num)[1]
+                                        and day_num <= calendar.monthrange(last_year, month_num)[1]):
+            day_num = None
+
+    if month_num is None:
+        earliest = date(first_year, 1, 1)
+        latest = date(last_year, 12, 31)
+    elif day_num is None:
+        earliest = date(first_year, month_num, 1)
+        latest = date(last_year, month_num, calendar.monthrange(last_year, month_num)[1])
+    else:
+        earliest = date(first_year, month_num, day_num)
+        latest = date(last_year, month_num, day_num)
 
-    if is_attr(record, "birth_month"):
-        try:
-            month = MONTHS.index(record["birth_month"]) + 1
-        except:
-            pass
-    
-    if is_attr(record, "birth_day"):
-        try:
-            day = int(record["birth_day"])
-        except ValueError:
-            try:
-                day = int(record["birth_day"][0:2])
-            except:
-                pass
-    return (year, month, day)
+    if year.lower().startswith("after"):
+        latest = None
+    elif year.lower().startswith("before"):
+        earliest = None
+    return FuzzyDate(best_year, month_num, day_num, earliest, latest)
+
+def birthdate_sorter(record: Dict[str, Any]) -> Tuple[int, int, int]:
+    """Function for use in sorted(), to sort birthdates in chronological
+    order. Returns a tuple of (year, month, day).
+    """
+    birth = parse_fuzzy_date(record.get("birth_year"), record.get("birth_month"), record.get("birth_day"))
+
+    # in case of unknown values, 1000000 will ensure they are sorted
+    # to the end
+    return (
+        birth.year if birth.year is not None else 1000000,
+        birth.month if birth.month is not None else 1000000,
+        birth.day if birth.day is not None else 1000000
+    )
 
 def format_person_data(record: Dict[str, Any], focal: bool = False) -> Dict[str, Any]:
     """Given a dictionary of Person data from the database, this adds
@@ -62,43 +111,107 @@ def format_person_data(record: Dict[str, Any], focal: bool = False) -> Dict[str,
     Returns the original dict supplemented with these additional fields.
     """
     output = dict(record)
-    output["display_name"] = create_display_name(record)
+    derived = get_derived_fields(record)
+    output["display_name"] = derived["display_name"]
     if focal:
-        output["title_name"] = create_display_name(record, underline=False)
-    output["life_span"] = create_life_span(record)
+        output["title_name"] = derived["title_name"]
+    output["life_span"] = derived["life_span"]
 
-    output["birth_date"] = format_date(record, "birth_day", "birth_month", "birth_year", all_blanks=True)
-    output["deceased"] = is_deceased(record)
+    output["birth_date"] = derived["birth_date"]
+    output["deceased"] = derived["deceased"]
 
     if focal and output["deceased"]:
-        output["death_date"] = format_date(record, "death_day", "death_month", "death_year", all_blanks=True)
-
-        age_at_death, unsure = calc_age(record, deceased=True)
-        if age_at_death is not None:
-            if unsure > 0:
-                output["age_at_death"] = f"{age_at_death}-{age_at_death+unsure}"
-            else:
-                output["age_at_death"] = str(age_at_death)
+        output["death_date"] = derived["death_date_blanks"]
+        if derived["age_at_death"] is not None:
+            output["age_at_death"] = derived["age_at_death"]
     else:
-        output["death_date"] = format_date(record, "death_day", "death_month", "death_year")
-
-        age, unsure = calc_age(record, deceased=False)
-        if age is not None:
-            if unsure > 0:
-                output["age"] = f"{age}-{age+unsure}"
+        output["death_date"] = derived["death_date"]
+
+        # current age is the one thing that changes without the record
+        # changing, so it is calculated fresh each time
+        if derived["birth_datetime"] is not None:
+            age = (datetime.today() - derived["birth_datetime"]).days // 365
+            if derived["unsure_birth"]:
+                output["age"] = f"{age}-{age+1}"
             else:
                 output["age"] = str(age)
 
     # used in graphical tree
-    output["name"] = create_short_name(record)
-    if is_attr(output, "gender") and output["gender"] in GENDER_MAP:
-        output["class"] = GENDER_MAP[output["gender"]]
+    output["name"] = derived["name"]
+    if "class" in derived:
+        output["class"] = derived["class"]
     output["extra"] = { "url": url_for("person_page", pid=output["id"]) }
     
     if focal:
         output["textClass"] = "emphasis"
     return output
 
+def tree_node(record: Dict[str, Any], focal: bool = False) -> Dict[str, Any]:
+    """Given a dictionary of Person data from the database, returns a
+    node for the graphical tree, with just the fields that the tree
+    uses. Add "marriages" (each with a "spouse" node and a list of
+    "children" nodes) to build out the tree below the person."""
+    derived = get_derived_fields(record)
+    node = {
+        "name": derived["name"],
+        "extra": { "url": url_for("person_page", pid=record["id"]) }
+    }
+    if "class" in derived:
+        node["class"] = derived["class"]
+    if focal:
+        node["textClass"] = "emphasis"
+    return node
+
+def tree_parent_ids(parents: List[Dict[str, Any]]) -> List[str]:
+    """Given a person's parents (each with an "adoptive" flag), returns
+    the IDs of the ones to show in the graphical tree. This is the
+    biological parents, unless there are fewer than two of them and
+    there are adoptive parents. There are a few cases in the data with
+    two biological parents plus an adoptive parent, and the graphical
+    tree just doesn't handle more than two parents very well..."""
+    bio_parent_ids = [p["id"] for p in parents if not p["adoptive"]]
+    adopt_parent_ids = [p["id"] for p in parents if p["adoptive"]]
+    if len(adopt_parent_ids) > 0 and len(bio_parent_ids) < 2:
+        return bio_parent_ids + adopt_parent_ids
+    else:
+        return bio_parent_ids
+
+def get_derived_fields(record: Dict[str, Any]) -> Dict[str, Any]:
+    """Returns the fields derived from a Person record (formatted names,
+    dates, life span, etc.), which are cached for each distinct version
+    of the record, so they are only computed once per person until
+    their data changes. The returned dict is shared, so it should not
+    be modified."""
+    return _derive_fields(tuple([record.get(col) for col in PERSON_COLS]))
+
+@lru_cache(maxsize=4096)
+def _derive_fields(values: Tuple) -> Dict[str, Any]:
+    record = dict(zip(PERSON_COLS, values))
+    derived = {
+        "display_name": create_display_name(record),
+        "title_name": create_display_name(record, underline=False),
+        "life_span": create_life_span(record),
+        "birth_date": format_date(record, "birth_day", "birth_month", "birth_year", all_blanks=True),
+        "deceased": is_deceased(record),
+        "death_date": format_date(record, "death_day", "death_month", "death_year"),
+        "death_date_blanks": format_date(record, "death_day", "death_month", "death_year", all_blanks=True),
+        "age_at_death": None,
+        "name": create_short_name(record)
+    }
+
+    age_at_death, unsure = calc_age(record, deceased=True)
+    if age_at_death is not None:
+        if unsure > 0:
+            derived["age_at_death"] = f"{age_at_death}-{age_at_death+unsure}"
+        else:
+            derived["age_at_death"] = str(age_at_death)
+
+    derived["birth_datetime"], derived["unsure_birth"] = parse_date(record, "birth_day", "birth_month", "birth_year")
+
+    if is_attr(record, "gender") and record["gender"] in GENDER_MAP:
+        derived["class"] = GENDER_MAP[record["gender"]]
+    return derived
+
 def create_display_name(record: Dict[str, Any], underline: bool = True) -> str:
     """Given a Person record, formats the first, middle, and last
     names, as well as nickname if it exists, into a string formatted
@@ -222,6 +335,20 @@ def format_date(record: Dict[str, Any], day: str, month: str,
         string = None
     return string
 
+def parse_date(record: Dict[str, Any], day: str, month: str,
+               year: str) -> Tuple[Optional[datetime], bool]:
+    """Given a Person record and the appropriate fields to use for the
+    date (e.g., "birth_day", "death_day"), parses the date as best it
+    can. Returns the date (or None if the year can't be determined),
+    and whether the month or day couldn't be parsed, in which case
+    the date falls back to the start of the year or month."""
+    parsed = parse_fuzzy_date(record.get(year), record.get(month), record.get(day))
+    if parsed.year is None:
+        return None, False
+    unsure = (is_attr(record, month) and parsed.month is None) \
+        or (is_attr(record, day) and parsed.day is None)
+    return datetime(parsed.year, parsed.month or 1, parsed.day or 1), unsure
+
 def calc_age(record: Dict[str, Any], deceased: bool = True) -> Tuple[Optional[int], Optional[int]]:
     """Given a Person record and whether the person should be presumed
     deceased, calculates either current age (for deceased == False) or
@@ -233,37 +360,11 @@ def calc_age(record: Dict[str, Any], deceased: bool = True) -> Tuple[Optional[in
     be off by one year. Thus, their age might return as (33, 1) to
     indicate that they could be either 33 or 34.
     """
-    birth_vals = { "year": None, "month": 1, "day": 1 }
-    unsure_birth = False
-    if is_attr(record, "birth_year"):
-        try:
-            birth_vals["year"] = int(record["birth_year"])
-        except ValueError:
-            try:
-                birth_vals["year"] = int(record["birth_year"][0:4])
-            except:
-                # if we can't figure out birth year, no point in continuing
-                return None, None
-    else:
+    birth_date, unsure_birth = parse_date(record, "birth_day", "birth_month", "birth_year")
+    if birth_date is None:
+        # if we can't figure out birth year, no point in continuing
         return None, None
 
-    if is_attr(record, "birth_month"):
-        try:
-            birth_vals["month"] = MONTHS.index(record["birth_month"]) + 1
-        except:
-            unsure_birth = True
-    
-    if is_attr(record, "birth_day"):
-        try:
-            birth_vals["day"] = int(record["birth_day"])
-        except ValueError:
-            try:
-                birth_vals["day"] = int(record["birth_day"][0:2])
-            except:
-                unsure_birth = True
-
-    birth_date = datetime(**birth_vals)
-
     if not deceased:
         today = datetime.today()
         duration = today - birth_date
@@ -271,46 +372,21 @@ def calc_age(record: Dict[str, Any], deceased: bool = True) -> Tuple[Optional[in
         return (age, int(unsure_birth))
 
     else:
-        death_vals = { "year": None, "month": 1, "day": 1 }
-        unsure_death = False
-        if is_attr(record, "death_year"):
-            try:
-                death_vals["year"] = int(record["death_year"])
-            except ValueError:
-                try:
-                    death_vals["year"] = int(record["death_year"][0:4])
-                except:
-                    # if we can't figure out death year, no point in continuing
-                    return None, None
-        else:
+        death_date, unsure_death = parse_date(record, "death_day", "death_month", "death_year")
+        if death_date is None:
+            # if we can't figure out death year, no point in continuing
             return None, None
 
-        if is_attr(record, "death_month"):
-            try:
-                death_vals["month"] = MONTHS.index(record["death_month"]) + 1
-            except:
-                unsure_death = True
-        
-        if is_attr(record, "death_day"):
-            try:
-                death_vals["day"] = int(record["death_day"])
-            except ValueError:
-                try:
-                    death_vals["day"] = int(record["death_day"][0:2])
-                except:
-                    unsure_death = True
-
-        death_date = datetime(**death_vals)
         duration = death_date - birth_date
         age = duration.days // 365
         return (age, int(unsure_birth) + int(unsure_death))
 
 def get_latest_export() -> Optional[str]:
     """If the data has been exported from the database in the past,
-    returns the date of that export, formatted as `%Y%m%d`."""
+    returns the file name of the latest full export."""
     try:
         files = os.listdir(os.path.join(os.environ.get("APP_ROOT"), "static/data"))
-        files = [f for f in files if f.endswith(".zip")]
+        files = [f for f in files if f.startswith("data_") and f.endswith(".zip")]
         if len(files) > 0:
             files = sorted(files)
             return files[-1]
@@ -319,20 +395,114 @@ def get_latest_export() -> Optional[str]:
     except FileNotFoundError:
         return None
 
+def export_date(filename: str) -> date:
+    """The date of an export, from its file name."""
+    return datetime.strptime(filename.split(".")[0].split("_")[-1], "%Y%m%d").date()
+
+def snapshot_due() -> bool:
+    """Whether there is no full export yet, or the latest one is older
+    than APP_EXPORT_SNAPSHOT_DAYS days (default 7; 0 means exports are
+    only made on request)."""
+    latest = get_latest_export()
+    if latest is None:
+        return True
+    max_age = int(os.environ.get("APP_EXPORT_SNAPSHOT_DAYS") or 7)
+    if max_age <= 0:
+        return False
+    return (date.today() - export_date(latest)).days >= max_age
+
+def _write_export(filename: str, writers: Dict[str, Callable[[Any], None]]) -> None:
+    # streams the CSV output from each writer straight into the zip
+    # file, which is written under a temporary name and then renamed, so
+    # a partly-written export is never served
+    data_dir = os.path.join(os.environ.get("APP_ROOT"), "static/data")
+    os.makedirs(data_dir, exist_ok=True)
+    tmp_path = os.path.join(data_dir, f".{filename}.tmp")
+    try:
+        with zipfile.ZipFile(tmp_path, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+            for csv_name, writer in writers.items():
+                with zf.open(csv_name, "w") as f:
+                    writer(f)
+        os.replace(tmp_path, os.path.join(data_dir, filename))
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
 def export_data(db_conn: DBConnect) -> str:
     """Given a connection to the database, this exports the data to
     CSV files, zips them and saves them to the <APP_ROOT>/static/data/
     directory. Returns the name of the file (without the directory)."""
     date = datetime.now().strftime("%Y%m%d")
     tables = ["people", "marriages", "children"]
-    with tempfile.TemporaryDirectory() as tmpdir:
-        for table in tables:
-            with open(os.path.join(tmpdir, f"{table}_{date}.csv"), "w") as f:
-                db_conn.export_data(table, f)
-
-        os.makedirs(os.path.join(os.environ.get("APP_ROOT"), "static/data"), exist_ok=True)
-        shutil.make_archive(os.path.join(os.environ.get("APP_ROOT"), "static/data", f"data_{date}"), "zip", tmpdir)
-    return f"data_{date}.zip"
+    writers = {
+        f"{table}_{date}.csv": (lambda f, table=table: db_conn.export_data(table, f))
+        for table in tables
+    }
+    filename = f"data_{date}.zip"
+    _write_export(filename, writers)
+    return filename
+
+def import_data(db_conn: DBConnect, files: List[Tuple[str, IO[bytes]]]) -> Dict[str, Dict[str, int]]:
+    """Bulk loads CSV files in the format written by export_data() and
+    export_changes(), given as a list of (file name, file) pairs: either
+    the CSV files themselves, or zip files of them, like the exports.
+    Each CSV file is matched to its table by the start of its name, e.g.
+    "people_20240101.csv". Returns the number of rows inserted, updated,
+    and unchanged in each table, or raises DataImportError if the files
+    can't be loaded."""
+    tables = {}
+    archives = []
+    try:
+        for name, fh in files:
+            if name.lower().endswith(".zip"):
+                try:
+                    zf = zipfile.ZipFile(fh)
+                except zipfile.BadZipFile:
+                    raise DataImportError([f"{name}: not a valid zip file."])
+                archives.append(zf)
+                entries = [(n, zf.open(n)) for n in zf.namelist() if not n.endswith("/")]
+            else:
+                entries = [(name, fh)]
+
+            for entry_name, entry in entries:
+                base = os.path.basename(entry_name)
+                table = next((t for t in ["people", "marriages", "children"] if base.startswith(t)), None)
+                if table is None or not base.lower().endswith(".csv"):
+                    raise DataImportError([f"{base}: not a people, marriages, or children CSV file."])
+                if table in tables:
+                    raise DataImportError([f"{base}: more than one {table} file."])
+                tables[table] = entry
+        return db_conn.import_data(tables)
+    finally:
+        for zf in archives:
+            zf.close()
+
+def changes_filename(since: date) -> str:
+    """The file name of today's export of the changes since `since`."""
+    return f"changes_{since.strftime('%Y%m%d')}_{datetime.now().strftime('%Y%m%d')}.zip"
+
+def export_changes(db_conn: DBConnect, since: date) -> str:
+    """Like export_data(), but only exports the rows that were added or
+    changed on or after `since`, e.g., the date of an earlier export.
+    Changed rows are exported in full, so applying the changes to a copy
+    of an earlier export brings it up to date. Change exports from
+    previous days are removed. Returns the name of the file (without
+    the directory)."""
+    date = datetime.now().strftime("%Y%m%d")
+    since_str = since.strftime("%Y%m%d")
+    tables = ["people", "marriages", "children"]
+    writers = {
+        f"{table}_changes_{since_str}_{date}.csv": (lambda f, table=table: db_conn.export_changes(table, since, f))
+        for table in tables
+    }
+    filename = changes_filename(since)
+    _write_export(filename, writers)
+
+    data_dir = os.path.join(os.environ.get("APP_ROOT"), "static/data")
+    for f in os.listdir(data_dir):
+        if f.startswith("changes_") and f.endswith(".zip") and not f.endswith(f"_{date}.zip"):
+            os.remove(os.path.join(data_dir, f))
+    return filename
 
 def is_safe_url(target: str) -> bool:
     """Ensures that URL redirects used with Flask-Login are safe, i.e.
@@ -0,0 +1,129 @@
+"""Compares the old GROUP BY sibling query from DBConnect.get_children
+against the current self-join, on copies of the tree scaled up to 1x,
+10x and 100x its size.
+
+The scaled copies are built from whatever is in the database, as
+temporary tables, so nothing is written to the real tables. Connects
+using the same POSTGRES_* environment variables as the app.
+"""
+import os
+import random
+import statistics
+import time
+
+import psycopg2
+
+SCALES = [1, 10, 100]
+SAMPLES = 200
+
+PERSON_SELECT = """
+    p.id, p.print_id, p.in_tree, p.first_name, p.nickname,
+    p.middle_name1, p.middle_name2, p.last_name, p.pref_name,
+    p.gender, p.birth_month, p.birth_day, p.birth_year,
+    p.birth_place, p.death_month, p.death_day, p.death_year,
+    p.death_place, p.buried, p.additional_notes"""
+
+OLD_QUERY = f"""
+    SELECT {PERSON_SELECT}
+    FROM (
+        SELECT DISTINCT a.cid, a.birth_order
+        FROM bench_children a
+        INNER JOIN
+        (
+            SELECT
+                cid,
+                SUM((pid = %s)::integer + (pid = %s)::integer) AS match
+            FROM bench_children
+            GROUP BY cid
+        ) b ON a.cid = b.cid
+        WHERE match >= 2
+    ) c
+    LEFT JOIN bench_people p on c.cid = p.id
+    ORDER BY c.birth_order"""
+
+NEW_QUERY = f"""
+    SELECT {PERSON_SELECT}
+    FROM (
+        SELECT DISTINCT a.cid, a.birth_order
+        FROM bench_children a
+        INNER JOIN bench_children b ON a.cid = b.cid
+        WHERE a.pid = %s AND b.pid = %s
+    ) c
+    LEFT JOIN bench_people p on c.cid = p.id
+    ORDER BY c.birth_order"""
+
+
+def build_tables(cursor, scale: int) -> None:
+    """Creates bench_* temp tables holding `scale` copies of the tree,
+    with the IDs of each copy given a distinct suffix."""
+    cursor.execute("DROP TABLE IF EXISTS bench_people, bench_children")
+    cursor.execute("CREATE TEMP TABLE bench_people (LIKE people)")
+    cursor.execute("""
+        INSERT INTO bench_people
+        SELECT
+            p.id || '~' || n, p.print_id, p.in_tree, p.first_name,
+            p.nickname, p.middle_name1, p.middle_name2, p.last_name,
+            p.pref_name, p.gender, p.birth_month, p.birth_day,
+            p.birth_year, p.birth_place, p.death_month, p.death_day,
+            p.death_year, p.death_place, p.buried, p.additional_notes
+        FROM people p, generate_series(1, %s) n""", (scale,))
+    cursor.execute("""
+        CREATE TEMP TABLE bench_children AS
+        SELECT
+            c.id, c.pid || '~' || n AS pid, c.cid || '~' || n AS cid,
+            c.birth_order, c.adoptive
+        FROM children c, generate_series(1, %s) n""", (scale,))
+    cursor.execute("ALTER TABLE bench_people ADD PRIMARY KEY (id)")
+    cursor.execute("CREATE INDEX ON bench_children (pid)")
+    cursor.execute("CREATE INDEX ON bench_children (cid)")
+    cursor.execute("ANALYZE bench_people")
+    cursor.execute("ANALYZE bench_children")
+
+
+def parent_pairs(cursor, n: int):
+    cursor.execute("""
+        SELECT a.pid, b.pid
+        FROM bench_children a
+        INNER JOIN bench_children b ON a.cid = b.cid AND a.pid < b.pid""")
+    pairs = cursor.fetchall()
+    random.seed(1)
+    return [random.choice(pairs) for _ in range(n)]
+
+
+def time_query(cursor, query: str, pairs) -> float:
+    """Returns the median time for the query in milliseconds."""
+    times = []
+    for pid1, pid2 in pairs:
+        start = time.perf_counter()
+        cursor.execute(query, (pid1, pid2))
+        cursor.fetchall()
+        times.append((time.perf_counter() - start) * 1000)
+    return statistics.median(times)
+
+
+def main() -> None:
+    conn = psycopg2.connect(
+        host=os.environ["POSTGRES_HOST"],
+        port=os.environ["POSTGRES_PORT"],
+        dbname=os.environ["POSTGRES_DB"],
+        user=os.environ["POSTGRES_USER"],
+        password=os.environ["POSTGRES_PASSWORD"])
+    cursor = conn.cursor()
+
+    print(f"{'scale':>6} {'people':>8} {'child rows':>11} {'old (ms)':>9} {'new (ms)':>9} {'speedup':>8}")
+    for scale in SCALES:
+        build_tables(cursor, scale)
+        cursor.execute("SELECT (SELECT count(*) FROM bench_people), (SELECT count(*) FROM bench_children)")
+        n_people, n_children = cursor.fetchone()
+
+        pairs = parent_pairs(cursor, SAMPLES)
+        old_ms = time_query(cursor, OLD_QUERY, pairs)
+        new_ms = time_query(cursor, NEW_QUERY, pairs)
+        print(f"{scale:>5}x {n_people:>8} {n_children:>11} {old_ms:>9.3f} {new_ms:>9.3f} {old_ms / new_ms:>7.0f}x")
+
+    conn.rollback()
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
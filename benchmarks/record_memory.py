@@ -0,0 +1,93 @@
+"""Compares the memory held by the people, marriages, and children
+tables when loaded as one dict per row (as DBConnect used to return
+them) against the compact records (db.Person, db.Marriage and
+db.ChildLink), on a copy of the tree scaled up to at least 100,000
+people.
+
+The rows are fetched once from the database and copied in Python, with
+the IDs of each copy given a distinct suffix; as they would be if read
+from a larger database, each copy's strings are separate objects.
+Connects using the same POSTGRES_* environment variables as the app.
+"""
+import gc
+import os
+import sys
+import tracemalloc
+
+import psycopg2
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app", "app"))
+from db import CHILDREN_COLS, ChildLink, Marriage, MARRIAGE_COLS, Person, PERSON_COLS
+
+MIN_PEOPLE = 100000
+
+TABLES = [
+    ("people", PERSON_COLS, Person, ["id"]),
+    ("marriages", MARRIAGE_COLS, Marriage, ["pid1", "pid2"]),
+    ("children", CHILDREN_COLS, ChildLink, ["pid", "cid"])
+]
+
+
+def scaled_rows(cursor, table: str, cols, id_cols, scale: int):
+    """Returns `scale` copies of the table's rows."""
+    cursor.execute(f"SELECT {', '.join(cols)} FROM {table}")
+    rows = cursor.fetchall()
+    id_idx = [cols.index(c) for c in id_cols]
+    out = []
+    for n in range(scale):
+        for row in rows:
+            row = list(row)
+            for i in range(len(row)):
+                if i in id_idx:
+                    row[i] = f"{row[i]}~{n}"
+                elif isinstance(row[i], str):
+                    # a new string object with the same value
+                    row[i] = "".join(list(row[i]))
+            out.append(tuple(row))
+    return out
+
+
+def fresh(rows):
+    """Copies of the rows, with new string objects, so that each way of
+    holding them starts from rows as they come from the database."""
+    return [tuple("".join(list(v)) if isinstance(v, str) else v for v in row) for row in rows]
+
+
+def measure(build) -> int:
+    """Returns the bytes still allocated by what `build` returns."""
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = build()
+    gc.collect()
+    size = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    del result
+    return size
+
+
+def main() -> None:
+    conn = psycopg2.connect(
+        host=os.environ["POSTGRES_HOST"],
+        port=os.environ["POSTGRES_PORT"],
+        dbname=os.environ["POSTGRES_DB"],
+        user=os.environ["POSTGRES_USER"],
+        password=os.environ["POSTGRES_PASSWORD"])
+    cursor = conn.cursor()
+    cursor.execute("SELECT count(*) FROM people")
+    scale = -(-MIN_PEOPLE // cursor.fetchone()[0])
+
+    print(f"{'table':>10} {'rows':>8} {'dicts (MB)':>11} {'records (MB)':>13} {'saved':>6}")
+    for table, cols, record_cls, id_cols in TABLES:
+        rows = scaled_rows(cursor, table, cols, id_cols, scale)
+        # the values are counted too, as interning them is part of the
+        # saving
+        dict_size = measure(lambda: [dict(zip(cols, r)) for r in fresh(rows)])
+        record_size = measure(lambda: [record_cls.from_row(r) for r in fresh(rows)])
+        print(f"{table:>10} {len(rows):>8} {dict_size / 2**20:>11.1f} {record_size / 2**20:>13.1f} {1 - record_size / dict_size:>6.0%}")
+
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,5 @@
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
 CREATE TABLE people (
     id TEXT PRIMARY KEY,
     print_id TEXT,
@@ -18,7 +20,10 @@ CREATE TABLE people (
     death_year TEXT,
     death_place TEXT,
     buried TEXT,
-    additional_notes TEXT
+    additional_notes TEXT,
+    -- normalized from the text fields above by a trigger
+    birth_range DATERANGE,
+    death_range DATERANGE
 );
 
 CREATE TABLE marriages (
@@ -35,6 +40,9 @@ CREATE TABLE marriages (
     divorced_month TEXT,
     divorced_day INTEGER CHECK (divorced_day >= 0 AND divorced_day <= 31),
     divorced_year TEXT,
+    -- normalized from the text fields above by a trigger
+    married_range DATERANGE,
+    divorced_range DATERANGE,
     FOREIGN KEY (pid1) REFERENCES people (id) ON DELETE CASCADE ON UPDATE CASCADE,
     FOREIGN KEY (pid2) REFERENCES people (id) ON DELETE CASCADE ON UPDATE CASCADE
 );
@@ -49,8 +57,160 @@ CREATE TABLE children (
     FOREIGN KEY (cid) REFERENCES people (id) ON DELETE CASCADE ON UPDATE CASCADE
 );
 
+-- one row per insert or update made through the admin pages, so that
+-- exports can include only the rows changed since an earlier export;
+-- row_id is the id of the changed row in table_name
+CREATE TABLE change_log (
+    id BIGSERIAL PRIMARY KEY,
+    table_name TEXT NOT NULL,
+    row_id TEXT NOT NULL,
+    action TEXT NOT NULL,
+    changed_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now()
+);
+
+-- every ancestor of every person, with the number of generations
+-- between them (the fewest, if there is more than one line of descent);
+-- kept up to date by the app as parent-child rows are added or changed
+CREATE TABLE ancestry (
+    ancestor_id TEXT NOT NULL,
+    descendant_id TEXT NOT NULL,
+    depth INTEGER NOT NULL,
+    PRIMARY KEY (ancestor_id, descendant_id),
+    FOREIGN KEY (ancestor_id) REFERENCES people (id) ON DELETE CASCADE ON UPDATE CASCADE,
+    FOREIGN KEY (descendant_id) REFERENCES people (id) ON DELETE CASCADE ON UPDATE CASCADE
+);
+
+-- Parses the free-text year, month name, and day fields into the range
+-- of days the date could fall on: e.g., "1846 or 1847" spans both
+-- years, "1853?" is taken to be give or take a year, a missing month or
+-- day spans the whole year or month, and "after 1888" has no upper
+-- bound. Returns NULL if there is no 4-digit year.
+-- (utils.parse_fuzzy_date() follows the same rules.)
+CREATE FUNCTION fuzzy_date_range(year TEXT, month TEXT, day INTEGER)
+RETURNS DATERANGE AS $$
+DECLARE
+    years INTEGER[];
+    month_num INTEGER;
+    first_year INTEGER;
+    last_year INTEGER;
+    earliest DATE;
+    latest DATE;
+BEGIN
+    years := ARRAY(SELECT m[1]::INTEGER FROM regexp_matches(year, '(\d{4})', 'g') m);
+    IF cardinality(years) = 0 THEN
+        RETURN NULL;
+    END IF;
+    SELECT MIN(y), MAX(y) INTO first_year, last_year FROM unnest(years) y;
+    IF position('?' IN year) > 0 THEN
+        first_year := first_year - 1;
+        last_year := last_year + 1;
+    END IF;
+    -- dates can only have years from 1 to 9999
+    first_year := LEAST(GREATEST(first_year, 1), 9999);
+    last_year := LEAST(GREATEST(last_year, 1), 9999);
+
+    month_num := array_position(ARRAY['January', 'February', 'March', 'April',
+        'May', 'June', 'July', 'August', 'September', 'October', 'November',
+        'December'], month);
+    IF month_num IS NULL THEN
+        earliest := make_date(first_year, 1, 1);
+        latest := make_date(last_year, 12, 31);
+    ELSE
+        earliest := make_date(first_year, month_num, 1);
+        latest := (make_date(last_year, month_num, 1) + INTERVAL '1 month - 1 day')::DATE;
+        IF day BETWEEN 1 AND 31 THEN
+            BEGIN
+                earliest := make_date(first_year, month_num, day);
+                latest := make_date(last_year, month_num, day);
+            EXCEPTION WHEN datetime_field_overflow THEN
+                -- e.g., February 30; fall back to the whole month
+            END;
+        END IF;
+    END IF;
+
+    IF year ILIKE 'after%' THEN
+        RETURN daterange(earliest, NULL, '[)');
+    ELSIF year ILIKE 'before%' THEN
+        RETURN daterange(NULL, latest, '[]');
+    END IF;
+    RETURN daterange(earliest, latest, '[]');
+END
+$$ LANGUAGE plpgsql IMMUTABLE;
+
+CREATE FUNCTION people_set_date_ranges() RETURNS TRIGGER AS $$
+BEGIN
+    NEW.birth_range := fuzzy_date_range(NEW.birth_year, NEW.birth_month, NEW.birth_day);
+    NEW.death_range := fuzzy_date_range(NEW.death_year, NEW.death_month, NEW.death_day);
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER people_date_ranges BEFORE INSERT OR UPDATE ON people
+    FOR EACH ROW EXECUTE FUNCTION people_set_date_ranges();
+
+CREATE FUNCTION marriages_set_date_ranges() RETURNS TRIGGER AS $$
+BEGIN
+    NEW.married_range := fuzzy_date_range(NEW.married_year, NEW.married_month, NEW.married_day);
+    NEW.divorced_range := fuzzy_date_range(NEW.divorced_year, NEW.divorced_month, NEW.divorced_day);
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER marriages_date_ranges BEFORE INSERT OR UPDATE ON marriages
+    FOR EACH ROW EXECUTE FUNCTION marriages_set_date_ranges();
+
+-- all of a person's names as one lowercase string, for name searches
+CREATE FUNCTION person_names(first_name TEXT, nickname TEXT, middle_name1 TEXT, middle_name2 TEXT, last_name TEXT)
+RETURNS TEXT AS $$
+    SELECT lower(coalesce(first_name, '') || ' ' || coalesce(nickname, '') || ' ' || coalesce(middle_name1, '') || ' ' || coalesce(middle_name2, '') || ' ' || coalesce(last_name, ''))
+$$ LANGUAGE SQL IMMUTABLE;
+
+-- a place name with case and punctuation removed, for matching places;
+-- e.g., "Meaford,  Ontario" becomes "meaford ontario"
+-- (db.place_key() does the same)
+CREATE FUNCTION place_key(place TEXT) RETURNS TEXT AS $$
+    SELECT trim(regexp_replace(lower(place), '[^a-z0-9]+', ' ', 'g'))
+$$ LANGUAGE SQL IMMUTABLE;
+
 COPY people (id, print_id, in_tree, first_name, nickname, middle_name1, middle_name2, last_name, pref_name, gender, birth_month, birth_day, birth_year, birth_place, death_month, death_day, death_year, death_place, buried, additional_notes) FROM '/data_imports/people.csv' CSV HEADER;
 
 COPY marriages (pid1, pid2, marriage_order, married_month, married_day, married_year, married_place, common_law, divorced, divorced_month, divorced_day, divorced_year) FROM '/data_imports/marriages.csv' CSV HEADER;
 
-COPY children (pid, cid, birth_order, adoptive) FROM '/data_imports/children.csv' CSV HEADER;
\ No newline at end of file
+COPY children (pid, cid, birth_order, adoptive) FROM '/data_imports/children.csv' CSV HEADER;
+
+-- (the depth limit guards against loops in the data)
+INSERT INTO ancestry (ancestor_id, descendant_id, depth)
+WITH RECURSIVE up (descendant_id, ancestor_id, depth) AS (
+    SELECT cid, pid, 1 FROM children WHERE pid <> cid
+    UNION
+    SELECT u.descendant_id, c.pid, u.depth + 1
+    FROM up u
+    INNER JOIN children c ON c.cid = u.ancestor_id
+    WHERE u.depth < 100
+)
+SELECT ancestor_id, descendant_id, MIN(depth)
+FROM up
+WHERE ancestor_id <> descendant_id
+GROUP BY ancestor_id, descendant_id;
+
+-- indexes for looking up relationships by person
+CREATE INDEX children_pid_idx ON children (pid);
+CREATE INDEX children_cid_idx ON children (cid);
+CREATE INDEX marriages_pid1_idx ON marriages (pid1);
+CREATE INDEX marriages_pid2_idx ON marriages (pid2);
+CREATE INDEX change_log_changed_at_idx ON change_log (changed_at);
+CREATE INDEX ancestry_descendant_idx ON ancestry (descendant_id, depth);
+
+-- trigram index for substring matches on names
+CREATE INDEX people_names_trgm_idx ON people USING GIN (person_names(first_name, nickname, middle_name1, middle_name2, last_name) gin_trgm_ops);
+
+-- indexes for date range searches, e.g. born between two years
+CREATE INDEX people_birth_range_idx ON people USING GIST (birth_range);
+CREATE INDEX people_death_range_idx ON people USING GIST (death_range);
+CREATE INDEX marriages_married_range_idx ON marriages USING GIST (married_range);
+
+-- indexes for place searches, by exact key and by substring
+CREATE INDEX people_birth_place_key_idx ON people (place_key(birth_place));
+CREATE INDEX people_death_place_key_idx ON people (place_key(death_place));
+CREATE INDEX people_birth_place_trgm_idx ON people USING GIN (place_key(birth_place) gin_trgm_ops);
+CREATE INDEX people_death_place_trgm_idx ON people USING GIN (place_key(death_place) gin_trgm_ops);
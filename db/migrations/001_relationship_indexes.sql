@@ -0,0 +1,8 @@
+-- Indexes for looking up relationships by person. These are created by
+-- load_data.sql for new databases; run this against databases that
+-- were initialized before they were added.
+
+CREATE INDEX IF NOT EXISTS children_pid_idx ON children (pid);
+CREATE INDEX IF NOT EXISTS children_cid_idx ON children (cid);
+CREATE INDEX IF NOT EXISTS marriages_pid1_idx ON marriages (pid1);
+CREATE INDEX IF NOT EXISTS marriages_pid2_idx ON marriages (pid2);
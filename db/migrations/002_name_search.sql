@@ -0,0 +1,14 @@
+-- Trigram index for name searches. These are created by load_data.sql
+-- for new databases; run this against databases that were initialized
+-- before they were added.
+
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+-- all of a person's names as one lowercase string, for name searches
+CREATE OR REPLACE FUNCTION person_names(first_name TEXT, nickname TEXT, middle_name1 TEXT, middle_name2 TEXT, last_name TEXT)
+RETURNS TEXT AS $$
+    SELECT lower(coalesce(first_name, '') || ' ' || coalesce(nickname, '') || ' ' || coalesce(middle_name1, '') || ' ' || coalesce(middle_name2, '') || ' ' || coalesce(last_name, ''))
+$$ LANGUAGE SQL IMMUTABLE;
+
+-- trigram index for substring matches on names
+CREATE INDEX IF NOT EXISTS people_names_trgm_idx ON people USING GIN (person_names(first_name, nickname, middle_name1, middle_name2, last_name) gin_trgm_ops);
@@ -0,0 +1,98 @@
+-- Normalized date ranges for birth, death, marriage and divorce dates.
+-- These are created by load_data.sql for new databases; run this
+-- against databases that were initialized before they were added.
+
+ALTER TABLE people ADD COLUMN IF NOT EXISTS birth_range DATERANGE;
+ALTER TABLE people ADD COLUMN IF NOT EXISTS death_range DATERANGE;
+ALTER TABLE marriages ADD COLUMN IF NOT EXISTS married_range DATERANGE;
+ALTER TABLE marriages ADD COLUMN IF NOT EXISTS divorced_range DATERANGE;
+
+-- Parses the free-text year, month name, and day fields into the range
+-- of days the date could fall on: e.g., "1846 or 1847" spans both
+-- years, "1853?" is taken to be give or take a year, a missing month or
+-- day spans the whole year or month, and "after 1888" has no upper
+-- bound. Returns NULL if there is no 4-digit year.
+-- (utils.parse_fuzzy_date() follows the same rules.)
+CREATE OR REPLACE FUNCTION fuzzy_date_range(year TEXT, month TEXT, day INTEGER)
+RETURNS DATERANGE AS $$
+DECLARE
+    years INTEGER[];
+    month_num INTEGER;
+    first_year INTEGER;
+    last_year INTEGER;
+    earliest DATE;
+    latest DATE;
+BEGIN
+    years := ARRAY(SELECT m[1]::INTEGER FROM regexp_matches(year, '(\d{4})', 'g') m);
+    IF cardinality(years) = 0 THEN
+        RETURN NULL;
+    END IF;
+    SELECT MIN(y), MAX(y) INTO first_year, last_year FROM unnest(years) y;
+    IF position('?' IN year) > 0 THEN
+        first_year := first_year - 1;
+        last_year := last_year + 1;
+    END IF;
+    -- dates can only have years from 1 to 9999
+    first_year := LEAST(GREATEST(first_year, 1), 9999);
+    last_year := LEAST(GREATEST(last_year, 1), 9999);
+
+    month_num := array_position(ARRAY['January', 'February', 'March', 'April',
+        'May', 'June', 'July', 'August', 'September', 'October', 'November',
+        'December'], month);
+    IF month_num IS NULL THEN
+        earliest := make_date(first_year, 1, 1);
+        latest := make_date(last_year, 12, 31);
+    ELSE
+        earliest := make_date(first_year, month_num, 1);
+        latest := (make_date(last_year, month_num, 1) + INTERVAL '1 month - 1 day')::DATE;
+        IF day BETWEEN 1 AND 31 THEN
+            BEGIN
+                earliest := make_date(first_year, month_num, day);
+                latest := make_date(last_year, month_num, day);
+            EXCEPTION WHEN datetime_field_overflow THEN
+                -- e.g., February 30; fall back to the whole month
+            END;
+        END IF;
+    END IF;
+
+    IF year ILIKE 'after%' THEN
+        RETURN daterange(earliest, NULL, '[)');
+    ELSIF year ILIKE 'before%' THEN
+        RETURN daterange(NULL, latest, '[]');
+    END IF;
+    RETURN daterange(earliest, latest, '[]');
+END
+$$ LANGUAGE plpgsql IMMUTABLE;
+
+CREATE OR REPLACE FUNCTION people_set_date_ranges() RETURNS TRIGGER AS $$
+BEGIN
+    NEW.birth_range := fuzzy_date_range(NEW.birth_year, NEW.birth_month, NEW.birth_day);
+    NEW.death_range := fuzzy_date_range(NEW.death_year, NEW.death_month, NEW.death_day);
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS people_date_ranges ON people;
+CREATE TRIGGER people_date_ranges BEFORE INSERT OR UPDATE ON people
+    FOR EACH ROW EXECUTE FUNCTION people_set_date_ranges();
+
+CREATE OR REPLACE FUNCTION marriages_set_date_ranges() RETURNS TRIGGER AS $$
+BEGIN
+    NEW.married_range := fuzzy_date_range(NEW.married_year, NEW.married_month, NEW.married_day);
+    NEW.divorced_range := fuzzy_date_range(NEW.divorced_year, NEW.divorced_month, NEW.divorced_day);
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS marriages_date_ranges ON marriages;
+CREATE TRIGGER marriages_date_ranges BEFORE INSERT OR UPDATE ON marriages
+    FOR EACH ROW EXECUTE FUNCTION marriages_set_date_ranges();
+
+-- fill in the ranges for existing rows, through the triggers
+UPDATE people SET birth_year = birth_year;
+UPDATE marriages SET married_year = married_year;
+
+-- indexes for date range searches, e.g. born between two years
+CREATE INDEX IF NOT EXISTS people_birth_range_idx ON people USING GIST (birth_range);
+CREATE INDEX IF NOT EXISTS people_death_range_idx ON people USING GIST (death_range);
+CREATE INDEX IF NOT EXISTS marriages_married_range_idx ON marriages USING GIST (married_range);
@@ -0,0 +1,16 @@
+-- Normalized place keys and their indexes, for place searches. These
+-- are created by load_data.sql for new databases; run this against
+-- databases that were initialized before they were added.
+
+-- a place name with case and punctuation removed, for matching places;
+-- e.g., "Meaford,  Ontario" becomes "meaford ontario"
+-- (db.place_key() does the same)
+CREATE OR REPLACE FUNCTION place_key(place TEXT) RETURNS TEXT AS $$
+    SELECT trim(regexp_replace(lower(place), '[^a-z0-9]+', ' ', 'g'))
+$$ LANGUAGE SQL IMMUTABLE;
+
+-- indexes for place searches, by exact key and by substring
+CREATE INDEX IF NOT EXISTS people_birth_place_key_idx ON people (place_key(birth_place));
+CREATE INDEX IF NOT EXISTS people_death_place_key_idx ON people (place_key(death_place));
+CREATE INDEX IF NOT EXISTS people_birth_place_trgm_idx ON people USING GIN (place_key(birth_place) gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS people_death_place_trgm_idx ON people USING GIN (place_key(death_place) gin_trgm_ops);
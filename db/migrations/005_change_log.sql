@@ -0,0 +1,14 @@
+-- Log of inserts and updates, used for exporting only the rows changed
+-- since an earlier export. This is created by load_data.sql for new
+-- databases; run this against databases that were initialized before
+-- it was added.
+
+CREATE TABLE IF NOT EXISTS change_log (
+    id BIGSERIAL PRIMARY KEY,
+    table_name TEXT NOT NULL,
+    row_id TEXT NOT NULL,
+    action TEXT NOT NULL,
+    changed_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now()
+);
+
+CREATE INDEX IF NOT EXISTS change_log_changed_at_idx ON change_log (changed_at);
@@ -0,0 +1,33 @@
+-- Closure table of every ancestor of every person. This is created by
+-- load_data.sql for new databases; run this against databases that
+-- were initialized before it was added. (The app can also rebuild it
+-- with `flask rebuild-ancestry`.)
+
+CREATE TABLE IF NOT EXISTS ancestry (
+    ancestor_id TEXT NOT NULL,
+    descendant_id TEXT NOT NULL,
+    depth INTEGER NOT NULL,
+    PRIMARY KEY (ancestor_id, descendant_id),
+    FOREIGN KEY (ancestor_id) REFERENCES people (id) ON DELETE CASCADE ON UPDATE CASCADE,
+    FOREIGN KEY (descendant_id) REFERENCES people (id) ON DELETE CASCADE ON UPDATE CASCADE
+);
+
+CREATE INDEX IF NOT EXISTS ancestry_descendant_idx ON ancestry (descendant_id, depth);
+
+BEGIN;
+DELETE FROM ancestry;
+-- (the depth limit guards against loops in the data)
+INSERT INTO ancestry (ancestor_id, descendant_id, depth)
+WITH RECURSIVE up (descendant_id, ancestor_id, depth) AS (
+    SELECT cid, pid, 1 FROM children WHERE pid <> cid
+    UNION
+    SELECT u.descendant_id, c.pid, u.depth + 1
+    FROM up u
+    INNER JOIN children c ON c.cid = u.ancestor_id
+    WHERE u.depth < 100
+)
+SELECT ancestor_id, descendant_id, MIN(depth)
+FROM up
+WHERE ancestor_id <> descendant_id
+GROUP BY ancestor_id, descendant_id;
+COMMIT;
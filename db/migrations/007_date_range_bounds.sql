@@ -0,0 +1,59 @@
+-- Keeps the ranges from fuzzy_date_range() within the years a date can
+-- have (1 to 9999), e.g. for "0000" or "9999?", which were rejected.
+-- load_data.sql and 003_date_ranges.sql already include this; run this
+-- against databases that were initialized before it was added.
+
+CREATE OR REPLACE FUNCTION fuzzy_date_range(year TEXT, month TEXT, day INTEGER)
+RETURNS DATERANGE AS $$
+DECLARE
+    years INTEGER[];
+    month_num INTEGER;
+    first_year INTEGER;
+    last_year INTEGER;
+    earliest DATE;
+    latest DATE;
+BEGIN
+    years := ARRAY(SELECT m[1]::INTEGER FROM regexp_matches(year, '(\d{4})', 'g') m);
+    IF cardinality(years) = 0 THEN
+        RETURN NULL;
+    END IF;
+    SELECT MIN(y), MAX(y) INTO first_year, last_year FROM unnest(years) y;
+    IF position('?' IN year) > 0 THEN
+        first_year := first_year - 1;
+        last_year := last_year + 1;
+    END IF;
+    -- dates can only have years from 1 to 9999
+    first_year := LEAST(GREATEST(first_year, 1), 9999);
+    last_year := LEAST(GREATEST(last_year, 1), 9999);
+
+    month_num := array_position(ARRAY['January', 'February', 'March', 'April',
+        'May', 'June', 'July', 'August', 'September', 'October', 'November',
+        'December'], month);
+    IF month_num IS NULL THEN
+        earliest := make_date(first_year, 1, 1);
+        latest := make_date(last_year, 12, 31);
+    ELSE
+        earliest := make_date(first_year, month_num, 1);
+        latest := (make_date(last_year, month_num, 1) + INTERVAL '1 month - 1 day')::DATE;
+        IF day BETWEEN 1 AND 31 THEN
+            BEGIN
+                earliest := make_date(first_year, month_num, day);
+                latest := make_date(last_year, month_num, day);
+            EXCEPTION WHEN datetime_field_overflow THEN
+                -- e.g., February 30; fall back to the whole month
+            END;
+        END IF;
+    END IF;
+
+    IF year ILIKE 'after%' THEN
+        RETURN daterange(earliest, NULL, '[)');
+    ELSIF year ILIKE 'before%' THEN
+        RETURN daterange(NULL, latest, '[]');
+    END IF;
+    RETURN daterange(earliest, latest, '[]');
+END
+$$ LANGUAGE plpgsql IMMUTABLE;
+
+-- fill in the ranges for existing rows, through the triggers
+UPDATE people SET birth_year = birth_year;
+UPDATE marriages SET married_year = married_year;